@@ -2,7 +2,6 @@ import abc
 import contextlib
 import os
 import sys
-from functools import partial
 from itertools import chain
 
 import fbuild
@@ -149,9 +148,7 @@ class AbstractCompiler(fbuild.db.PersistentObject):
         objs = []
         src_deps = []
         dst_deps = []
-        for o, s, d in self.ctx.scheduler.map(
-                partial(self.compile.call, *args, **kwargs),
-                srcs):
+        for o, s, d in self.compile.map(srcs, *args, **kwargs):
             objs.append(o)
             src_deps.extend(s)
             dst_deps.extend(d)
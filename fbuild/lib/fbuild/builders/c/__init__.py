@@ -1,4 +1,4 @@
-import abc, copy
+import abc, contextlib, copy
 from functools import partial
 from itertools import chain
 
@@ -180,6 +180,28 @@ class Builder(fbuild.builders.AbstractCompilerBuilder):
                 **lkwargs) as exe:
             return self.run([exe], quieter=quieter, **kwargs)
 
+    @contextlib.contextmanager
+    def tempfile_link_exe(self, code='', *, quieter=1, ckwargs={}, **kwargs):
+        """Overload tempfile_link_exe to build in the temporary directory, so
+        that checks that run at the same time don't overwrite each other's
+        files in the buildroot."""
+        with self.tempfile(code) as src:
+            obj = self.uncached_compile(src,
+                quieter=quieter,
+                buildroot=src.parent,
+                **ckwargs)
+            yield self.uncached_link_exe(src.parent / 'temp', [obj],
+                quieter=quieter,
+                buildroot=src.parent,
+                **kwargs)
+
+    def identity(self):
+        """Returns what identifies the compiler, such as its executable, its
+        version and its flags, so that what was found out about one builder
+        can be reused by another with the same identity. Returns None if the
+        compiler can't be identified."""
+        return None
+
     # -------------------------------------------------------------------------
 
     def check_statement(self, name, statement, *,
@@ -5,6 +5,7 @@ from itertools import chain
 import fbuild
 import fbuild.builders
 import fbuild.builders.c
+import fbuild.builders.c.objcache
 import fbuild.builders.platform
 import fbuild.db
 import fbuild.record
@@ -359,11 +360,8 @@ class Compiler(fbuild.db.PersistentObject):
             suffix=None,
             buildroot=None,
             **kwargs):
-        buildroot = buildroot or self.ctx.buildroot
         src = Path(src)
-
-        suffix = suffix or self.suffix
-        dst = Path(dst or src).addroot(buildroot).replaceext(suffix)
+        dst = self.output(src, dst, suffix=suffix, buildroot=buildroot)
         dst.parent.makedirs()
 
         stdout, stderr = self.cc([src], dst,
@@ -374,6 +372,14 @@ class Compiler(fbuild.db.PersistentObject):
 
         return dst, stdout, stderr
 
+    def output(self, src, dst=None, *, suffix=None, buildroot=None):
+        """Returns the object that compiling the source would make."""
+
+        buildroot = buildroot or self.ctx.buildroot
+        suffix = suffix or self.suffix
+
+        return Path(dst or src).addroot(buildroot).replaceext(suffix)
+
     def __str__(self):
         return str(self.cc)
 
@@ -433,6 +439,17 @@ class Builder(fbuild.builders.c.Builder):
     def __str__(self):
         return str(self.compiler)
 
+    def identity(self):
+        cc = self.compiler.cc
+        return (
+            str(cc.exe),
+            cc.version(),
+            tuple(chain(
+                cc.pre_flags,
+                cc.flags,
+                self.compiler.flags,
+                self.exe_linker.flags)))
+
     # --------------------------------------------------------------------------
 
     @fbuild.db.cachemethod
@@ -440,6 +457,30 @@ class Builder(fbuild.builders.c.Builder):
             flags=[],
             **kwargs) -> fbuild.db.DST:
         """Compile a c file and cache the results."""
+        # Reuse the object if it's in the object cache.
+        cache = fbuild.builders.c.objcache.find_object_cache(self.ctx)
+        if cache is None:
+            key = None
+        else:
+            key = cache.key(self, src, dict(kwargs, flags=flags))
+
+        if key is not None:
+            found = cache.find(key)
+            if found is not None:
+                cached, deps = found
+                obj = self.compiler.output(src, dst,
+                    suffix=kwargs.get('suffix'),
+                    buildroot=kwargs.get('buildroot'))
+
+                self.ctx.logger.check(' * %s (cached)' % self.compiler,
+                    '%s -> %s' % (src, obj),
+                    color='compile',
+                    verbose=kwargs.get('quieter', 0))
+                cache.restore(cached, obj)
+
+                self.ctx.db.add_external_dependencies_to_call(srcs=deps)
+                return obj
+
         # Generate the dependencies while we compile the file.
         with tempfile() as dep:
             obj = self.uncached_compile(src, dst,
@@ -459,6 +500,11 @@ class Builder(fbuild.builders.c.Builder):
         if s is not None:
             deps = s.decode().split()
             self.ctx.db.add_external_dependencies_to_call(srcs=deps)
+        else:
+            deps = []
+
+        if key is not None:
+            cache.add(key, obj, deps)
 
         return obj
 
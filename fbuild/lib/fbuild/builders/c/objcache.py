@@ -0,0 +1,176 @@
+"""A local cache of compiled objects that can be shared between buildroots and
+checkouts, much like ccache. An object is found by hashing the compiler's
+identity, the compile arguments and the source, which leads to a manifest of
+the dependencies that the source was compiled with before. If all of the
+dependencies of one of those compiles still have the same contents, its object
+can be reused without running the compiler."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import fbuild.db.backend
+from fbuild.path import Path
+
+# ------------------------------------------------------------------------------
+
+class ObjectCache:
+    """The objects cached in a directory."""
+
+    # How many different sets of dependencies we remember for each source.
+    max_manifest_entries = 16
+
+    def __init__(self, ctx, dirname):
+        self.ctx = ctx
+        self.dirname = Path(dirname)
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.identities = {}
+
+    def key(self, builder, src, kwargs):
+        """Returns the key of compiling the source with the builder and the
+        keyword arguments, or None if the compile can't be cached."""
+
+        # Identifying the compiler runs it, so only do it once per builder.
+        with self.lock:
+            entry = self.identities.get(id(builder))
+
+        if entry is None:
+            # Keep the builder alive so that its id can't be reused.
+            entry = (builder, builder.identity())
+            with self.lock:
+                self.identities[id(builder)] = entry
+
+        identity = entry[1]
+        if identity is None:
+            return None
+
+        # The buildroot only changes where the object goes.
+        kwargs = {k: v for k, v in kwargs.items() if k != 'buildroot'}
+        options = fbuild.db.backend.digest_bound(self.ctx, {
+            'builder': builder,
+            'src': str(src),
+            'kwargs': kwargs})
+        if options is None:
+            return None
+
+        return _digest([repr(identity), options, self.digest_file(src)])
+
+    def find(self, key):
+        """Returns the cached object and the dependencies it was compiled with
+        if they haven't changed, or None."""
+
+        for obj_key, deps in self.load_manifest(key):
+            if all(self.check_file(dep, digest) for dep, digest in deps):
+                obj = self.path(obj_key)
+                if obj.exists():
+                    return obj, [dep for dep, digest in deps]
+
+        return None
+
+    def add(self, key, obj, deps):
+        """Save the object that was compiled with the dependencies."""
+
+        deps = [(dep, self.digest_file(dep)) for dep in deps]
+        obj_key = _digest([key] + [digest for dep, digest in deps])
+
+        def copy(f):
+            with open(obj, 'rb') as src:
+                shutil.copyfileobj(src, f)
+
+        if not self.path(obj_key).exists():
+            self.write(self.path(obj_key), copy)
+
+        # Put the newest entry first, since it's the most likely to match.
+        manifest = [[obj_key, deps]]
+        manifest.extend(entry for entry in self.load_manifest(key)
+            if entry[0] != obj_key)
+        del manifest[self.max_manifest_entries:]
+
+        self.write(self.path(key, '.manifest'), lambda f: f.write(
+            json.dumps(manifest).encode()))
+
+    def restore(self, cached, obj):
+        """Copy the cached object to where the compiler would have put it."""
+
+        obj.parent.makedirs()
+        shutil.copyfile(cached, obj)
+
+    # --------------------------------------------------------------------------
+
+    def path(self, key, suffix=''):
+        return self.dirname / key[:2] / key + suffix
+
+    def load_manifest(self, key):
+        try:
+            with open(self.path(key, '.manifest'), 'rb') as f:
+                return json.loads(f.read().decode())
+        except (OSError, ValueError):
+            return []
+
+    def write(self, path, write):
+        """Write the file atomically, so other builds sharing the cache never
+        see it half written."""
+
+        path.parent.makedirs()
+        fd, tmp = tempfile.mkstemp(dir=path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def digest_file(self, path):
+        """Returns the digest of the contents of the file, which is only
+        computed again if the file changed."""
+
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        with self.lock:
+            try:
+                old_stamp, digest = self.digests[path]
+            except KeyError:
+                pass
+            else:
+                if old_stamp == stamp:
+                    return digest
+
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+
+        with self.lock:
+            self.digests[path] = (stamp, digest)
+
+        return digest
+
+    def check_file(self, path, digest):
+        try:
+            return self.digest_file(path) == digest
+        except OSError:
+            return False
+
+def _digest(parts):
+    return hashlib.md5('\0'.join(parts).encode()).hexdigest()
+
+# ------------------------------------------------------------------------------
+
+_cache_lock = threading.Lock()
+
+def find_object_cache(ctx):
+    """Returns the L{ObjectCache} of the context, which is kept in the context
+    for the rest of the build, or None if we're not using one."""
+
+    if not ctx.options.object_cache:
+        return None
+
+    with _cache_lock:
+        if ctx.object_cache is None:
+            ctx.object_cache = ObjectCache(ctx, ctx.options.object_cache)
+
+        return ctx.object_cache
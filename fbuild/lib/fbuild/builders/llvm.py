@@ -1,6 +1,7 @@
 from itertools import chain
 
 import fbuild.builders
+import fbuild.builders.platform
 import fbuild.db
 import fbuild.path
 
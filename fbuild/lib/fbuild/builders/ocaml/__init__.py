@@ -14,6 +14,7 @@ import fbuild
 import fbuild.builders
 import fbuild.builders.platform
 import fbuild.db
+import fbuild.sched
 import fbuild.temp
 from fbuild.path import Path
 
@@ -69,79 +70,13 @@ class Ocamldep(fbuild.db.PersistentObject):
             includes=(),
             **kwargs) -> fbuild.db.DSTS:
         """Compute the source files this ocaml file depends on."""
-        deps = []
-
-        def f(module, include):
-            # On case-insensitive but case-preserving filesystems, we need to
-            # be careful on how we deal with finding OCaml dependencies. Since
-            # OCaml can store a module named List in either list.ml or List.ml,
-            # we can't just test if the filename exists since fbuild needs to
-            # deal with the exact filenames.  To do that, we'll grab the list
-            # of filenames in the directory, then search for the right
-            # spelling in that list.
-
-            # Grab the filenames in the directory.
-            if include is None:
-                dirs = Path.getcwd().listdir()
-            else:
-                include = Path(include)
-
-                if not include.exists():
-                    # We can't search for dependencies in a directory that
-                    # doesn't exist, so exit early.
-                    return False
-
-                dirs = include.listdir()
-
-            found = False
-            for suffix in '.mli', '.ml':
-                # Look for the traditional lowercase form.
-                path = module[0].lower() + module[1:] + suffix
-                if path not in dirs:
-                    # That didn't work, so lets try the uppercase form.
-                    path = module[0].upper() + module[1:] + suffix
-                    if path not in dirs:
-                        # Couldn't find it, so just skip this module.
-                        continue
-
-                # We found it! Add that file to the dependencies.
-                if include is None:
-                    deps.append(Path(path))
-                else:
-                    deps.append(include / path)
-                found = True
-
-            return found
-
         modules = self.modules(src, **kwargs)
-        for module in modules:
-            if not f(module, None):
-                for include in includes:
-                    f(module, include)
-
-        if src.endswith('.ml'):
-            # The .mli file might not live right next to the .ml file, so
-            # search the include path for it.
-            mli = Path(src).replaceext('.mli')
-            if mli.exists():
-                deps.append(mli)
-            else:
-                # If we generated the .ml file, then perhaps there's a
-                # pre-defined .mli file not in the buildroot.
-                buildroot = kwargs.get('buildroot') or self.ctx.buildroot
-                mli = mli.removeroot(buildroot + os.sep)
-
-                if mli.exists():
-                    deps.append(mli)
-                else:
-                    for include in includes:
-                        path = mli.name
-                        if include is not None: path = include / path
-                        if path.exists():
-                            deps.append(path)
-                        break
 
-        return deps
+        # Searching the directories is all python, so the scheduler can run it
+        # in another process.
+        return self.ctx.scheduler.submit(_find_module_sources, src, modules,
+            includes=includes,
+            buildroot=kwargs.get('buildroot') or self.ctx.buildroot).result()
 
     def __str__(self):
         return self.exe.name
@@ -155,6 +90,84 @@ class Ocamldep(fbuild.db.PersistentObject):
 
 # ------------------------------------------------------------------------------
 
+@fbuild.sched.process_safe
+def _find_module_sources(src, modules, *, includes, buildroot):
+    """Returns the source files of the I{modules} that the ocaml file I{src}
+    depends on."""
+    deps = []
+
+    def f(module, include):
+        # On case-insensitive but case-preserving filesystems, we need to
+        # be careful on how we deal with finding OCaml dependencies. Since
+        # OCaml can store a module named List in either list.ml or List.ml,
+        # we can't just test if the filename exists since fbuild needs to
+        # deal with the exact filenames.  To do that, we'll grab the list
+        # of filenames in the directory, then search for the right
+        # spelling in that list.
+
+        # Grab the filenames in the directory.
+        if include is None:
+            dirs = Path.getcwd().listdir()
+        else:
+            include = Path(include)
+
+            if not include.exists():
+                # We can't search for dependencies in a directory that
+                # doesn't exist, so exit early.
+                return False
+
+            dirs = include.listdir()
+
+        found = False
+        for suffix in '.mli', '.ml':
+            # Look for the traditional lowercase form.
+            path = module[0].lower() + module[1:] + suffix
+            if path not in dirs:
+                # That didn't work, so lets try the uppercase form.
+                path = module[0].upper() + module[1:] + suffix
+                if path not in dirs:
+                    # Couldn't find it, so just skip this module.
+                    continue
+
+            # We found it! Add that file to the dependencies.
+            if include is None:
+                deps.append(Path(path))
+            else:
+                deps.append(include / path)
+            found = True
+
+        return found
+
+    for module in modules:
+        if not f(module, None):
+            for include in includes:
+                f(module, include)
+
+    if src.endswith('.ml'):
+        # The .mli file might not live right next to the .ml file, so
+        # search the include path for it.
+        mli = Path(src).replaceext('.mli')
+        if mli.exists():
+            deps.append(mli)
+        else:
+            # If we generated the .ml file, then perhaps there's a
+            # pre-defined .mli file not in the buildroot.
+            mli = mli.removeroot(buildroot + os.sep)
+
+            if mli.exists():
+                deps.append(mli)
+            else:
+                for include in includes:
+                    path = mli.name
+                    if include is not None: path = include / path
+                    if path.exists():
+                        deps.append(path)
+                    break
+
+    return deps
+
+# ------------------------------------------------------------------------------
+
 class Builder(fbuild.builders.AbstractCompilerBuilder):
     def __init__(self, ctx, exe, *,
             platform=None,
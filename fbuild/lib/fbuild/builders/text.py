@@ -3,6 +3,7 @@ import re
 
 import fbuild
 import fbuild.db
+import fbuild.sched
 
 # ------------------------------------------------------------------------------
 
@@ -12,13 +13,10 @@ def substitute(ctx, dst, src:fbuild.db.SRC, patterns, *, buildroot=None) \
     """L{substitute} replaces the I{patterns} in the file named I{src}
     and saves the changes into file named I{dst}."""
 
-    buildroot = buildroot or ctx.buildroot
-    src = fbuild.path.Path(src)
-    dst = fbuild.path.Path.addroot(dst, buildroot)
-    dst.parent.makedirs()
-
-    ctx.logger.log(' * creating ' + dst, color='yellow')
+    return _rewrite(ctx, _substitute, dst, src, patterns, buildroot)
 
+@fbuild.sched.process_safe
+def _substitute(dst, src, patterns):
     with open(src, 'r') as src_file:
         code = src_file.read()
         for pattern, text in patterns.items():
@@ -27,8 +25,6 @@ def substitute(ctx, dst, src:fbuild.db.SRC, patterns, *, buildroot=None) \
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
 # ------------------------------------------------------------------------------
 
 @fbuild.db.caches
@@ -37,13 +33,10 @@ def regex_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
     """L{substitute} replaces the I{patterns} in the file named I{src}
     and saves the changes into file named I{dst}."""
 
-    buildroot = buildroot or ctx.buildroot
-    src = fbuild.path.Path(src)
-    dst = fbuild.path.Path.addroot(dst, buildroot)
-    dst.parent.makedirs()
-
-    ctx.logger.log(' * creating ' + dst, color='yellow')
+    return _rewrite(ctx, _regex_substitute, dst, src, patterns, buildroot)
 
+@fbuild.sched.process_safe
+def _regex_substitute(dst, src, patterns):
     with open(src, 'r') as src_file:
         code = src_file.read()
         for items in patterns:
@@ -58,8 +51,6 @@ def regex_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
 # ------------------------------------------------------------------------------
 
 @fbuild.db.caches
@@ -69,21 +60,16 @@ def format_substitute(ctx, dst, src:fbuild.db.SRC, patterns, *,
     and saves the changes into file named I{dst}. It uses python's format
     patterns for finding the insertion points."""
 
-    buildroot = buildroot or ctx.buildroot
-    src = fbuild.path.Path(src)
-    dst = fbuild.path.Path.addroot(dst, buildroot)
-    dst.parent.makedirs()
-
-    ctx.logger.log(' * creating ' + dst, color='yellow')
+    return _rewrite(ctx, _format_substitute, dst, src, patterns, buildroot)
 
+@fbuild.sched.process_safe
+def _format_substitute(dst, src, patterns):
     with open(src, 'r') as src_file:
         code = src_file.read().format(**patterns)
 
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
 # ------------------------------------------------------------------------------
 
 @fbuild.db.caches
@@ -93,13 +79,11 @@ def autoconf_config_file(ctx, dst, src:fbuild.db.SRC, patterns, *,
     I{src} and saves the changes into file named I{dst}. It uses autoconf
     AC_CONFIG_FILES @word@ patterns to find the insertion points."""
 
-    buildroot = buildroot or ctx.buildroot
-    src = fbuild.path.Path(src)
-    dst = fbuild.path.Path(dst).addroot(buildroot)
-    dst.parent.makedirs()
-
-    ctx.logger.log(' * creating ' + dst, color='yellow')
+    return _rewrite(ctx, _autoconf_config_file, dst, src, patterns,
+        buildroot)
 
+@fbuild.sched.process_safe
+def _autoconf_config_file(dst, src, patterns):
     def replace(match):
         value = patterns[match.group(1)]
         if isinstance(value, str):
@@ -116,8 +100,6 @@ def autoconf_config_file(ctx, dst, src:fbuild.db.SRC, patterns, *,
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
-    return dst
-
 # ------------------------------------------------------------------------------
 
 @fbuild.db.caches
@@ -128,13 +110,11 @@ def autoconf_config_header(ctx, dst, src:fbuild.db.SRC, patterns, *,
     AC_CONFIG_HEADERS @word@ and #define patterns to find the insertion
     points."""
 
-    buildroot = buildroot or ctx.buildroot
-    src = fbuild.path.Path(src)
-    dst = fbuild.path.Path.addroot(dst, buildroot)
-    dst.parent.makedirs()
-
-    ctx.logger.log(' * creating ' + dst, color='yellow')
+    return _rewrite(ctx, _autoconf_config_header, dst, src, patterns,
+        buildroot)
 
+@fbuild.sched.process_safe
+def _autoconf_config_header(dst, src, patterns):
     missing_definitions = []
 
     def replace(match):
@@ -182,4 +162,20 @@ def autoconf_config_header(ctx, dst, src:fbuild.db.SRC, patterns, *,
     with open(dst, 'w') as dst_file:
         dst_file.write(code)
 
+# ------------------------------------------------------------------------------
+
+def _rewrite(ctx, function, dst, src, patterns, buildroot):
+    """Write the I{dst} from the I{src} with the I{function}. The function
+    is run by the scheduler, so that the process executor can run it in
+    another process."""
+
+    buildroot = buildroot or ctx.buildroot
+    src = fbuild.path.Path(src)
+    dst = fbuild.path.Path.addroot(dst, buildroot)
+    dst.parent.makedirs()
+
+    ctx.logger.log(' * creating ' + dst, color='yellow')
+
+    ctx.scheduler.submit(function, dst, src, patterns).result()
+
     return dst
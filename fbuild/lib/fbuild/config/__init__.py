@@ -1,7 +1,14 @@
 """The config system is a simple mechanism in order to model testing similar
 tests."""
 
+import functools
+import threading
+import types
+
+import fbuild
 import fbuild.db
+import fbuild.db.backend
+import fbuild.functools
 
 # ------------------------------------------------------------------------------
 
@@ -29,8 +36,13 @@ class TestMeta(fbuild.db.PersistentMeta):
         if not parents:
             return super().__new__(cls, name, bases, attrs)
 
-        module = attrs.pop('__module__')
-        new_class = super().__new__(cls, name, bases, {'__module__': module})
+        namespace = {'__module__': attrs.pop('__module__')}
+
+        # Methods that use super() need the class cell.
+        if '__classcell__' in attrs:
+            namespace['__classcell__'] = attrs.pop('__classcell__')
+
+        new_class = super().__new__(cls, name, bases, namespace)
         new_class.__field_names__ = []
 
         for parent in parents:
@@ -60,6 +72,21 @@ class Test(metaclass=TestMeta):
     def __init__(self, ctx):
         self.ctx = ctx
 
+    def prefetch(self):
+        """Evaluate all of the fields of the test concurrently in the
+        scheduler. Each field is still cached on its own, so later accesses
+        just find them in the cache. Returns the test."""
+
+        self.ctx.scheduler.map(functools.partial(getattr, self),
+            [name for name, field in self.fields()])
+
+        return self
+
+    def identity(self):
+        """Returns what identifies the results of the test, so that they can
+        be reused by another build, or None if they can't be reused."""
+        return None
+
     @classmethod
     def fields(cls):
         for field_name in cls.__field_names__:
@@ -77,3 +104,141 @@ class Test(metaclass=TestMeta):
                 return default
 
         return obj
+
+# ------------------------------------------------------------------------------
+
+def call(test, *args, parallel=False, **kwargs):
+    """Create the test with the arguments. The test may be the name of the
+    test class to import. If I{parallel} is true, all of the fields of the
+    test are evaluated concurrently with L{Test.prefetch}."""
+
+    test = fbuild.functools.call(test, *args, **kwargs)
+
+    if parallel:
+        test.prefetch()
+
+    return test
+
+# ------------------------------------------------------------------------------
+
+class Results:
+    """The results of the fields of the tests, keyed by what identifies each
+    test, so that they can be saved to a file with --save-config and loaded
+    into another build with --load-config. Loading a test's results saves
+    them in the database, so that the test doesn't need to run them."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.lock = threading.Lock()
+        self.loaded = {}
+        self.found = {}
+        self.identities = {}
+
+    def identify(self, test):
+        """Returns the identity of the test, computing it only once."""
+
+        with self.lock:
+            try:
+                return self.identities[id(test)][1]
+            except KeyError:
+                pass
+
+        identity = test.identity()
+
+        # Keep the test alive so that its id can't be reused.
+        with self.lock:
+            self.identities[id(test)] = (test, identity)
+
+        return identity
+
+    def load(self, filename):
+        """Load the results from the file. Files that aren't saved results,
+        or that were saved by another version of fbuild, are ignored."""
+
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            raise fbuild.Error('cannot load %s: %s' % (filename, e))
+
+        try:
+            version, results = fbuild.db.backend.pickle_loads(self.ctx, data)
+        except Exception:
+            # Unpickling something else can raise just about anything.
+            version = results = None
+
+        if not isinstance(results, dict):
+            self.ctx.logger.log(
+                'ignoring %s since it is not a saved configuration' %
+                    filename,
+                color='yellow')
+            return
+
+        if version != fbuild.__version__:
+            self.ctx.logger.log(
+                'ignoring %s since it was saved by fbuild %s' %
+                    (filename, version),
+                color='yellow')
+            return
+
+        self.loaded.update(results)
+
+    def save(self, filename):
+        """Save the loaded results and the ones we found during this build to
+        the file."""
+
+        results = dict(self.loaded)
+        for test, values in list(self.found.values()):
+            identity = self.identify(test)
+            if identity is not None:
+                results[identity] = dict(results.get(identity, {}), **values)
+
+        with open(filename, 'wb') as f:
+            f.write(fbuild.db.backend.pickle_dumps(self.ctx,
+                (fbuild.__version__, results)))
+
+    def seed(self, test):
+        """Save the loaded results of the test in the database."""
+
+        if not self.loaded:
+            return
+
+        identity = self.identify(test)
+        try:
+            values = self.loaded[identity]
+        except KeyError:
+            return
+
+        for name, field in test.fields():
+            if isinstance(field, fbuild.db.cacheproperty) and name in values:
+                self.ctx.db.seed(types.MethodType(field.method, test),
+                    values[name])
+
+    def add(self, test, name, value):
+        """Remember the result of the test's field so that it can be
+        saved."""
+
+        with self.lock:
+            try:
+                test, values = self.found[id(test)]
+            except KeyError:
+                values = {}
+                self.found[id(test)] = (test, values)
+
+            values[name] = value
+
+_results_lock = threading.Lock()
+
+def find_results(ctx):
+    """Returns the L{Results} of the context, which are kept in the context
+    for the rest of the build, or None if we're not saving or loading the
+    results."""
+
+    if not (ctx.options.save_config or ctx.options.load_config):
+        return None
+
+    with _results_lock:
+        if ctx.config_results is None:
+            ctx.config_results = Results(ctx)
+
+        return ctx.config_results
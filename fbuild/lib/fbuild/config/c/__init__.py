@@ -1,8 +1,13 @@
+import atexit
+import tempfile
 import textwrap
+import threading
 
-import fbuild.builders.platform
 import fbuild.config
 import fbuild.db
+import fbuild.db.backend
+import fbuild.subprocess
+from fbuild.path import Path
 
 # ------------------------------------------------------------------------------
 
@@ -25,7 +30,7 @@ class Function:
         return \
             type(self) is type(other) and \
             self.return_type == other.return_type and \
-            self.args == other.size
+            self.args == other.args
 
     def __hash__(self):
         return hash((self.__class__, self.return_type, self.args))
@@ -135,6 +140,17 @@ class cacheproperty(fbuild.db.cacheproperty):
         cls.__field_names__.append(key)
         setattr(cls, key, self)
 
+    def __get__(self, instance, owner):
+        result = super().__get__(instance, owner)
+
+        if instance is not None:
+            # Remember the result if we're going to save the results.
+            results = fbuild.config.find_results(instance.ctx)
+            if results is not None:
+                results.add(instance, self.__name__, result)
+
+        return result
+
 # ------------------------------------------------------------------------------
 
 class AbstractFieldDescriptor:
@@ -172,7 +188,6 @@ class AbstractFieldDescriptor:
                 return None
         else:
             header = None
-        formatted_test = self.test if self.test else self.format_test(header)
 
         if isinstance(self, header_test):
             msg = 'checking header %r' % self.filename
@@ -184,27 +199,73 @@ class AbstractFieldDescriptor:
 
         instance.ctx.logger.check(msg)
 
+        # If the test only needs the values of some constant expressions, we
+        # can find them without running anything, which also works when
+        # we're cross compiling.
+        if self.test is None and self.format_values(header) is not None:
+            try:
+                if instance.ctx.options.batch_probes:
+                    values = _find_batch(instance, header).measure(self)
+                else:
+                    batch = _ProbeBatch(instance, header, [self])
+                    try:
+                        values = batch.measure(self)
+                    finally:
+                        batch.close()
+            except (fbuild.ExecutionError, fbuild.ConfigFailed):
+                instance.ctx.logger.failed()
+            else:
+                return self.process_values(instance, values)
+
+            return None
+
         # run the test
         try:
-            stdout, stderr = instance.builder.tempfile_run(formatted_test,
-                input=self.stdin,
-                timeout=self.timeout,
-                lkwargs={
-                    'flags': instance.flags,
-                    'libpaths': instance.libpaths,
-                    'libs': instance.libs,
-                    'external_libs': instance.external_libs})
+            if self.test is None and instance.ctx.options.batch_probes and \
+                    self.format_probe(header) is not None:
+                stdout, stderr = _find_batch(instance, header).run(self)
+            else:
+                stdout, stderr = instance.builder.tempfile_run(
+                    self.test if self.test else self.format_test(header),
+                    input=self.stdin,
+                    timeout=self.timeout,
+                    lkwargs=instance.link_kwargs())
         except fbuild.ExecutionError:
             instance.ctx.logger.failed()
         else:
             return self.process_stdout(instance, stdout)
 
-    def format_test(self, instance):
-        raise NotImplementedError
+    def format_values(self, header=None, prefix='fbuild'):
+        """Returns the declarations the test needs, the definitions it needs
+        that are named with the prefix, and the constant integer expressions
+        whose values are the result of the test. Returns None if the test
+        needs to be run."""
+        return None
+
+    def format_probe(self, header=None):
+        """Returns the declarations the test needs and the body of its main
+        function, so that it can be compiled in one program together with the
+        other tests that need the same declarations. Returns None if the test
+        can't be batched."""
+        return None
+
+    def format_test(self, header=None):
+        probe = self.format_probe(header)
+        if probe is None:
+            raise NotImplementedError
+
+        declarations, body = probe
+
+        return '%s\nint main() {\n%s\n}\n' % (
+            declarations,
+            textwrap.indent(body, '    '))
 
     def process_stdout(self, instance, stdout):
         raise NotImplementedError
 
+    def process_values(self, instance, values):
+        raise NotImplementedError
+
     def __eq__(self, other):
         return \
             self.__class__ is other.__class__ and \
@@ -229,6 +290,351 @@ class AbstractFieldDescriptor:
 
 # ------------------------------------------------------------------------------
 
+def _format_include(header, *headers):
+    """Returns the include lines for the headers followed by the test's
+    header, if it has one."""
+
+    if header is not None:
+        headers += (header,)
+
+    return '\n'.join('#include <%s>' % h for h in headers)
+
+# ------------------------------------------------------------------------------
+
+class _ProbeBatch:
+    """The batchable tests of a L{Test}. The first time one of them runs, all
+    of the tests that need the same declarations are compiled into one
+    program, whose main function runs the test selected by its argument. The
+    tests that only need the values of constant expressions are compiled
+    into one object, whose data holds all of their values. If a program or
+    object fails to compile or link, we bisect the tests until we find the
+    ones that failed, so a test costs a compiler invocation only when it
+    fails. Each group of tests is compiled under its own lock, so the
+    groups can be compiled concurrently."""
+
+    def __init__(self, instance, header, descriptors=None):
+        if descriptors is None:
+            descriptors = [getattr(field, 'method', None)
+                for name, field in instance.fields()]
+
+        self.instance = instance
+        self.header = header
+        self.descriptors = [d for d in descriptors
+            if isinstance(d, AbstractFieldDescriptor) and
+                not isinstance(d, header_test) and
+                d.test is None]
+        self.lock = threading.Lock()
+        self.exes = None
+        self.values = None
+        self.dirname = None
+        self.count = 0
+
+    def run(self, descriptor):
+        """Run the test's program and return its stdout and stderr. Raises
+        L{fbuild.ExecutionError} if the test didn't compile or the program
+        failed."""
+
+        with self.lock:
+            if self.exes is None:
+                self.exes = self.group(lambda index, descriptor:
+                    descriptor.format_probe(self.header))
+
+        # Raise the error if the test didn't compile.
+        result = self.build(self.link, self.exes[descriptor], descriptor)
+        if isinstance(result, fbuild.ExecutionError):
+            raise result
+
+        exe, index = result
+
+        # The tests call functions with uninitialized arguments, so make sure
+        # they can't block on reading our stdin.
+        return self.instance.builder.run([exe, str(index)],
+            input=descriptor.stdin,
+            stdin=fbuild.subprocess.DEVNULL,
+            timeout=descriptor.timeout,
+            quieter=1)
+
+    def measure(self, descriptor):
+        """Return the values of the test's expressions. Raises
+        L{fbuild.ExecutionError} if the test didn't compile, or
+        L{fbuild.ConfigFailed} if we couldn't find its values."""
+
+        with self.lock:
+            if self.values is None:
+                self.values = self.group(lambda index, descriptor:
+                    descriptor.format_values(self.header,
+                        'fbuild_value_%d' % index))
+
+        # Raise the error if the test didn't compile or we couldn't find its
+        # values.
+        result = self.build(self.compute, self.values[descriptor], descriptor)
+        if isinstance(result, (fbuild.ExecutionError, fbuild.ConfigFailed)):
+            raise result
+
+        return result
+
+    def group(self, format):
+        """Format the tests and return a dictionary of each test to the
+        L{_ProbeGroup} of the tests that need the same declarations."""
+
+        groups = {}
+        for index, descriptor in enumerate(self.descriptors):
+            probe = format(index, descriptor)
+            if probe is not None:
+                declarations, *probe = probe
+                try:
+                    group = groups[declarations]
+                except KeyError:
+                    group = groups[declarations] = _ProbeGroup(declarations)
+                group.probes.append((descriptor,) + tuple(probe))
+
+        return {probe[0]: group
+            for group in groups.values()
+            for probe in group.probes}
+
+    def build(self, compile, group, descriptor):
+        """Compile the group of tests if it hasn't been compiled yet, and
+        return the result of the test, or the error if it didn't compile."""
+
+        with group.lock:
+            if group.results is None:
+                results = {}
+                self.bisect(compile, group.declarations, group.probes, results)
+                group.results = results
+
+        return group.results[descriptor]
+
+    def bisect(self, compile, declarations, probes, results):
+        try:
+            found = compile(declarations, probes)
+        except fbuild.ExecutionError as e:
+            if len(probes) == 1:
+                results[probes[0][0]] = e
+            else:
+                half = len(probes) // 2
+                self.bisect(compile, declarations, probes[:half], results)
+                self.bisect(compile, declarations, probes[half:], results)
+        else:
+            for probe, result in zip(probes, found):
+                results[probe[0]] = result
+
+    def link(self, declarations, probes):
+        builder = self.instance.builder
+
+        src = self.source(_format_batch(declarations,
+            [body for descriptor, body in probes]))
+
+        # Keep the objects and programs in our directory so that they can't
+        # collide with the other batches.
+        obj = builder.uncached_compile(src, quieter=1, buildroot=self.dirname)
+        exe = builder.uncached_link_exe(src.replaceext(''), [obj],
+            quieter=1,
+            buildroot=self.dirname,
+            **self.instance.link_kwargs())
+
+        return [(exe, index) for index in range(len(probes))]
+
+    def compute(self, declarations, probes):
+        src = self.source(_format_values(declarations, probes))
+        obj = self.instance.builder.uncached_compile(src,
+            quieter=1,
+            buildroot=self.dirname)
+
+        with open(obj, 'rb') as f:
+            values = _parse_values(f.read(),
+                sum(len(expressions) for d, defs, expressions in probes))
+
+        results = []
+        for descriptor, definitions, expressions in probes:
+            if values is None:
+                # We couldn't find the finished array in the object. That
+                # happens when it only contains the intermediate
+                # representation for link time optimization, which can hold
+                # the marker without the values after it. So we'll have to
+                # search for them with static asserts instead.
+                try:
+                    results.append([
+                        self.search(declarations, definitions, expression)
+                        for expression in expressions])
+                except fbuild.ConfigFailed as e:
+                    results.append(e)
+            else:
+                results.append(values[:len(expressions)])
+                del values[:len(expressions)]
+
+        return results
+
+    def search(self, declarations, definitions, expression):
+        """Binary search for the value of the expression, which costs a
+        compile for every bit of the value. Raises L{fbuild.ConfigFailed} if
+        we can't show the value is less than 2**32."""
+
+        def less(bound):
+            src = self.source(_format_assert(declarations, definitions,
+                '(%s) < %d' % (expression, bound)))
+            try:
+                self.instance.builder.uncached_compile(src,
+                    quieter=1,
+                    buildroot=self.dirname)
+            except fbuild.ExecutionError:
+                return False
+            return True
+
+        low, high = 0, 1
+        while not less(high):
+            if high >= 1 << 32:
+                raise fbuild.ConfigFailed(
+                    'failed to find the value of %s' % expression)
+            low, high = high, high * 2
+
+        while high - low > 1:
+            middle = (low + high) // 2
+            if less(middle):
+                high = middle
+            else:
+                low = middle
+
+        return low
+
+    def source(self, code):
+        """Write the code to a new source file in our directory."""
+
+        with self.lock:
+            if self.dirname is None:
+                self.dirname = Path(tempfile.mkdtemp())
+                atexit.register(self.dirname.rmtree, ignore_errors=True)
+
+            self.count += 1
+            src = self.dirname / ('probe%d' % self.count) + \
+                self.instance.builder.src_suffix
+
+        with open(src, 'w') as f:
+            print(code, file=f)
+
+        return src
+
+    def close(self):
+        """Delete our directory now instead of when we exit."""
+
+        if self.dirname is not None:
+            atexit.unregister(self.dirname.rmtree)
+            self.dirname.rmtree(ignore_errors=True)
+
+class _ProbeGroup:
+    """The tests of a L{_ProbeBatch} that need the same declarations."""
+
+    def __init__(self, declarations):
+        self.declarations = declarations
+        self.probes = []
+        self.lock = threading.Lock()
+        self.results = None
+
+def _format_batch(declarations, bodies):
+    """Returns a program that runs the probe whose index is given as the
+    first argument. We don't include anything to parse it since that could
+    change what the probes see."""
+
+    lines = [declarations]
+    for index, body in enumerate(bodies):
+        lines.append('static int fbuild_probe_%d(void) {' % index)
+        lines.append(textwrap.indent(body, '    '))
+        lines.append('}')
+
+    lines.append(textwrap.dedent('''
+        int main(int argc, char** argv) {
+            const char* s = argc > 1 ? argv[1] : "";
+            int probe = 0;
+            while (*s) probe = probe * 10 + *s++ - '0';
+            switch (probe) {'''))
+
+    for index in range(len(bodies)):
+        lines.append('    case %d: return fbuild_probe_%d();' % (index, index))
+
+    lines.append('    }\n    return 1;\n}')
+
+    return '\n'.join(lines)
+
+# The values are stored between these markers so we can find them in the
+# object.
+_VALUES_MARKER = b'\xfbfbuild-values\xfb'
+_VALUES_END_MARKER = b'\xfbfbuild-end\xfb'
+
+def _format_values(declarations, probes):
+    """Returns the code for an array that holds the marker, the number of
+    values, the values and then the end marker. Each value is stored big
+    endian in 4 bytes, so we can read it without knowing the byte order of
+    the target."""
+
+    lines = [declarations]
+    expressions = []
+    for descriptor, definitions, exprs in probes:
+        lines.append(definitions)
+        expressions.extend(exprs)
+
+    lines.append(textwrap.dedent('''
+        #define FBUILD_VALUE(v) \\
+            (unsigned char)((v) >> 24), (unsigned char)((v) >> 16), \\
+            (unsigned char)((v) >> 8), (unsigned char)(v)
+        unsigned char fbuild_values[] = {'''))
+    lines.append('    %s,' % ', '.join(str(b) for b in _VALUES_MARKER))
+    lines.append('    FBUILD_VALUE(%d),' % len(expressions))
+
+    for expression in expressions:
+        lines.append('    FBUILD_VALUE(%s),' % expression)
+
+    lines.append('    %s,' % ', '.join(str(b) for b in _VALUES_END_MARKER))
+    lines.append('};')
+
+    return '\n'.join(lines)
+
+def _parse_values(data, count):
+    """Returns the values from the data of an object, or None if we couldn't
+    find them. Objects for link time optimization can hold the start of the
+    array as it was written without the values, so we only trust an array
+    that has the right count and ends with the end marker."""
+
+    start = data.find(_VALUES_MARKER)
+    while start != -1:
+        values_start = start + len(_VALUES_MARKER)
+        values_end = values_start + 4 * (count + 1)
+
+        if data[values_end:values_end + len(_VALUES_END_MARKER)] == \
+                _VALUES_END_MARKER:
+            values = [int.from_bytes(data[i:i + 4], 'big')
+                for i in range(values_start, values_end, 4)]
+            if values[0] == count:
+                return values[1:]
+
+        start = data.find(_VALUES_MARKER, start + 1)
+
+    return None
+
+def _format_assert(declarations, definitions, condition):
+    """Returns code that only compiles if the condition is true."""
+
+    return '%s\n%s\ntypedef char fbuild_assert[(%s) ? 1 : -1];' % (
+        declarations,
+        definitions,
+        condition)
+
+_batches_lock = threading.Lock()
+
+def _find_batch(instance, header):
+    """Returns the L{_ProbeBatch} of the test instance, which is kept in the
+    context for the rest of the build."""
+
+    batches = instance.ctx.probe_batches
+
+    with _batches_lock:
+        try:
+            batch = batches[instance]
+        except KeyError:
+            batch = batches[instance] = _ProbeBatch(instance, header)
+
+    return batch
+
+# ------------------------------------------------------------------------------
+
 class header_test(AbstractFieldDescriptor):
     """L{header_test} is a descriptor that tests for the header on the first
     access. If it exists, the header filename is memoized in the object and
@@ -296,12 +702,7 @@ class function_test(AbstractFieldDescriptor):
             ', '.join(str(a) for a in args),
         )
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
-
+    def format_probe(self, header=None):
         args = []
         defs = []
 
@@ -325,14 +726,9 @@ class function_test(AbstractFieldDescriptor):
         if self.return_type != 'void':
             call = '%s res = %s' % (self.return_type, call)
 
-        return textwrap.dedent('''
-            %s
-            int main() {
-                %s
-                %s;
-                return 0;
-            }
-        ''') % (header, '\n    '.join(defs), call)
+        return _format_include(header), '\n'.join(defs + [
+            call + ';',
+            'return 0;'])
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -363,21 +759,12 @@ class macro_test(AbstractFieldDescriptor):
     access. If it exists, an instance of L{Macro} is memoized in the object and
     returned. Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
-
-        return textwrap.dedent('''
-            %s
+    def format_probe(self, header=None):
+        return _format_include(header), textwrap.dedent('''\
             #ifndef %s
             #error %s is not defined
             #endif
-            int main() {
-                return 0;
-            }
-        ''') % (header, self.name, self.name)
+            return 0;''') % (self.name, self.name)
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -393,25 +780,21 @@ class type_test(AbstractFieldDescriptor):
     access. If it exists, an instance of L{Type} is memoized in the object and
     returned. Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        return textwrap.dedent('''
-            #include <stddef.h>
-            #include <stdio.h>
-            %s
-
-            typedef %s type;
-            struct TEST { char c; type mem; };
-            int main() {
-                printf("%%d\\n", (int)offsetof(struct TEST, mem));
-                printf("%%d\\n", (int)sizeof(type));
-                return 0;
-            }
-        ''') % ('' if header is None else '#include <%s>' % header, self.name)
+    def format_values(self, header=None, prefix='fbuild'):
+        return _format_include(header, 'stddef.h'), \
+            textwrap.dedent('''\
+                typedef %s %s_type;
+                struct %s_align { char c; %s_type mem; };''') % (
+                    self.name, prefix, prefix, prefix), [
+            'offsetof(struct %s_align, mem)' % prefix,
+            'sizeof(%s_type)' % prefix]
 
     def process_stdout(self, instance, stdout):
-        stdout = stdout.split()
-        alignment = int(stdout[0])
-        size = int(stdout[1])
+        return self.process_values(instance,
+            [int(value) for value in stdout.split()[:2]])
+
+    def process_values(self, instance, values):
+        alignment, size = values
 
         instance.ctx.logger.passed('alignment: %s size: %s' % (alignment, size))
 
@@ -422,27 +805,20 @@ class int_type_test(AbstractFieldDescriptor):
     first access.  If it exists, an instance of L{IntType} is memoized in the
     object and returned.  Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        return textwrap.dedent('''
-            #include <stddef.h>
-            #include <stdio.h>
-            %s
+    def format_values(self, header=None, prefix='fbuild'):
+        declarations, definitions, expressions = \
+            type_test.format_values(self, header, prefix)
 
-            typedef %s type;
-            struct TEST { char c; type mem; };
-            int main() {
-                printf("%%d\\n", (int)offsetof(struct TEST, mem));
-                printf("%%d\\n", (int)sizeof(type));
-                printf("%%d\\n", (type)~3 < (type)0);
-                return 0;
-            }
-        ''') % ('' if header is None else '#include <%s>' % header, self.name)
+        return declarations, definitions, expressions + [
+            '(%s_type)~3 < (%s_type)0' % (prefix, prefix)]
 
     def process_stdout(self, instance, stdout):
-        stdout = stdout.split()
-        alignment = int(stdout[0])
-        size = int(stdout[1])
-        signed = int(stdout[2]) == 1
+        return self.process_values(instance,
+            [int(value) for value in stdout.split()[:3]])
+
+    def process_values(self, instance, values):
+        alignment, size, signed = values
+        signed = signed == 1
 
         instance.ctx.logger.passed('alignment: %s size: %s signed: %s' %
             (alignment, size, signed))
@@ -466,24 +842,12 @@ class struct_test(AbstractFieldDescriptor):
             self.name = 'struct ' + key
         cacheproperty(self).contribute_to_class(cls, key)
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
-
-        defs = []
+    def format_probe(self, header=None):
+        defs = ['%s arg;' % self.name]
         for i, (type, member) in enumerate(self.members):
             defs.append('%s arg_%d = arg.%s;' % (type, i, member))
 
-        return textwrap.dedent('''
-            %s
-            int main() {
-                %s arg;
-                %s
-                return 0;
-            }
-        ''') % (header, self.name, '\n    '.join(defs))
+        return _format_include(header), '\n'.join(defs + ['return 0;'])
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -510,19 +874,8 @@ class variable_test(AbstractFieldDescriptor):
     first access.  If it exists, an instance of L{Variable} is memoized in the
     object and returned.  Otherwise, memoize and return None."""
 
-    def format_test(self, header=None):
-        if header is None:
-            header = ''
-        else:
-            header = '#include <%s>' % header
-
-        return textwrap.dedent('''
-            %s
-            int main() {
-                %s;
-                return 0;
-            }
-        ''') % (header, self.name)
+    def format_probe(self, header=None):
+        return _format_include(header), '%s;\nreturn 0;' % self.name
 
     def process_stdout(self, instance, stdout):
         if self.stdout is None or self.stdout == stdout:
@@ -538,6 +891,11 @@ class TestMeta(fbuild.config.TestMeta):
         result, srcs, objs = builder.ctx.db.call(cls.__call_super__, builder,
             *args, **kwargs)
 
+        # Use the results that were loaded for this test.
+        results = fbuild.config.find_results(builder.ctx)
+        if results is not None:
+            results.seed(result)
+
         return result
 
 
@@ -551,7 +909,8 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
         super().__init__(builder.ctx)
 
         if platform is None:
-            platform = fbuild.builders.platform.guess_platform(builder.ctx)
+            from fbuild.builders.platform import guess_platform
+            platform = guess_platform(builder.ctx)
 
         self.builder = builder
         self.platform = platform
@@ -560,6 +919,37 @@ class Test(fbuild.config.Test, metaclass=TestMeta):
         self.libs = list(libs)
         self.external_libs = list(external_libs)
 
+    def prefetch(self):
+        # Every other field needs the header, so check it first instead of
+        # having all of them check it at once. The batched fields that need
+        # the same declarations then wait for one compile of them, while the
+        # other groups are compiled and the programs are run concurrently.
+        getattr(self, 'header', None)
+
+        return super().prefetch()
+
+    def identity(self):
+        """The results of the test can be reused with a compiler that has the
+        same identity, if the test's arguments are the same too."""
+
+        compiler = self.builder.identity()
+        if compiler is None:
+            return None
+
+        return (
+            '%s.%s' % (type(self).__module__, type(self).__qualname__),
+            compiler,
+            fbuild.db.backend.digest_bound(self.ctx, self))
+
+    def link_kwargs(self):
+        """Returns the keyword arguments to link the test programs with."""
+
+        return {
+            'flags': self.flags,
+            'libpaths': self.libpaths,
+            'libs': self.libs,
+            'external_libs': self.external_libs}
+
     def functions(self):
         for name, field in self.fields():
             if isinstance(field, cacheproperty):
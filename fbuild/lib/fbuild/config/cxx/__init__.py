@@ -1,5 +1,3 @@
-import textwrap
-
 import fbuild
 import fbuild.config.c as c
 import fbuild.config.c.c90 as c90
@@ -46,16 +44,8 @@ class template_test(c.AbstractFieldDescriptor):
         super().__init__(**kwargs)
         self.test_types = test_types
 
-    def format_test(self, header=None):
-        return textwrap.dedent('''
-            %s
-
-            int main() {
-                %s<%s> t;
-                return 0;
-            }
-        ''') % (
-            '' if header is None else '#include <%s>' % header,
+    def format_probe(self, header=None):
+        return c._format_include(header), '%s<%s> t;\nreturn 0;' % (
             self.name,
             ', '.join(self.test_types))
 
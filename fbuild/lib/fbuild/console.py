@@ -2,13 +2,14 @@ import sys
 import threading
 import contextlib
 import collections
-import ctypes
 
 import fbuild
 
 # ------------------------------------------------------------------------------
 
 if sys.platform == 'win32':
+    import ctypes
+
     # Constants from the Windows API
     _STD_OUTPUT_HANDLE = -11
     _colorcodes = {
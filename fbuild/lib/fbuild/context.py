@@ -5,11 +5,11 @@ import threading
 import time
 
 import fbuild
-import fbuild.builders.platform
 import fbuild.console
 import fbuild.db.database
 import fbuild.sched
 import fbuild.subprocess.killableprocess
+import fbuild.trace
 
 from fbuild.path import Path
 
@@ -28,11 +28,22 @@ class Context:
             threadcount=options.threadcount,
             show_threads=options.show_threads)
 
+        # Only record the timeline of the build if we're going to save it.
+        if options.trace:
+            self.tracer = fbuild.trace.Tracer()
+        else:
+            self.tracer = fbuild.trace.NullTracer()
+
         self.db = fbuild.db.database.Database(self,
             engine=options.database_engine,
-            explain=options.explain_database)
+            explain=options.explain_database,
+            concurrent_reads=options.concurrent_reads)
         self.scheduler = fbuild.sched.Scheduler(options.threadcount,
-            logger=self.logger)
+            logger=self.logger,
+            executor=options.executor,
+            schedule=options.schedule,
+            estimate=self.db.find_durations,
+            tracer=self.tracer)
 
         self.options = options
         self.args = args
@@ -40,6 +51,15 @@ class Context:
         self.install_prefix = Path('/usr/local')
         self.to_install = {'bin': [], 'lib': [], 'share': [], 'include': []}
 
+        # The batches of probes of the config tests, keyed by the test.
+        self.probe_batches = {}
+
+        # The results of the config tests to save or load.
+        self.config_results = None
+
+        # The cache of compiled objects shared with other buildroots.
+        self.object_cache = None
+
     @property
     def buildroot(self):
         return self.options.buildroot
@@ -98,6 +118,16 @@ class Context:
                 except:
                     error_handler(None, file, sys.exc_info())
 
+    def gc_state(self):
+        """Delete the calls and files from the database that weren't used
+        during this build, or the last few builds with --gc-keep-builds."""
+        call_count, file_count = self.db.collect_garbage(
+            self.options.gc_keep_builds)
+
+        self.logger.check(' * gc-state',
+            'deleted %d calls and %d files' % (call_count, file_count),
+            color='compile')
+
     # --------------------------------------------------------------------------
     # Logging wrapper functions
 
@@ -158,8 +188,8 @@ class Context:
         # Add in the runtime library search paths.
         if runtime_libpaths:
             # Look up the current architecture
-            runtime_env_libpath = \
-                fbuild.builders.platform.runtime_env_libpath(self)
+            from fbuild.builders.platform import runtime_env_libpath
+            runtime_env_libpath = runtime_env_libpath(self)
 
             runtime_libpaths = os.pathsep.join(runtime_libpaths)
             try:
@@ -204,7 +234,7 @@ class Context:
             # Set the timer to None for now to make sure it's defined.
             timer = None
 
-        starttime = time.time()
+        starttime = time.perf_counter()
         try:
             p = fbuild.subprocess.killableprocess.Popen(cmd,
                 stdin=fbuild.subprocess.PIPE if input else stdin,
@@ -235,7 +265,13 @@ class Context:
         finally:
             if timeout and timer is not None:
                 timer.cancel()
-        endtime = time.time()
+        endtime = time.perf_counter()
+
+        # Remember how long the command took for the call that ran it.
+        self.db.add_duration_to_call(endtime - starttime)
+
+        self.tracer.add_slice(msg1 or cmd_string, 'execute', starttime, endtime,
+            cmd=cmd_string)
 
         if returncode:
             self.logger.log(' + ' + cmd_string, verbose=quieter)
@@ -165,6 +165,12 @@ class cachemethod_wrapper:
     def call(self, *args, **kwargs):
         return self.method.__self__.ctx.db.call(self.method, *args, **kwargs)
 
+    def map(self, srcs, *args, **kwargs):
+        """Call the method concurrently with each of the srcs as the first
+        argument. See L{fbuild.db.database.Database.map}."""
+        return self.method.__self__.ctx.db.map(self.method, srcs,
+            *args, **kwargs)
+
 
 class cacheproperty:
     """L{cacheproperty} acts like a normal I{property} but will memoize the
@@ -1,7 +1,11 @@
+import hashlib
 import io
+import os
 import pickle
+import threading
 import time
 
+import fbuild.db
 from fbuild.path import Path
 
 # ------------------------------------------------------------------------------
@@ -10,6 +14,29 @@ class Backend:
     def __init__(self, ctx):
         self._ctx = ctx
 
+        # The state of every file we've checked during this build, which is
+        # only forgotten when fbuild writes to the file.
+        self._file_states = {}
+
+        # The digests of the files we've hashed during this build, keyed by
+        # the file name and digest algorithm.
+        self._file_digests = {}
+        self._written_files = set()
+        self._file_lock = threading.Lock()
+        self._prefetch_pool = None
+
+        # The PersistentObjects we've stored or loaded during this build,
+        # keyed by their digest, and the digests of the states we've stored,
+        # keyed by the pickled state.
+        self._interned_objects = {}
+        self._object_digests = {}
+        self._object_lock = threading.Lock()
+
+        # The calls and files we've used during this build, so that the ones
+        # that go unused for a while can be garbage collected.
+        self._used_calls = set()
+        self._used_files = set()
+
     # --------------------------------------------------------------------------
 
     def connect(self, *args, **kwargs):
@@ -23,8 +50,12 @@ class Backend:
 
     # --------------------------------------------------------------------------
 
-    def prepare(self, fun_name, fun_digest, bound, srcs, dsts):
-        """Queries all the information needed to cache a function."""
+    def prepare(self, fun_name, fun_digest, bound, bound_digest, srcs, dsts,
+            files=None):
+        """Queries all the information needed to cache a function. The
+        I{bound_digest} is the L{digest_bound} of the arguments, and the
+        I{files} are the records of the files that were prefetched for the
+        call, as returned by L{find_prefetch_files}."""
 
         # Check if the function changed.
         fun_dirty, fun_id = self.check_function(fun_name, fun_digest)
@@ -35,11 +66,15 @@ class Backend:
             call_id = None
             old_result = None
         else:
-            call_dirty, call_id, old_result = self.find_call(fun_id, bound)
+            call_dirty, call_id, old_result = self.find_call(fun_id, bound,
+                bound_digest)
+
+        if call_id is not None:
+            self._used_calls.add(call_id)
 
         # Add the source files to the database. We always run this because it
         # adds our call files to the database for us.
-        call_file_digests = self.check_call_files(call_id, srcs)
+        call_file_digests = self.check_call_files(call_id, srcs, files)
 
         # Check extra external call files.
         if call_id is None:
@@ -48,7 +83,7 @@ class Backend:
             external_digests = ()
         else:
             external_srcs, external_dsts, external_digests = \
-                self.check_external_files(call_id)
+                self.check_external_files(call_id, files)
 
         return (
             fun_dirty,
@@ -61,6 +96,43 @@ class Backend:
             external_dsts,
             external_digests)
 
+    def try_prepare(self, fun_name, fun_digest, bound, bound_digest, srcs,
+            dsts, files=None):
+        """Try to run L{prepare} in the calling thread instead of the database
+        thread. Returns None if the backend doesn't support that, or if the
+        call needs to write to the database."""
+        return None
+
+    def find_prefetch_files(self, calls):
+        """Returns the records of the src files and the known external srcs
+        of the calls, which are tuples of the arguments of L{prepare}, keyed
+        by the file name. Files we've already checked during this build are
+        skipped."""
+
+        file_names = set()
+        for fun_name, fun_digest, bound, bound_digest, srcs, dsts in calls:
+            file_names.update(srcs)
+
+            fun_dirty, fun_id = self.check_function(fun_name, fun_digest)
+            if not fun_dirty and fun_id is not None:
+                call_dirty, call_id, old_result = self.find_call(fun_id,
+                    bound, bound_digest)
+                if call_id is not None:
+                    file_names.update(self.find_external_srcs(call_id))
+
+        with self._file_lock:
+            file_names = [file_name for file_name in file_names
+                if file_name not in self._file_states]
+
+        return {file_name: self.find_file(file_name)
+            for file_name in file_names}
+
+    def try_find_prefetch_files(self, calls):
+        """Try to run L{find_prefetch_files} in the calling thread instead of
+        the database thread. Returns None if the backend doesn't support
+        that."""
+        return None
+
     def cache(self,
             fun_dirty,
             fun_id,
@@ -68,11 +140,21 @@ class Backend:
             fun_digest,
             call_id,
             bound,
+            bound_digest,
             result,
             call_file_digests,
             external_srcs,
-            external_dsts):
-        """Saves the function call into the database."""
+            external_dsts,
+            call_duration=None,
+            call_children=()):
+        """Saves the function call into the database, along with the ids of
+        the cached calls it made. Returns the id of the call."""
+
+        # Another call of the function may have saved it since this call was
+        # prepared, such as an earlier call in the same batch, so check it
+        # again. Otherwise we'd delete the calls that were just saved.
+        if fun_dirty:
+            fun_dirty, fun_id = self.check_function(fun_name, fun_digest)
 
         # Lock the db since we're updating data structures.
         if fun_dirty:
@@ -86,11 +168,31 @@ class Backend:
             fun_id = self.save_function(fun_id, fun_name, fun_digest)
 
         # Get the real call_id to use in the call files.
-        call_id = self.save_call(call_id, fun_id, bound, result)
+        call_id = self.save_call(call_id, fun_id, bound, bound_digest, result)
+        self._used_calls.add(call_id)
         self.save_call_files(call_id, call_file_digests)
 
         self.save_external_files(call_id, external_srcs, external_dsts)
 
+        if call_duration is not None:
+            self.save_call_duration(call_id, call_duration)
+
+        self.save_call_children(call_id, call_children)
+
+        return call_id
+
+    def prepare_many(self, calls, files=None):
+        """Prepare each of the calls, which are tuples of the arguments of
+        L{prepare}, and return a list of the results."""
+
+        return [self.prepare(*call, files=files) for call in calls]
+
+    def cache_many(self, calls):
+        """Save each of the calls, which are tuples of the arguments of
+        L{cache}, and return a list of their ids."""
+
+        return [self.cache(*call) for call in calls]
+
     # --------------------------------------------------------------------------
 
     def check_function(self, fun_name, fun_digest):
@@ -123,24 +225,82 @@ class Backend:
 
     # --------------------------------------------------------------------------
 
-    def find_call(self, fun_id, bound):
+    def find_call(self, fun_id, bound, bound_digest):
         """Returns the function call index and result or None if it does not
-        exist."""
+        exist. The call is looked up by the I{bound_digest} of its arguments,
+        or by searching all the calls if it's None."""
         raise NotImplementedError
 
 
-    def save_call(self, call_id, fun_id, bound, result):
-        """Insert or update the function call."""
+    def save_call(self, call_id, fun_id, bound, bound_digest, result):
+        """Insert or update the function call, which is indexed by the
+        I{bound_digest} of its arguments."""
+        raise NotImplementedError
+
+
+    def find_call_children(self, call_id):
+        """Returns the ids of the cached calls that the call made, or None if
+        we don't know since the call was saved before we kept track of them.
+        Calls that don't exist didn't make any calls."""
+        raise NotImplementedError
+
+
+    def save_call_children(self, call_id, children):
+        """Replace the ids of the cached calls that the call made."""
+        raise NotImplementedError
+
+    # --------------------------------------------------------------------------
+
+    def find_durations(self, calls):
+        """Returns how long the commands of each call took to run the last
+        time it was called, or None if we don't know. The calls are the
+        function name and the digest of the bound arguments, or None. Since
+        the durations are only estimates, the calls are found by the digest
+        alone without unpickling them to check the arguments."""
+        raise NotImplementedError
+
+
+    def find_call_duration(self, call_id):
+        """Returns the duration of the call or None if it does not exist."""
+        raise NotImplementedError
+
+
+    def find_call_durations(self):
+        """Returns an iterator of the function name and duration of every
+        timed call."""
+        raise NotImplementedError
+
+
+    def save_call_duration(self, call_id, duration):
+        """Insert or update the duration of the call."""
         raise NotImplementedError
 
     # --------------------------------------------------------------------------
 
-    def check_call_files(self, call_id, file_names):
-        """Returns all of the dirty call files."""
+    def find_source_digests(self):
+        """Returns a dictionary of the source digests of the cached functions,
+        keyed by the path of their module. The values are the (mtime_ns,
+        size) of the module and a dictionary of the digests keyed by each
+        function's qualified name and line number."""
+        raise NotImplementedError
+
+
+    def save_source_digests(self, digests):
+        """Insert or replace the source digests of the modules in the
+        dictionary, which is in the format of L{find_source_digests}."""
+        raise NotImplementedError
+
+    # --------------------------------------------------------------------------
+
+    def check_call_files(self, call_id, file_names, files=None):
+        """Returns all of the dirty call files. The I{files} are the records
+        of the files we already looked up, as returned by
+        L{find_prefetch_files}."""
 
         digests = set()
         for file_name in file_names:
-            d, file_id, file_digest = self.check_call_file(call_id, file_name)
+            d, file_id, file_digest = self.check_call_file(call_id, file_name,
+                files)
             if d:
                 digests.add((file_id, file_name, file_digest))
 
@@ -155,14 +315,14 @@ class Backend:
 
     # --------------------------------------------------------------------------
 
-    def check_call_file(self, call_id, file_name):
+    def check_call_file(self, call_id, file_name, files=None):
         """Returns if the call file is dirty and the file's digest."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str), file_name
 
         # Compute the digest of the file.
-        dirty, file_id, mtime, digest = self.add_file(file_name)
+        dirty, file_id, mtime, digest = self.add_file(file_name, files)
 
         # Exit early if we don't have a valid call_id.
         if call_id is None:
@@ -192,9 +352,10 @@ class Backend:
 
     # --------------------------------------------------------------------------
 
-    def check_external_files(self, call_id):
+    def check_external_files(self, call_id, files=None):
         """Returns all of the externally specified call files, and the dirty
-        list."""
+        list. The I{files} are the records of the files we already looked up,
+        as returned by L{find_prefetch_files}."""
 
         # Do nothing if we don't have a valid call.
         if call_id is None:
@@ -208,7 +369,8 @@ class Backend:
             external_digests = []
             for src in srcs:
                 try:
-                    d, file_id, file_digest = self.check_call_file(call_id, src)
+                    d, file_id, file_digest = self.check_call_file(call_id,
+                        src, files)
                 except OSError:
                     pass
                 else:
@@ -234,34 +396,46 @@ class Backend:
 
     # --------------------------------------------------------------------------
 
-    def add_file(self, file_name):
+    def add_file(self, file_name, files=None):
         """Insert or update the file information. Returns True if the content
-        of the file is different from what was in the table."""
+        of the file is different from what was in the table. If the file is
+        in I{files}, we use the record we looked up for it there."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str), file_name
 
-        # Look up the old data.
-        file_id, old_mtime, old_digest = self.find_file(file_name)
+        self._used_files.add(file_name)
 
-        # Now, create a path object and find it's mtime.
-        file_path = Path(file_name)
-        file_mtime = file_path.getmtime()
+        # Exit early if we already checked the file during this build.
+        with self._file_lock:
+            try:
+                return self._file_states[file_name]
+            except KeyError:
+                pass
+
+            # The record of a file that fbuild wrote to could have been saved
+            # and forgotten since it was prefetched.
+            written = file_name in self._written_files
 
-        if old_mtime is not None:
-            # If the file was modified less than 1.0 seconds ago, recompute the
-            # hash since it still could have changed even with the same mtime.
-            # If True, then assume the file has not been modified.
-            if file_mtime == old_mtime and time.time() - file_mtime > 1.0:
-                return False, file_id, file_mtime, old_digest
+        # Look up the old data, unless we did that when we prefetched it.
+        # Anything else that changed the record since would have saved the
+        # state of the file.
+        if files is not None and file_name in files and not written:
+            file_id, old_identity, old_digest = files[file_name]
+        else:
+            file_id, old_identity, old_digest = self.find_file(file_name)
 
-        # The mtime changed, so let's see if the content's changed.
-        digest = file_path.digest()
+        # Now, find the file's identity and digest.
+        file_identity, digest = self.stat_file(file_name,
+            old_identity,
+            old_digest)
 
         if digest == old_digest:
-            # Save the new mtime.
-            self.save_file(file_id, file_name, file_mtime, digest)
-            return False, file_id, file_mtime, digest
+            # Save the new identity if it changed.
+            if file_identity != old_identity:
+                self.save_file(file_id, file_name, file_identity, digest)
+            self._save_file_state(file_name, file_id, file_identity, digest)
+            return False, file_id, file_identity, digest
 
         if file_id is not None:
             # Since the function changed, all of the calls that used this
@@ -272,19 +446,126 @@ class Backend:
             file_id = None
 
         # Now, add the file back to the database.
-        file_id = self.save_file(file_id, file_name, file_mtime, digest)
+        file_id = self.save_file(file_id, file_name, file_identity, digest)
+        self._save_file_state(file_name, file_id, file_identity, digest)
 
         # Returns True since the file changed.
-        return True, file_id, file_mtime, digest
+        return True, file_id, file_identity, digest
+
+
+    def _save_file_state(self, file_name, file_id, file_identity, digest):
+        """Remember the file for the rest of the build. Since the database is
+        now up to date, later checks of the file will find it unchanged."""
+
+        with self._file_lock:
+            self._file_states[file_name] = \
+                (False, file_id, file_identity, digest)
+
+
+    def forget_files(self, file_names):
+        """Forget the state of files that fbuild wrote to so that they will
+        be checked again."""
+
+        with self._file_lock:
+            for file_name in file_names:
+                self._file_states.pop(file_name, None)
+                self._written_files.add(file_name)
+
+
+    def stat_file(self, file_name, old_identity=None, old_digest=None):
+        """Returns the identity and digest of the file. The file is only
+        hashed if its identity differs from the old one and from the one it
+        had when we last hashed it during this build. The identity is None if
+        the file was hashed too soon after it was modified to trust it in
+        later builds."""
+
+        file_path = Path(file_name)
+        file_identity = file_path.identity()
+
+        if old_identity is not None and file_identity == tuple(old_identity):
+            return file_identity, old_digest
+
+        # Files we hashed with md5 keep using it so their digests still match
+        # the ones saved with the calls.
+        algorithm = digest_algorithm(old_digest)
+
+        with self._file_lock:
+            try:
+                identity, digest, saved_identity = \
+                    self._file_digests[file_name, algorithm]
+            except KeyError:
+                pass
+            else:
+                if identity == file_identity:
+                    return saved_identity, digest
+
+        hashed_ns = time.time_ns()
+        digest = file_path.digest(algorithm=algorithm)
+
+        if _stable_identity(file_identity, hashed_ns):
+            saved_identity = file_identity
+        else:
+            saved_identity = None
+
+        with self._file_lock:
+            self._file_digests[file_name, algorithm] = \
+                (file_identity, digest, saved_identity)
+
+        return saved_identity, digest
+
+
+    def prefetch_files(self, files):
+        """Stat and hash the files in parallel so that checking them one by
+        one afterwards only hits the memoised digests. The I{files} are the
+        records returned by L{find_prefetch_files}. This runs in the calling
+        thread, so that the database thread isn't kept waiting on the
+        files."""
+
+        def stat_file(args):
+            try:
+                self.stat_file(*args)
+            except OSError:
+                # Let the file get reported when it's checked.
+                pass
+
+        args = [(file_name, old_identity, old_digest)
+            for file_name, (file_id, old_identity, old_digest)
+            in files.items()]
+
+        if len(args) < 2:
+            for a in args:
+                stat_file(a)
+            return
+
+        with self._file_lock:
+            if self._prefetch_pool is None:
+                import concurrent.futures
+                self._prefetch_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=os.cpu_count() or 1)
+            pool = self._prefetch_pool
+
+        for _ in pool.map(stat_file, args):
+            pass
+
+
+    def shutdown_prefetch(self):
+        """Shut down the threads used to prefetch files."""
+
+        with self._file_lock:
+            pool = self._prefetch_pool
+            self._prefetch_pool = None
+
+        if pool is not None:
+            pool.shutdown()
 
 
     def find_file(self, file_name):
-        """Returns the file's old mtime and digest or None if it does not
+        """Returns the file's old identity and digest or None if it does not
         exist."""
         raise NotImplementedError
 
 
-    def save_file(self, file_id, file_name, file_mtime, file_digest):
+    def save_file(self, file_id, file_name, file_identity, file_digest):
         """Insert or update the file."""
         raise NotImplementedError
 
@@ -293,31 +574,203 @@ class Backend:
         """Remove the file from the database."""
         raise NotImplementedError
 
+    # --------------------------------------------------------------------------
+
+    def collect_garbage(self, keep_builds=0):
+        """Delete the calls and files that weren't used during this build or
+        the I{keep_builds} builds before it, and then compact the database.
+        The calls made by a used call, and the files a kept call depends on,
+        are kept as well. Returns the number of calls and files that were
+        deleted."""
+        raise NotImplementedError
+
+
+    def find_reachable_calls(self, call_ids):
+        """Returns the ids of the calls and every call they made, directly or
+        through other calls. Returns None if we don't know what one of those
+        calls made, in which case any call could still be used."""
+
+        reachable = set()
+        stack = list(call_ids)
+
+        while stack:
+            call_id = stack.pop()
+            if call_id in reachable:
+                continue
+
+            reachable.add(call_id)
+
+            children = self.find_call_children(call_id)
+            if children is None:
+                return None
+
+            stack.extend(children)
+
+        return reachable
+
+    # --------------------------------------------------------------------------
+
+    def dumps(self, obj):
+        """Pickle the object. The PersistentObjects it refers to are stored
+        once in the object table and pickled as references to it."""
+
+        f = io.BytesIO()
+        pickler = Pickler(self._ctx, f, objects=self._object_id)
+        pickler.dump(obj)
+
+        return f.getvalue()
+
+
+    def loads(self, string):
+        """Unpickle an object pickled with L{dumps}."""
+
+        f = io.BytesIO(string)
+        unpickler = Unpickler(self._ctx, f, objects=self.load_object)
+        return unpickler.load()
+
+
+    def _object_id(self, obj):
+        """Store the PersistentObject in the object table if it isn't there
+        yet, and return its persistent id."""
+
+        # Pickle the object's state without the memo so that equal objects
+        # get the same digest.
+        f = io.BytesIO()
+        pickler = Pickler(self._ctx, f, objects=self._object_id)
+        pickler.fast = True
+
+        try:
+            pickler.dump((type(obj), obj.__dict__))
+        except (pickle.PicklingError, AttributeError, TypeError, ValueError):
+            # We can't store the object on its own, so just pickle it with
+            # whatever refers to it.
+            return None
+
+        state = f.getvalue()
+
+        # The object may have changed since we last stored it, so we can only
+        # skip storing it again if its state is the same.
+        with self._object_lock:
+            try:
+                return ('object', self._object_digests[state])
+            except KeyError:
+                pass
+
+        digest = hashlib.md5(state).hexdigest()
+
+        if self.find_object(digest) is None:
+            self.save_object(digest, state)
+
+        # Don't intern the object, since it could still change and then no
+        # longer match the digest.
+        with self._object_lock:
+            self._object_digests[state] = digest
+
+        return ('object', digest)
+
+
+    def load_object(self, digest):
+        """Returns the PersistentObject with the digest. Every reference to
+        the object loads the same instance."""
+
+        with self._object_lock:
+            try:
+                return self._interned_objects[digest]
+            except KeyError:
+                pass
+
+        state = self.find_object(digest)
+        if state is None:
+            raise pickle.UnpicklingError('unknown object: %r' % digest)
+
+        cls, d = self.loads(state)
+
+        obj = object.__new__(cls)
+        obj.__dict__.update(d)
+
+        return self._intern_object(digest, obj)
+
+
+    def _intern_object(self, digest, obj):
+        """Make the object the instance for the digest, unless there already
+        is one. Returns the instance."""
+
+        with self._object_lock:
+            obj = self._interned_objects.setdefault(digest, obj)
+
+        return obj
+
+
+    def find_object(self, digest):
+        """Returns the pickled state of the object, or None if it does not
+        exist."""
+        raise NotImplementedError
+
+
+    def save_object(self, digest, state):
+        """Insert the pickled state of the object."""
+        raise NotImplementedError
+
+# ------------------------------------------------------------------------------
+
+def _stable_identity(identity, hashed_ns):
+    """Returns if the identity of a file that we started to hash at
+    I{hashed_ns} can be trusted to change when the file does. Filesystems
+    can't tell apart writes within the same tick of their clock, which can be
+    as coarse as a second even when the timestamps have nanoseconds, so if
+    the file was modified less than 1.0 seconds before we hashed it, it could
+    have changed since without changing its identity."""
+
+    return hashed_ns - identity[2] > 1000000000
+
+
+def digest_algorithm(old_digest):
+    """Returns the algorithm used to hash a file. New files are hashed with
+    blake2b, but files that were hashed with md5 stay with md5."""
+
+    if old_digest is not None and len(old_digest) == 32:
+        return 'md5'
+    else:
+        return 'blake2b'
+
 # ------------------------------------------------------------------------------
 
 class Pickler(pickle.Pickler):
-    """Create a custom pickler that won't try to pickle the context."""
+    """Create a custom pickler that won't try to pickle the context. If
+    I{objects} is given, it's called with each PersistentObject and returns
+    the persistent id to pickle in the object's place, or None to pickle the
+    object itself."""
 
-    def __init__(self, ctx, *args, **kwargs):
+    def __init__(self, ctx, *args, objects=None, **kwargs):
         super().__init__(*args, protocol=pickle.HIGHEST_PROTOCOL, **kwargs)
         self.ctx = ctx
+        self.objects = objects
 
     def persistent_id(self, obj):
         if obj is self.ctx:
             return b'ctx'
+        elif self.objects is not None and \
+                isinstance(obj, fbuild.db.PersistentObject):
+            return self.objects(obj)
         else:
             return None
 
 class Unpickler(pickle.Unpickler):
-    """Create a custom unpickler that will substitute the current context."""
+    """Create a custom unpickler that will substitute the current context. If
+    I{objects} is given, it's called with the digest of each PersistentObject
+    that was pickled by reference and returns the object."""
 
-    def __init__(self, ctx, *args, **kwargs):
+    def __init__(self, ctx, *args, objects=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.ctx = ctx
+        self.objects = objects
 
     def persistent_load(self, pid):
         if pid == b'ctx':
             return self.ctx
+        elif self.objects is not None and \
+                isinstance(pid, tuple) and pid[0] == 'object':
+            return self.objects(pid[1])
         else:
             raise pickle.UnpicklingError('unsupported persistent object: %r' %
                 pid)
@@ -335,3 +788,81 @@ def pickle_loads(ctx, string):
     f = io.BytesIO(string)
     unpickler = Unpickler(ctx, f)
     return unpickler.load()
+
+
+# ------------------------------------------------------------------------------
+
+# The version of the digests made by digest_bound. Change it whenever they
+# change, so that the backends index their calls again.
+DIGEST_VERSION = 1
+
+def digest_bound(ctx, bound):
+    """Returns a digest of the bound arguments of a call. Equal arguments get
+    the same digest even if their sets and dictionaries are ordered
+    differently, so it can be used to index the calls of a function. Returns
+    None if the arguments can't be pickled."""
+
+    def dumps(obj):
+        # Disable the memo so that the pickle doesn't depend on which of the
+        # objects happen to be shared.
+        f = io.BytesIO()
+        pickler = Pickler(ctx, f)
+        pickler.fast = True
+        pickler.dump(obj)
+
+        return f.getvalue()
+
+    # The ids of the containers we're in the middle of canonicalizing, so we
+    # can tell when one contains itself.
+    active = set()
+
+    def canonicalize(obj):
+        if isinstance(obj, (dict, set, frozenset, list, tuple)) or \
+                isinstance(type(obj), fbuild.db.PersistentMeta):
+            if id(obj) in active:
+                raise ValueError('recursive argument: %r' % type(obj))
+
+            active.add(id(obj))
+            try:
+                return canonicalize_container(obj)
+            finally:
+                active.discard(id(obj))
+
+        return obj
+
+    def canonicalize_container(obj):
+        # Check the metaclass since the config tests are persistent without
+        # subclassing PersistentObject.
+        if isinstance(type(obj), fbuild.db.PersistentMeta):
+            return (type(obj), canonicalize(obj.__dict__))
+        elif isinstance(obj, dict):
+            # Most dictionaries are keyed by strings, which we can sort
+            # without pickling the whole item.
+            if all(type(k) is str for k in obj):
+                return (type(obj), tuple(
+                    (k, canonicalize(obj[k])) for k in sorted(obj)))
+
+            return (type(obj), tuple(sorted(
+                ((canonicalize(k), canonicalize(v)) for k, v in obj.items()),
+                key=dumps)))
+        elif isinstance(obj, (set, frozenset)):
+            if all(type(o) is str for o in obj):
+                return (type(obj), tuple(sorted(obj)))
+
+            return (type(obj), tuple(sorted(
+                (canonicalize(o) for o in obj),
+                key=dumps)))
+        elif type(obj) in (list, tuple):
+            return (type(obj), tuple(canonicalize(o) for o in obj))
+        else:
+            return obj
+
+    # Arguments that refer back to themselves, or that are nested too deeply,
+    # can't be digested either.
+    try:
+        s = dumps(canonicalize(bound))
+    except (pickle.PicklingError, AttributeError, TypeError, ValueError,
+            RecursionError):
+        return None
+
+    return hashlib.md5(s).hexdigest()
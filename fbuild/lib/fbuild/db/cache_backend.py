@@ -12,6 +12,16 @@ class CacheBackend(fbuild.db.backend.Backend):
         self._call_files = {}
         self._external_srcs = {}
         self._external_dsts = {}
+        self._call_durations = {}
+        self._call_indices = {}
+        self._source_digests = {}
+        self._call_children = {}
+
+        # The number of this build, and the number of the last build that used
+        # each call and file.
+        self._build = 1
+        self._call_builds = {}
+        self._file_builds = {}
 
     def close(self):
         """Clear the database cache."""
@@ -22,6 +32,12 @@ class CacheBackend(fbuild.db.backend.Backend):
         del self._call_files
         del self._external_srcs
         del self._external_dsts
+        del self._call_durations
+        del self._call_indices
+        del self._source_digests
+        del self._call_children
+        del self._call_builds
+        del self._file_builds
 
     # --------------------------------------------------------------------------
 
@@ -97,6 +113,23 @@ class CacheBackend(fbuild.db.backend.Backend):
         else:
             function_existed |= True
 
+        try:
+            del self._call_durations[fun_name]
+        except KeyError:
+            pass
+        else:
+            function_existed |= True
+
+        try:
+            del self._call_indices[fun_name]
+        except KeyError:
+            pass
+        else:
+            function_existed |= True
+
+        self._call_children.pop(fun_name, None)
+        self._call_builds.pop(fun_name, None)
+
         # Since _call_files is indexed by filename, we need to search through
         # each item and delete any references to this function. The assumption
         # is that the files will change much less frequently compared to
@@ -126,7 +159,7 @@ class CacheBackend(fbuild.db.backend.Backend):
 
     # --------------------------------------------------------------------------
 
-    def find_call(self, fun_id, bound):
+    def find_call(self, fun_id, bound, bound_digest):
         """Returns the function call index and result or None if it does not
         exist."""
 
@@ -139,18 +172,29 @@ class CacheBackend(fbuild.db.backend.Backend):
         except KeyError:
             return True, None, None
 
-        # We've called this before, so search the data to see if we've called
-        # it with the same arguments.
-        for call_index, (old_bound, old_result) in enumerate(datas):
-            if bound == old_bound:
-                # We've found a matching call so just return the index.
-                return False, (fun_id, call_index), old_result
+        # We've called this before, so look up the call with the same digest
+        # and make sure it really has the same arguments.
+        if bound_digest is None:
+            # We can't digest the arguments, so search all the calls.
+            for call_index, (old_bound, old_result) in enumerate(datas):
+                if bound == old_bound:
+                    return False, (fun_id, call_index), old_result
+        else:
+            try:
+                call_index = self._call_indices[fun_id][bound_digest]
+            except KeyError:
+                pass
+            else:
+                old_bound, old_result = datas[call_index]
+                if bound == old_bound:
+                    # We've found a matching call so just return the index.
+                    return False, (fun_id, call_index), old_result
 
         # Turns out we haven't called it with these args.
         return True, None, None
 
 
-    def save_call(self, call_id, fun_id, bound, result):
+    def save_call(self, call_id, fun_id, bound, bound_digest, result):
         """Insert or update the function call."""
 
         # Make sure we got the right types.
@@ -175,17 +219,138 @@ class CacheBackend(fbuild.db.backend.Backend):
             # The function be new or may have been deleted. So ignore the
             # call_id and just create a new list.
             self._function_calls[fun_id] = [(bound, result)]
+            self._call_indices[fun_id] = {}
 
-            call_index = 0
+            call_index = None
         else:
             if call_index is None:
                 datas.append((bound, result))
-                call_index = len(datas) - 1
             else:
                 datas[call_index] = (bound, result)
 
+        # Index the new call by the digest of its arguments.
+        if call_index is None:
+            call_index = len(self._function_calls[fun_id]) - 1
+            if bound_digest is not None:
+                self._call_indices.setdefault(fun_id, {})[bound_digest] = \
+                    call_index
+
         return (fun_id, call_index)
 
+    def _index_calls(self):
+        """Index all the calls by the digests of their arguments."""
+
+        self._call_indices = {}
+        for fun_name, datas in self._function_calls.items():
+            indices = self._call_indices[fun_name] = {}
+            for call_index, (bound, result) in enumerate(datas):
+                digest = fbuild.db.backend.digest_bound(self._ctx, bound)
+                if digest is not None:
+                    indices[digest] = call_index
+
+    # --------------------------------------------------------------------------
+
+    def find_call_children(self, call_id):
+        """Returns the ids of the cached calls that the call made, or None if
+        we don't know."""
+
+        # Extract out the real fun_name and call_id
+        fun_name, call_index = call_id
+
+        if call_index >= len(self._function_calls.get(fun_name, ())):
+            return frozenset()
+
+        try:
+            return self._call_children[fun_name][call_index]
+        except KeyError:
+            return None
+
+
+    def save_call_children(self, call_id, children):
+        """Replace the ids of the cached calls that the call made."""
+
+        # Extract out the real fun_name and call_id
+        fun_name, call_index = call_id
+
+        # Make sure we got the right types.
+        assert isinstance(fun_name, str), fun_name
+        assert isinstance(call_index, int), call_index
+        assert all(isinstance(child, tuple) for child in children), children
+
+        self._call_children.setdefault(fun_name, {})[call_index] = \
+            frozenset(children)
+
+    # --------------------------------------------------------------------------
+
+    def find_call_duration(self, call_id):
+        """Returns the duration of the call or None if it does not exist."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, tuple), call_id
+
+        # Extract out the real fun_name and call_id
+        fun_name, call_index = call_id
+
+        try:
+            return self._call_durations[fun_name][call_index]
+        except KeyError:
+            return None
+
+
+    def find_durations(self, calls):
+        """Returns how long the commands of each call took to run the last
+        time it was called, or None if we don't know."""
+
+        durations = []
+        for call in calls:
+            try:
+                fun_name, digest = call
+                call_index = self._call_indices[fun_name][digest]
+                duration = self._call_durations[fun_name][call_index]
+            except (TypeError, KeyError):
+                duration = None
+
+            durations.append(duration)
+
+        return durations
+
+
+    def find_call_durations(self):
+        """Returns an iterator of the function name and duration of every
+        timed call."""
+
+        for fun_name, durations in self._call_durations.items():
+            for duration in durations.values():
+                yield fun_name, duration
+
+
+    def save_call_duration(self, call_id, duration):
+        """Insert or update the duration of the call."""
+
+        # Extract out the real fun_name and call_id
+        fun_name, call_index = call_id
+
+        # Make sure we got the right types.
+        assert isinstance(fun_name, str), fun_name
+        assert isinstance(call_index, int), call_index
+        assert isinstance(duration, float), duration
+
+        self._call_durations.setdefault(fun_name, {})[call_index] = duration
+
+    # --------------------------------------------------------------------------
+
+    def find_source_digests(self):
+        """Returns a dictionary of the source digests of the cached functions,
+        keyed by the path of their module."""
+
+        return dict(self._source_digests)
+
+
+    def save_source_digests(self, digests):
+        """Insert or replace the source digests of the modules."""
+
+        self._source_digests.update(digests)
+
     # --------------------------------------------------------------------------
 
     def find_call_file(self, call_id, file_name):
@@ -289,7 +454,7 @@ class CacheBackend(fbuild.db.backend.Backend):
 
         external_digests = []
         for src in srcs:
-            dirty, file_id, mtime, digest = self.add_file(src)
+            dirty, file_id, identity, digest = self.add_file(src)
             external_digests.append((file_id, src, digest))
 
         self.save_call_files(call_id, external_digests)
@@ -297,34 +462,40 @@ class CacheBackend(fbuild.db.backend.Backend):
     # --------------------------------------------------------------------------
 
     def find_file(self, file_name):
-        """Returns the mtime and digest of the file, or None if it does not
+        """Returns the identity and digest of the file, or None if it does not
         exist."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str), file_name
 
         try:
-            file_mtime, file_digest = self._files[file_name]
+            file_identity, file_digest = self._files[file_name]
         except KeyError:
-            file_mtime = None
+            file_identity = None
             file_digest = None
 
+        # Older state files saved the mtime instead of the identity, which
+        # will just force the file to be rehashed.
+        if not isinstance(file_identity, tuple):
+            file_identity = None
+
         # We'll return the file_name as the file_id.
-        return file_name, file_mtime, file_digest
+        return file_name, file_identity, file_digest
 
 
-    def save_file(self, file_id, file_name, file_mtime, file_digest):
+    def save_file(self, file_id, file_name, file_identity, file_digest):
         """Insert or update the file."""
 
         # Make sure we got the right types.
         assert file_id is file_name or file_id is None, (file_id, file_name)
         assert isinstance(file_name, str), file_name
-        assert isinstance(file_mtime, float), file_mtime
+        assert file_identity is None or isinstance(file_identity, tuple), \
+            file_identity
         assert isinstance(file_digest, str), file_digest
 
         # We don't have separate code paths for existing and non-existing
         # files.
-        self._files[file_name] = (file_mtime, file_digest)
+        self._files[file_name] = (file_identity, file_digest)
 
         # We'll return the file_name as the file_id.
         return file_name
@@ -352,4 +523,146 @@ class CacheBackend(fbuild.db.backend.Backend):
         else:
             file_existed |= True
 
+        self._file_builds.pop(file_name, None)
+
         return file_existed
+
+    # --------------------------------------------------------------------------
+
+    def _save_uses(self):
+        """Mark the calls and files we used with the number of this build."""
+
+        for fun_name, call_index in self._used_calls:
+            # Skip the calls of functions that were deleted since.
+            if call_index < len(self._function_calls.get(fun_name, ())):
+                self._call_builds.setdefault(fun_name, {})[call_index] = \
+                    self._build
+
+        for file_name in self._used_files:
+            if file_name in self._files:
+                self._file_builds[file_name] = self._build
+
+        self._used_calls.clear()
+        self._used_files.clear()
+
+
+    def collect_garbage(self, keep_builds=0):
+        """Delete the calls and files that weren't used during this build or
+        the I{keep_builds} builds before it, along with the calls they made
+        and the files the calls depend on. Returns the number of calls and
+        files that were deleted."""
+
+        self._save_uses()
+
+        # Anything we saved before we started counting builds is treated as
+        # being used by build 0.
+        oldest = self._build - keep_builds
+
+        used = self.find_reachable_calls(
+            (fun_name, call_index)
+            for fun_name, builds in self._call_builds.items()
+            for call_index, build in builds.items()
+            if build >= oldest)
+
+        # If we don't know what some of the used calls made, any call could
+        # still be used, so we can only delete files.
+        call_count = 0
+        if used is not None:
+            indices = {}
+            for fun_name, datas in list(self._function_calls.items()):
+                keep = [call_index for call_index in range(len(datas))
+                    if (fun_name, call_index) in used]
+
+                if len(keep) == len(datas):
+                    continue
+
+                call_count += len(datas) - len(keep)
+
+                if keep:
+                    indices[fun_name] = self._renumber_calls(fun_name, keep)
+                else:
+                    self.delete_function(fun_name)
+                    indices[fun_name] = {}
+
+            self._renumber_children(indices)
+
+        # Keep the files that the remaining calls depend on, even if they
+        # weren't checked recently, since deleting them would make the calls
+        # dirty.
+        kept_files = {file_name
+            for file_name, functions in self._call_files.items()
+            if any(functions.values())}
+
+        for dsts in self._external_dsts.values():
+            for file_names in dsts.values():
+                kept_files.update(file_names)
+
+        file_names = [file_name for file_name in self._files
+            if self._file_builds.get(file_name, 0) < oldest and
+                file_name not in kept_files]
+
+        for file_name in file_names:
+            self.delete_file(file_name)
+
+        return call_count, len(file_names)
+
+
+    def _renumber_calls(self, fun_name, keep):
+        """Only keep the calls of the function with the indices in I{keep},
+        and move them down so that the call indices stay contiguous. Returns
+        a dictionary of the new indices keyed by the old ones."""
+
+        indices = {old: new for new, old in enumerate(keep)}
+
+        def renumber(table):
+            try:
+                values = table[fun_name]
+            except KeyError:
+                return
+
+            table[fun_name] = {indices[call_index]: value
+                for call_index, value in values.items()
+                if call_index in indices}
+
+        datas = self._function_calls[fun_name]
+        self._function_calls[fun_name] = [datas[i] for i in keep]
+
+        self._call_indices[fun_name] = {digest: indices[call_index]
+            for digest, call_index in self._call_indices.get(fun_name,
+                {}).items()
+            if call_index in indices}
+
+        renumber(self._external_srcs)
+        renumber(self._external_dsts)
+        renumber(self._call_durations)
+        renumber(self._call_children)
+        renumber(self._call_builds)
+
+        for functions in self._call_files.values():
+            renumber(functions)
+
+        return indices
+
+
+    def _renumber_children(self, indices):
+        """Update the ids of the calls that other calls made, given the new
+        indices of the calls of each function that was renumbered. The calls
+        that were deleted are dropped."""
+
+        def renumber(child):
+            fun_name, call_index = child
+            try:
+                function_indices = indices[fun_name]
+            except KeyError:
+                return child
+
+            try:
+                return (fun_name, function_indices[call_index])
+            except KeyError:
+                return None
+
+        for fun_name, calls in self._call_children.items():
+            for call_index, children in calls.items():
+                calls[call_index] = frozenset(
+                    child for child in map(renumber, children)
+                    if child is not None)
@@ -1,7 +1,9 @@
+import contextvars
+import functools
 import hashlib
 import itertools
-import pprint
 import threading
+import time
 
 import fbuild
 import fbuild.functools
@@ -10,16 +12,89 @@ import fbuild.path
 import fbuild.rpc
 
 import fbuild.db
-import fbuild.db.pickle_backend
-import fbuild.db.cache_backend
-import fbuild.db.sqlite_backend
+import fbuild.db.backend
+
+# ------------------------------------------------------------------------------
+
+class _Call:
+    """The bound function and arguments of a call to L{Database.call}."""
+
+    def __init__(self, fun_name, function, args, kwargs, fun_digest,
+            call_bound, bound_digest, srcs, dsts, return_type):
+        self.fun_name = fun_name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.fun_digest = fun_digest
+        self.call_bound = call_bound
+        self.bound_digest = bound_digest
+        self.srcs = srcs
+        self.dsts = dsts
+        self.return_type = return_type
+
+        # The id of the call in the backend, once it's been checked or saved.
+        self.call_id = None
+
+    def prepare_args(self):
+        """Returns the arguments for the backend's prepare method."""
+        return (
+            self.fun_name,
+            self.fun_digest,
+            self.call_bound,
+            self.bound_digest,
+            self.srcs,
+            self.dsts)
+
+# ------------------------------------------------------------------------------
+
+class _RunningCall:
+    """What a dirty call did while it ran."""
+
+    def __init__(self):
+        # The durations of the commands run by the call. Commands run by any
+        # nested cached calls are added to those calls instead.
+        self.durations = []
+
+        # The ids of the cached calls it made, whether or not they were dirty.
+        self.children = set()
+
+# The call that's running in the current thread. The scheduler runs each task
+# in a copy of the context that queued it, so the tasks a call starts belong
+# to it too, whichever thread runs them.
+_running_call = contextvars.ContextVar('running_call', default=None)
+
+# ------------------------------------------------------------------------------
+
+# Why a call was dirty, in the order we check them. Each miss is counted under
+# the first reason that applies.
+MISS_REASONS = ('function', 'arguments', 'srcs', 'external srcs', 'dsts')
+
+class _CallStats:
+    """How often the calls of a function were cached, why they weren't, and
+    where the time went."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = dict.fromkeys(MISS_REASONS, 0)
+        self.prepare_time = 0.0
+        self.body_time = 0.0
+        self.cache_time = 0.0
+
+    def to_json(self):
+        return {
+            'hits': self.hits,
+            'misses': dict(self.misses),
+            'prepare_time': self.prepare_time,
+            'body_time': self.body_time,
+            'cache_time': self.cache_time,
+        }
 
 # ------------------------------------------------------------------------------
 
 class Database:
     """L{Database} persistently stores the results of argument calls."""
 
-    def __init__(self, ctx, *, engine, explain=False):
+    def __init__(self, ctx, *, engine, explain=False, concurrent_reads=False):
         def handle_rpc(method, *args, **kwargs):
             return method(*args, **kwargs)
 
@@ -27,18 +102,45 @@ class Database:
         self._explain = explain
         self._connected = False
 
+        # Only import the engine we're using, since they can be slow to load.
         if engine == 'pickle':
-            self._backend = fbuild.db.pickle_backend.PickleBackend(self._ctx)
+            from fbuild.db.pickle_backend import PickleBackend
+            self._backend = PickleBackend(self._ctx)
+        elif engine == 'log':
+            from fbuild.db.log_backend import LogBackend
+            self._backend = LogBackend(self._ctx)
         elif engine == 'cache':
-            self._backend = fbuild.db.cache_backend.CacheBackend(self._ctx)
+            from fbuild.db.cache_backend import CacheBackend
+            self._backend = CacheBackend(self._ctx)
         elif engine == 'sqlite':
-            self._backend = fbuild.db.sqlite_backend.SqliteBackend(self._ctx)
+            from fbuild.db.sqlite_backend import SqliteBackend
+            self._backend = SqliteBackend(self._ctx,
+                concurrent_reads=concurrent_reads)
         else:
             raise fbuild.Error('unknown backend: %s' % engine)
 
-        self._rpc = fbuild.rpc.RPC(handle_rpc)
+        self._rpc = fbuild.rpc.RPC(handle_rpc, ctx.tracer)
+        self._rpc.name = 'database'
         self._rpc.daemon = True
         self.active_files = set()
+
+        # The results of the calls we've already checked or run during this
+        # build, keyed by the function name, function digest and the digest of
+        # the arguments, and the keys of the calls that depend on each src.
+        self._memo = {}
+        self._memo_srcs = {}
+        self._memo_lock = threading.Lock()
+
+        # The source digests of the cached functions that were saved in the
+        # database, and the modules whose digests we need to save.
+        self._source_digests = {}
+        self._dirty_source_paths = set()
+        self._module_identities = {}
+
+        # The counters and timings of the calls of each function.
+        self._call_stats = {}
+        self._call_stats_lock = threading.Lock()
+
         self.start()
 
     def start(self):
@@ -55,11 +157,23 @@ class Database:
 
         result = self._rpc.call(self._backend.connect, *args, **kwargs)
         self._connected = True
+
+        self._source_digests = self._rpc.call(
+            self._backend.find_source_digests)
+
         return result
 
     def close(self, *args, **kwargs):
         """Close the connection to the backend."""
+        with self._digest_function_lock:
+            if self._dirty_source_paths:
+                self._rpc.call(self._backend.save_source_digests,
+                    {path: self._source_digests[path]
+                        for path in self._dirty_source_paths})
+                self._dirty_source_paths = set()
+
         result = self._rpc.call(self._backend.close, *args, **kwargs)
+        self._backend.shutdown_prefetch()
         self._connected = False
         return result
 
@@ -72,6 +186,222 @@ class Database:
         "srcs" are also modified.  Finally, if any of the filenames in "dsts"
         do not exist, re-run the function no matter what."""
 
+        start = time.perf_counter()
+        call = self._bind_call(function, args, kwargs)
+        try:
+            return self._call(call)
+        finally:
+            self._ctx.tracer.add_slice(call.fun_name, 'call', start,
+                time.perf_counter())
+
+    def _call(self, call):
+        """Check the bound call against the database, and run it if it's
+        dirty."""
+
+        # Return the result if we've already checked the call during this
+        # build.
+        memoized = self._find_memo(call)
+        if memoized is not None:
+            self._count_call(call.fun_name, hits=1)
+            self._add_child(call)
+            return memoized
+
+        # Try to check the call from this thread before falling back onto
+        # the database thread.
+        start = time.perf_counter()
+        files = self._prefetch_files([call])
+        prepared = self._backend.try_prepare(*call.prepare_args(),
+            files=files)
+        if prepared is None:
+            prepared = self._rpc.call(self._backend.prepare,
+                *call.prepare_args(), files=files)
+        self._count_call(call.fun_name,
+            prepare_time=time.perf_counter() - start)
+
+        # Return the cached value if the call was not dirty.
+        cached = self._check_call(call, prepared)
+        if cached is not None:
+            self._save_memo(call, cached)
+            self._add_child(call)
+            return cached
+
+        # The call was dirty, so recompute it and save the results in the
+        # database.
+        cache_args, result = self._run_call(call, prepared)
+
+        start = time.perf_counter()
+        call.call_id = self._rpc.call(self._backend.cache, *cache_args)
+        self._count_call(call.fun_name,
+            cache_time=time.perf_counter() - start)
+
+        self._save_memo(call, result)
+        self._add_child(call)
+
+        return result
+
+    def seed(self, function, result, *args, **kwargs):
+        """Save the result of calling the function with the arguments as if
+        it had been called, without calling it. This only works for functions
+        that don't depend on any files. Returns False if the call was already
+        cached, in which case the cached result is kept."""
+
+        call = self._bind_call(function, args, kwargs)
+        assert not call.srcs and not call.dsts, \
+            "Cannot seed a call that depends on files"
+
+        if self._find_memo(call) is not None:
+            return False
+
+        fun_dirty, fun_id, call_dirty, call_id, old_result, call_file_digests, \
+            external_srcs, external_dsts, external_digests = \
+                self._rpc.call(self._backend.prepare, *call.prepare_args())
+
+        if not (fun_dirty or call_dirty):
+            return False
+
+        call.call_id = self._rpc.call(self._backend.cache,
+            fun_dirty, fun_id, call.fun_name, call.fun_digest,
+            call_id, call.call_bound, call.bound_digest, result,
+            call_file_digests, set(), set(), None, ())
+
+        self._save_memo(call, (result, set(), set()))
+
+        return True
+
+    def map(self, function, srcs, *args, **kwargs):
+        """Call the function with each of the srcs as the first argument, and
+        return a list of the results, src dependencies, and dst dependencies
+        in the order of the srcs. This acts like L{call}, but it checks and
+        saves all the calls in one round trip to the backend each, and runs
+        the dirty calls concurrently in the scheduler."""
+
+        start = time.perf_counter()
+        calls = [self._bind_call(function, (src,) + args, kwargs)
+            for src in srcs]
+
+        if not calls:
+            return []
+
+        try:
+            return self._map(calls)
+        finally:
+            self._ctx.tracer.add_slice(calls[0].fun_name, 'map', start,
+                time.perf_counter(), calls=len(calls))
+
+    def _map(self, calls):
+        """Check the bound calls against the database, and run the dirty ones
+        concurrently."""
+
+        memoized = [self._find_memo(call) for call in calls]
+
+        for call, m in zip(calls, memoized):
+            if m is not None:
+                self._count_call(call.fun_name, hits=1)
+                self._add_child(call)
+
+        start = time.perf_counter()
+        files = self._prefetch_files(
+            [call for call, m in zip(calls, memoized) if m is None])
+        prepared = [None if m is not None else
+                self._backend.try_prepare(*call.prepare_args(), files=files)
+            for call, m in zip(calls, memoized)]
+
+        # Prepare all the calls we couldn't check from this thread at once.
+        missing = [i for i, p in enumerate(prepared)
+            if p is None and memoized[i] is None]
+        if missing:
+            for i, p in zip(missing, self._rpc.call(
+                    self._backend.prepare_many,
+                    [calls[i].prepare_args() for i in missing],
+                    files)):
+                prepared[i] = p
+
+        # The calls were prepared together, so split the time between them.
+        prepare_time = time.perf_counter() - start
+        checked = [call for call, m in zip(calls, memoized) if m is None]
+        for call in checked:
+            self._count_call(call.fun_name,
+                prepare_time=prepare_time / len(checked))
+
+        results = [m if m is not None else self._check_call(call, p)
+            for call, p, m in zip(calls, prepared, memoized)]
+
+        for call, m, result in zip(calls, memoized, results):
+            if m is None and result is not None:
+                self._save_memo(call, result)
+                self._add_child(call)
+
+        def run(index):
+            # Catch the errors so that we can still save the calls that
+            # succeeded.
+            try:
+                return self._run_call(calls[index], prepared[index]), None
+            except Exception as e:
+                return None, e
+
+        dirty = [i for i, result in enumerate(results) if result is None]
+
+        # The scheduler can't see through the closure to estimate how long
+        # each call takes, so look them up ourselves.
+        estimates = None
+        if dirty and self._ctx.scheduler.schedule == 'critical-path':
+            estimates = self._rpc.call(self._backend.find_durations,
+                [(calls[i].fun_name, calls[i].bound_digest) for i in dirty])
+
+        exc = None
+        cache_args = []
+        cached = []
+        ran_calls = self._ctx.scheduler.map(run, dirty, estimates=estimates)
+        for index, (ran, e) in zip(dirty, ran_calls):
+            if e is not None:
+                if exc is None:
+                    exc = e
+            else:
+                cache_args.append(ran[0])
+                cached.append((calls[index], ran[1]))
+                results[index] = ran[1]
+
+        if cache_args:
+            start = time.perf_counter()
+            call_ids = self._rpc.call(self._backend.cache_many, cache_args)
+
+            cache_time = time.perf_counter() - start
+            for args in cache_args:
+                self._count_call(args[2],
+                    cache_time=cache_time / len(cache_args))
+
+            for (call, result), call_id in zip(cached, call_ids):
+                call.call_id = call_id
+                self._save_memo(call, result)
+                self._add_child(call)
+
+        if exc is not None:
+            raise exc
+
+        return results
+
+    def _prefetch_files(self, calls):
+        """Stat and hash the src files and the known external srcs of the
+        calls in parallel from this thread, so that the backend only hits the
+        memoised digests when it checks them. Returns the records of the
+        files to pass on to the backend."""
+
+        if not calls:
+            return {}
+
+        args = [call.prepare_args() for call in calls]
+        files = self._backend.try_find_prefetch_files(args)
+        if files is None:
+            files = self._rpc.call(self._backend.find_prefetch_files, args)
+
+        self._backend.prefetch_files(files)
+
+        return files
+
+    def _bind_call(self, function, args, kwargs):
+        """Look up everything we need to know about the call before we can
+        check it against the backend."""
+
         # Make sure none of the arguments are a generator.
         assert all(not fbuild.inspect.isgenerator(arg)
             for arg in itertools.chain(args, kwargs.values())), \
@@ -91,14 +421,82 @@ class Database:
             args,
             kwargs)
 
+        # Digest the arguments once, since both the memo and the backend
+        # look up the call by them.
+        bound_digest = fbuild.db.backend.digest_bound(self._ctx, call_bound)
+
+        return _Call(fun_name, function, args, kwargs, fun_digest,
+            call_bound, bound_digest, srcs, dsts, return_type)
+
+    def _find_memo(self, call):
+        """Returns the result, src dependencies and dst dependencies of the
+        call if it was already checked or run during this build, or None."""
+
+        if call.bound_digest is None:
+            return None
+
+        key = (call.fun_name, call.fun_digest, call.bound_digest)
+
+        with self._memo_lock:
+            try:
+                bound, result, call_id = self._memo[key]
+            except KeyError:
+                return None
+
+        if bound != call.call_bound:
+            return None
+
+        call.call_id = call_id
+
+        result, srcs, dsts = result
+        return result, set(srcs), set(dsts)
+
+    def _save_memo(self, call, result):
+        """Remember the result of the call for the rest of the build."""
+
+        if call.bound_digest is None:
+            return
+
+        key = (call.fun_name, call.fun_digest, call.bound_digest)
+        srcs = result[1]
+
+        with self._memo_lock:
+            self._memo[key] = (call.call_bound, result, call.call_id)
+            for src in srcs:
+                self._memo_srcs.setdefault(src, set()).add(key)
+
+    def _add_child(self, call):
+        """Record that the running call made this call, so that the call is
+        kept as long as the running call is used, even when the running call
+        is cached and doesn't make the call again."""
+
+        running = _running_call.get()
+        if running is not None and call.call_id is not None:
+            running.children.add(call.call_id)
+
+    def _forget_files(self, file_names):
+        """Forget everything we know about the files since fbuild wrote to
+        them, including the results of the calls that depend on them."""
+
+        file_names = list(file_names)
+        self._backend.forget_files(file_names)
+
+        with self._memo_lock:
+            for file_name in file_names:
+                for key in self._memo_srcs.pop(file_name, ()):
+                    self._memo.pop(key, None)
+
+    def _check_call(self, call, prepared):
+        """Returns the cached result, src dependencies and dst dependencies of
+        the call, or None if the call is dirty."""
+
         fun_dirty, fun_id, call_dirty, call_id, old_result, call_file_digests, \
-            external_srcs, external_dsts, external_digests = \
-                self._rpc.call(self._backend.prepare,
-                    fun_name,
-                    fun_digest,
-                    call_bound,
-                    srcs,
-                    dsts)
+            external_srcs, external_dsts, external_digests = prepared
+
+        fun_name = call.fun_name
+        srcs = call.srcs
+        dsts = call.dsts
+        return_type = call.return_type
 
         dirty_dsts = set()
 
@@ -129,8 +527,24 @@ class Database:
                 all_dsts.update(return_dsts)
                 # Update the active file list.
                 self.active_files.update(all_srcs | all_dsts)
+                self._count_call(fun_name, hits=1)
+                call.call_id = call_id
                 return old_result, all_srcs, all_dsts
 
+        # New calls have dirty source files too, so only count the first
+        # reason.
+        if fun_dirty:
+            reason = 'function'
+        elif call_dirty:
+            reason = 'arguments'
+        elif call_file_digests:
+            reason = 'srcs'
+        elif external_digests:
+            reason = 'external srcs'
+        else:
+            reason = 'dsts'
+        self._count_call(fun_name, reason=reason)
+
         if self._explain:
             # Explain why we are going to run the function.
             if fun_dirty:
@@ -156,23 +570,45 @@ class Database:
                 for dst in dirty_dsts:
                     self._ctx.logger.log('\t%s' % dst)
 
+        return None
+
+    def _run_call(self, call, prepared):
+        """Run the dirty call. Returns the arguments for the backend's cache
+        method, and the result, src dependencies and dst dependencies of the
+        call."""
+
+        fun_dirty, fun_id, call_dirty, call_id, old_result, call_file_digests, \
+            external_srcs, external_dsts, external_digests = prepared
+
+        srcs = call.srcs
+        dsts = call.dsts
+        return_type = call.return_type
+
         # Clear external srcs and dsts since they'll be recomputed inside
         # the function.
         external_srcs = set()
         external_dsts = set()
 
-        # The call was dirty, so recompute it.
-        call_result = function(*args, **kwargs)
+        # The call was dirty, so recompute it. This includes the time spent in
+        # any nested calls.
+        running = _RunningCall()
+        token = _running_call.set(running)
+        start = time.perf_counter()
+        try:
+            call_result = call.function(*call.args, **call.kwargs)
+        finally:
+            _running_call.reset(token)
+        self._count_call(call.fun_name, body_time=time.perf_counter() - start)
 
         # Make sure the result is not a generator.
         assert not fbuild.inspect.isgenerator(call_result), \
             "Cannot store generator in database"
 
-        # Save the results in the database.
-        self._rpc.call(self._backend.cache,
-            fun_dirty, fun_id, fun_name, fun_digest,
-            call_id, call_bound, call_result,
-            call_file_digests, external_srcs, external_dsts)
+        cache_args = (
+            fun_dirty, fun_id, call.fun_name, call.fun_digest,
+            call_id, call.call_bound, call.bound_digest, call_result,
+            call_file_digests, external_srcs, external_dsts,
+            float(sum(running.durations)), frozenset(running.children))
 
         if return_type is not None and issubclass(return_type, fbuild.db.DST):
             return_dsts = return_type.convert(call_result)
@@ -182,9 +618,37 @@ class Database:
         all_srcs = srcs.union(external_srcs)
         all_dsts = dsts.union(external_dsts)
         all_dsts.update(return_dsts)
+        # The call wrote to the dsts, so they need to be checked again.
+        self._forget_files(all_dsts)
         # Update the active file list.
         self.active_files.update(all_srcs | all_dsts)
-        return call_result, all_srcs, all_dsts
+        return cache_args, (call_result, all_srcs, all_dsts)
+
+    def _count_call(self, fun_name, *, hits=0, reason=None,
+            prepare_time=0.0, body_time=0.0, cache_time=0.0):
+        """Add to the counters and timings of the function."""
+
+        with self._call_stats_lock:
+            try:
+                stats = self._call_stats[fun_name]
+            except KeyError:
+                stats = self._call_stats[fun_name] = _CallStats()
+
+            stats.hits += hits
+            if reason is not None:
+                stats.misses[reason] += 1
+            stats.prepare_time += prepare_time
+            stats.body_time += body_time
+            stats.cache_time += cache_time
+
+    def find_call_stats(self):
+        """Returns a dictionary of the hits, misses by reason and the time
+        spent preparing, running and caching the calls of each function during
+        this build, keyed by the function name. Times are in seconds."""
+
+        with self._call_stats_lock:
+            return {fun_name: stats.to_json()
+                for fun_name, stats in self._call_stats.items()}
 
     def delete_function(self, fun_name):
         """Delete the function from the database."""
@@ -196,8 +660,76 @@ class Database:
 
         return self._rpc.call(self._backend.delete_file, file_name)
 
+    def collect_garbage(self, keep_builds=0):
+        """Delete the calls and files that weren't used during this build or
+        the I{keep_builds} builds before it, and compact the database. Returns
+        the number of calls and files that were deleted."""
+
+        # The call ids we've remembered may not be valid anymore.
+        with self._memo_lock:
+            self._memo.clear()
+            self._memo_srcs.clear()
+
+        return self._rpc.call(self._backend.collect_garbage, keep_builds)
+
+    def find_durations(self, tasks):
+        """Returns how long the commands of each cached function took to run
+        the last time it was called with the source, or None if we don't
+        know. The tasks are pairs of a function, which may be wrapped in
+        L{functools.partial}, and a source. They're all looked up in one round
+        trip to the backend."""
+
+        return self._rpc.call(self._backend.find_durations,
+            [self._find_duration_key(function, (src,), {})
+                for function, src in tasks])
+
+    def _find_duration_key(self, function, args, kwargs):
+        """Returns the function name and the digest of the arguments of the
+        cached function, or None if the function isn't cached."""
+
+        # Unwrap the function until we get to the function that's cached.
+        while True:
+            if isinstance(function, functools.partial):
+                args = function.args + args
+                kwargs = dict(function.keywords, **kwargs)
+                function = function.func
+            elif fbuild.inspect.ismethod(function) and \
+                    function.__name__ == 'call' and \
+                    isinstance(function.__self__, (
+                        fbuild.db.caches,
+                        fbuild.db.cachemethod_wrapper)):
+                function = function.__self__
+            elif isinstance(function, fbuild.db.caches):
+                function = function.function
+                break
+            elif isinstance(function, fbuild.db.cachemethod_wrapper):
+                function = function.method
+                break
+            else:
+                # The function isn't cached, so we haven't timed it.
+                return None
+
+        fun_name, function, args, kwargs = self._find_function_name(
+            function,
+            args,
+            kwargs)
+
+        try:
+            bound = fbuild.functools.bind_args(function, args, kwargs)
+        except TypeError:
+            return None
+
+        return fun_name, fbuild.db.backend.digest_bound(self._ctx, bound)
+
+    def find_call_durations(self):
+        """Returns a list of the function name and duration of every timed
+        call."""
+
+        return list(self._rpc.call(self._backend.find_call_durations))
+
     def dump_database(self):
         """Print the database."""
+        import pprint
         pprint.pprint(self._backend.__dict__)
 
     def _find_function_name(self, function, args, kwargs):
@@ -227,21 +759,26 @@ class Database:
         return fun_name, function, args, kwargs
 
     # Create an in-process cache of the function digests, since they shouldn't
-    # change while we're running.
+    # change while we're running. Only filling in the cache takes the lock.
     _digest_function_lock = threading.Lock()
     _digest_function_cache = {}
     def _digest_function(self, function, args, kwargs):
         """Compute the digest for a function or a function object. Cache this
         for this instance."""
-        with self._digest_function_lock:
-            # If we're caching a PersistentObject creation, use the class's
-            # __init__ as our function.
-            if fbuild.inspect.isroutine(function) and \
-                    len(args) > 0 and \
-                    function.__name__ == '__call_super__' and \
-                    isinstance(args[0], fbuild.db.PersistentMeta):
-                function = args[0].__init__
+        # If we're caching a PersistentObject creation, use the class's
+        # __init__ as our function.
+        if fbuild.inspect.isroutine(function) and \
+                len(args) > 0 and \
+                function.__name__ == '__call_super__' and \
+                isinstance(args[0], fbuild.db.PersistentMeta):
+            function = args[0].__init__
+
+        try:
+            return self._digest_function_cache[function]
+        except KeyError:
+            pass
 
+        with self._digest_function_lock:
             try:
                 digest = self._digest_function_cache[function]
             except KeyError:
@@ -249,8 +786,7 @@ class Database:
                     # The function is a function, method, or lambda, so digest
                     # the source. If the function is a builtin, we will raise
                     # an exception.
-                    src = fbuild.inspect.getsource(function)
-                    digest = hashlib.md5(src.encode()).hexdigest()
+                    digest = self._digest_source(function)
                 else:
                     # The function is a functor so let it digest itself.
                     digest = hash(function)
@@ -258,6 +794,63 @@ class Database:
 
         return digest
 
+    def _digest_source(self, function):
+        """Digest the source of the function. The digests are saved in the
+        database by the path, mtime and size of the function's module, so we
+        only read the source again when the module changes."""
+        try:
+            code = function.__code__
+        except AttributeError:
+            path = None
+        else:
+            # Lambdas on the same line would share a key.
+            if function.__name__ == '<lambda>':
+                path = None
+            else:
+                path = code.co_filename
+            key = '%s:%d' % (function.__qualname__, code.co_firstlineno)
+
+        if path is not None:
+            try:
+                identity = self._module_identities[path]
+            except KeyError:
+                try:
+                    st = fbuild.path.Path(path).stat()
+                except OSError:
+                    identity = None
+                else:
+                    identity = (st.st_mtime_ns, st.st_size)
+                self._module_identities[path] = identity
+
+            if identity is None:
+                path = None
+            else:
+                try:
+                    old_identity, digests = self._source_digests[path]
+                except KeyError:
+                    pass
+                else:
+                    if tuple(old_identity) == identity and key in digests:
+                        return digests[key]
+
+        src = fbuild.inspect.getsource(function)
+        digest = hashlib.md5(src.encode()).hexdigest()
+
+        if path is not None:
+            try:
+                old_identity, digests = self._source_digests[path]
+            except KeyError:
+                old_identity = None
+
+            if old_identity is None or tuple(old_identity) != identity:
+                digests = {}
+                self._source_digests[path] = (identity, digests)
+
+            digests[key] = digest
+            self._dirty_source_paths.add(path)
+
+        return digest
+
     def _find_call_filenames(self, function, args, kwargs):
         """Return the filenames needed for the function."""
 
@@ -284,6 +877,9 @@ class Database:
         a cached function and will error out if it is called from an
         uncached function."""
 
+        # The call wrote to the dsts, so they need to be checked again.
+        self._forget_files(dsts)
+
         # Hack in additional dependencies
         frame = fbuild.inspect.currentframe()
 
@@ -293,8 +889,17 @@ class Database:
         frame = frame.f_back
 
         while frame:
-            if frame.f_code == self.call.__code__:
+            if frame.f_code == self._run_call.__code__:
                 frame.f_locals['external_srcs'].update(srcs)
                 frame.f_locals['external_dsts'].update(dsts)
 
             frame = frame.f_back
+
+    def add_duration_to_call(self, duration):
+        """When inside a cached method, add the duration of a command to the
+        innermost call. This does nothing if it is called from an uncached
+        function."""
+
+        running = _running_call.get()
+        if running is not None:
+            running.durations.append(duration)
@@ -0,0 +1,681 @@
+import struct
+import threading
+
+import fbuild.db.backend
+import fbuild.db.cache_backend
+import fbuild.db.pickle_backend
+import fbuild.path
+
+# ------------------------------------------------------------------------------
+
+class LogBackend(fbuild.db.pickle_backend.PickleBackend):
+    """A pickle backend that saves the database as a log of records, so that
+    only the records that changed during the build are appended to the state
+    file when it's closed. Each record is pickled on its own, and the records
+    of a function are only unpickled when the function is first used.
+
+    The log has these kinds of records, keyed by a function or file name.
+    Since the file names may be subclasses of str that compare differently,
+    like libraries, the file records also hold the real file name:
+
+        f: the function's digest, which replaces all of its previous records
+        x: the function was deleted
+        c: one call of a function, keyed by its name and call index
+        p: the identity and digest of a file
+        r: the file was deleted
+        o: the state of a PersistentObject, keyed by its digest
+        s: the source digests of the functions in a module, keyed by its path
+        u: the number of a build, and the calls and files it used that the
+           build before it didn't, which is merged into the previous records
+        v: the version of the digests that the calls are indexed by, which is
+           the first record of the log
+
+    When most of the log is made up of replaced records, it's compacted in a
+    background thread while the build runs.
+    """
+
+    MAGIC = b'fbuild-log\x001\n'
+    HEADER = struct.Struct('<cII')
+
+    # Only bother compacting logs at least this big, and only when less than
+    # this fraction of the log is still live.
+    COMPACT_SIZE = 1 << 20
+    COMPACT_RATIO = 0.5
+
+    def connect(self, filename):
+        """Index the records in the log file."""
+
+        self._file_name = fbuild.path.Path(filename)
+        self._data = b''
+        self._log_size = 0
+        self._function_records = {}
+        self._file_records = {}
+        self._object_records = {}
+        self._object_states = {}
+        self._new_objects = []
+        self._source_records = {}
+        self._use_records = []
+        self._version_record = None
+        self._function_resets = {}
+        self._file_deletes = {}
+        self._dirty_sources = set()
+        self._reset_functions = set()
+        self._dirty_calls = set()
+        self._dirty_files = set()
+        self._rewrite = False
+        self._compact_thread = None
+        self._compacted = None
+
+        if self._file_name.exists():
+            with open(self._file_name, 'rb') as f:
+                self._data = f.read()
+
+            if not self._data.startswith(self.MAGIC):
+                # This is a state file from the pickle backend, so load all of
+                # it and write it back out as a log when we close.
+                super().connect(filename)
+                self._data = b''
+                self._rewrite = True
+                return
+
+        fbuild.db.cache_backend.CacheBackend.connect(self)
+
+        if self._data:
+            self._scan()
+
+            self._build, self._call_builds, self._file_builds = \
+                self._load_uses(self._data, self._use_records,
+                    self._function_resets, self._file_deletes)
+
+            # This is the build after the one that was saved.
+            self._build += 1
+
+            # Logs from before we recorded the version used the first one.
+            version = 1
+            if self._version_record is not None:
+                kind, key, pos, start, end = self._version_record
+                version = fbuild.db.backend.pickle_loads(self._ctx,
+                    self._data[start:end])
+
+            if version != fbuild.db.backend.DIGEST_VERSION:
+                # The calls need to be indexed by the new digests, which we
+                # can only do by loading all of them and writing them out
+                # again.
+                self._load_all()
+                self._index_calls()
+                self._rewrite = True
+
+            self._compact_thread = threading.Thread(
+                target=self._compact,
+                args=(
+                    self._data,
+                    dict(self._function_records),
+                    dict(self._file_records),
+                    dict(self._object_records),
+                    dict(self._source_records),
+                    self._version_record,
+                    list(self._use_records),
+                    dict(self._function_resets),
+                    dict(self._file_deletes)))
+            self._compact_thread.daemon = True
+            self._compact_thread.start()
+
+
+    def close(self):
+        """Append the records that changed to the log file."""
+
+        if self._rewrite:
+            # Write every record into a new log.
+            self._reset_functions = set(self._functions)
+            self._dirty_files = set(self._files)
+            self._dirty_sources.update(self._source_digests)
+
+        frames = self._dump()
+
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+
+        if self._rewrite or self._compacted is not None:
+            if self._rewrite:
+                # We don't need the compacted log since we're writing
+                # everything anyway.
+                if self._compacted is not None:
+                    fbuild.path.Path(self._compacted).remove()
+
+                tmp = self._file_name + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(self.MAGIC)
+                    f.writelines(frames)
+            else:
+                tmp = self._compacted
+                with open(tmp, 'ab') as f:
+                    f.writelines(frames)
+
+            self._replace_state_file(tmp)
+        elif frames or not self._data:
+            if self._data:
+                f = open(self._file_name, 'r+b')
+            else:
+                f = open(self._file_name, 'wb')
+
+            with f:
+                if self._data:
+                    # Drop anything left over from a save that was
+                    # interrupted.
+                    f.seek(self._log_size)
+                    f.truncate()
+                else:
+                    f.write(self.MAGIC)
+
+                f.writelines(frames)
+
+        self._data = b''
+
+    # --------------------------------------------------------------------------
+
+    def _scan(self):
+        """Index the records in the log by their function or file name,
+        without unpickling them."""
+
+        data = self._data
+        pos = len(self.MAGIC)
+
+        while pos + self.HEADER.size <= len(data):
+            kind, key_size, payload_size = self.HEADER.unpack_from(data, pos)
+
+            start = pos + self.HEADER.size
+            end = start + key_size + payload_size
+
+            # The last save was interrupted, so ignore the partial record.
+            if end > len(data):
+                break
+
+            key = data[start:start + key_size]
+            record = (kind, key, pos, start + key_size, end)
+
+            if kind in (b'f', b'x'):
+                self._function_records[key] = [record]
+                self._function_resets[key] = pos
+            elif kind == b'c':
+                fun_name = key.rsplit(b'\0', 1)[0]
+                self._function_records.setdefault(fun_name, []).append(record)
+            elif kind == b'o':
+                self._object_records[key] = record
+            elif kind == b's':
+                self._source_records[key] = record
+            elif kind == b'u':
+                self._use_records.append(record)
+            elif kind == b'v':
+                self._version_record = record
+            else:
+                if kind == b'r':
+                    self._file_deletes[key] = pos
+                self._file_records.setdefault(key, []).append(record)
+
+            pos = end
+
+        self._log_size = pos
+
+
+    def _load_uses(self, data, use_records, function_resets, file_deletes):
+        """Merge the use records into the number of the last build and the
+        builds that last used each call and file. A record doesn't mark the
+        calls of a function that was reset after it, since the new calls reuse
+        the call indices, nor the files that were deleted after it."""
+
+        build = 0
+        call_builds = {}
+        file_builds = {}
+
+        for kind, key, pos, start, end in use_records:
+            record_build, record_calls, record_files = \
+                fbuild.db.backend.pickle_loads(self._ctx, data[start:end])
+
+            build = max(build, record_build)
+
+            for fun_name, builds in record_calls.items():
+                if function_resets.get(fun_name.encode('utf-8'), -1) < pos:
+                    call_builds.setdefault(fun_name, {}).update(builds)
+
+            for file_name, file_build in record_files.items():
+                if file_deletes.get(file_name.encode('utf-8'), -1) < pos:
+                    file_builds[file_name] = file_build
+
+        return build, call_builds, file_builds
+
+
+    def _compact(self, data, function_records, file_records, object_records,
+            source_records, version_record, use_records, function_resets,
+            file_deletes):
+        """Write the live records of the log into a new file if enough of the
+        log has been replaced. This only reads the log as it was when we
+        connected, so it's safe to run while the build uses the database."""
+
+        if len(data) < self.COMPACT_SIZE:
+            return
+
+        live = []
+        for records in function_records.values():
+            if records[0][0] == b'x':
+                continue
+
+            calls = {}
+            for record in records:
+                calls[record[1]] = record
+            live.extend(calls.values())
+
+        for records in file_records.values():
+            files = {}
+            for record in records:
+                kind, key, pos, start, end = record
+                obj = fbuild.db.backend.pickle_loads(self._ctx, data[start:end])
+                if kind == b'p':
+                    files[obj[0]] = record
+                else:
+                    files.pop(obj, None)
+            live.extend(files.values())
+
+        # We'd have to unpickle every call to find out which objects are
+        # still used, so just keep all of them.
+        live.extend(object_records.values())
+        live.extend(source_records.values())
+
+        if version_record is not None:
+            live.append(version_record)
+
+        live.sort(key=lambda record: record[2])
+
+        size = sum(end - pos for kind, key, pos, start, end in live)
+        if size > len(data) * self.COMPACT_RATIO:
+            return
+
+        # Fold the use records into one, which goes last so that it marks the
+        # calls of every function.
+        uses = None
+        if use_records:
+            uses = self._frame(b'u', '', fbuild.db.backend.pickle_dumps(
+                self._ctx,
+                self._load_uses(data, use_records, function_resets,
+                    file_deletes)))
+
+        tmp = self._file_name + '.compact'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self.MAGIC)
+                for kind, key, pos, start, end in live:
+                    f.write(data[pos:end])
+
+                if uses is not None:
+                    f.write(uses)
+        except OSError:
+            return
+
+        self._compacted = tmp
+
+
+    def _frame(self, kind, key, payload=b''):
+        """Create a record for the log."""
+
+        key = key.encode('utf-8')
+
+        return self.HEADER.pack(kind, len(key), len(payload)) + key + payload
+
+
+    def _dump(self):
+        """Returns the records of everything that changed during this
+        build."""
+
+        frames = []
+
+        # A new log starts with the version of its digests.
+        if self._rewrite or not self._data:
+            frames.append(self._frame(b'v', '',
+                fbuild.db.backend.pickle_dumps(self._ctx,
+                    fbuild.db.backend.DIGEST_VERSION)))
+
+        for fun_name in sorted(self._reset_functions):
+            try:
+                fun_digest = self._functions[fun_name]
+            except KeyError:
+                frames.append(self._frame(b'x', fun_name))
+            else:
+                frames.append(self._frame(b'f', fun_name,
+                    fbuild.db.backend.pickle_dumps(self._ctx, fun_digest)))
+
+                # The record replaced all of the function's calls, so write
+                # them out again.
+                self._dirty_calls.update((fun_name, call_index)
+                    for call_index in range(len(
+                        self._function_calls.get(fun_name, ()))))
+
+        if self._dirty_calls:
+            # Gather the call files of the calls we're writing.
+            call_files = {}
+            for file_name, functions in self._call_files.items():
+                for fun_name, digests in functions.items():
+                    for call_index, file_digest in digests.items():
+                        if (fun_name, call_index) in self._dirty_calls:
+                            call_files.setdefault((fun_name, call_index), {})[
+                                file_name] = file_digest
+
+            digests = {}
+            for fun_name in {fun_name for fun_name, _ in self._dirty_calls}:
+                digests[fun_name] = {call_index: digest for digest, call_index
+                    in self._call_indices.get(fun_name, {}).items()}
+
+            for fun_name, call_index in sorted(self._dirty_calls):
+                # Skip the calls of functions that were deleted.
+                try:
+                    bound, result = self._function_calls[fun_name][call_index]
+                except (KeyError, IndexError):
+                    continue
+
+                call_id = (fun_name, call_index)
+                frames.append(self._frame(
+                    b'c',
+                    '%s\0%d' % call_id,
+                    self.dumps((
+                        digests[fun_name].get(call_index),
+                        bound,
+                        result,
+                        self.find_external_srcs(call_id),
+                        self.find_external_dsts(call_id),
+                        self.find_call_duration(call_id),
+                        call_files.get(call_id, {}),
+                        self.find_call_children(call_id),
+                    ))))
+
+        for file_name in self._dirty_files:
+            try:
+                file_state = self._files[file_name]
+            except KeyError:
+                frames.append(self._frame(b'r', file_name,
+                    fbuild.db.backend.pickle_dumps(self._ctx, file_name)))
+            else:
+                frames.append(self._frame(b'p', file_name,
+                    fbuild.db.backend.pickle_dumps(self._ctx,
+                        (file_name, file_state))))
+
+        for path in self._dirty_sources:
+            frames.append(self._frame(b's', path,
+                fbuild.db.backend.pickle_dumps(self._ctx,
+                    self._source_digests[path])))
+
+        uses = self._dump_uses()
+        if uses is not None:
+            frames.append(self._frame(b'u', '',
+                fbuild.db.backend.pickle_dumps(self._ctx, uses)))
+
+        # Write the objects the calls refer to before the calls.
+        object_frames = [
+            self._frame(b'o', digest, self._object_states[digest])
+            for digest in self._new_objects]
+        self._new_objects = []
+
+        return object_frames + frames
+
+    def _dump_uses(self):
+        """Returns the use record of this build, or None if it only used the
+        calls and files that the last build used, in which case it's counted
+        as the same build."""
+
+        if self._rewrite:
+            # The new log needs all of the uses.
+            self._save_uses()
+            return self._build, self._call_builds, self._file_builds
+
+        call_builds = {}
+        for fun_name, call_index in self._used_calls:
+            # Skip the calls of functions that were deleted since.
+            if call_index < len(self._function_calls.get(fun_name, ())):
+                call_builds.setdefault(fun_name, {})[call_index] = self._build
+
+        file_builds = {file_name: self._build
+            for file_name in self._used_files if file_name in self._files}
+
+        last_build = self._build - 1
+        changed = \
+            any(self._call_builds.get(fun_name, {}).get(call_index) !=
+                    last_build
+                for fun_name, builds in call_builds.items()
+                for call_index in builds) or \
+            any(self._file_builds.get(file_name) != last_build
+                for file_name in file_builds)
+
+        self._save_uses()
+
+        if not changed:
+            return None
+
+        return self._build, call_builds, file_builds
+
+    # --------------------------------------------------------------------------
+
+    def _load_function(self, fun_name):
+        """Unpickle the records of the function if we haven't yet."""
+
+        try:
+            records = self._function_records.pop(fun_name.encode('utf-8'))
+        except KeyError:
+            return
+
+        calls = {}
+        for kind, key, pos, start, end in records:
+            if kind == b'f':
+                self._functions[fun_name] = fbuild.db.backend.pickle_loads(
+                    self._ctx, self._data[start:end])
+            elif kind == b'c':
+                calls[int(key.rsplit(b'\0', 1)[1])] = (start, end)
+
+        if fun_name not in self._functions:
+            return
+
+        datas = self._function_calls[fun_name] = []
+        indices = self._call_indices[fun_name] = {}
+
+        for call_index in sorted(calls):
+            start, end = calls[call_index]
+
+            record = self.loads(self._data[start:end])
+
+            # Older logs didn't record the calls that each call made.
+            if len(record) == 7:
+                record += (None,)
+
+            digest, bound, result, srcs, dsts, duration, call_files, \
+                children = record
+
+            assert call_index == len(datas), (fun_name, call_index)
+            datas.append((bound, result))
+
+            if digest is not None:
+                indices[digest] = call_index
+
+            self._external_srcs.setdefault(fun_name, {})[call_index] = srcs
+            self._external_dsts.setdefault(fun_name, {})[call_index] = dsts
+
+            if duration is not None:
+                self._call_durations.setdefault(fun_name, {})[call_index] = \
+                    duration
+
+            for file_name, file_digest in call_files.items():
+                self._call_files. \
+                    setdefault(file_name, {}). \
+                    setdefault(fun_name, {})[call_index] = file_digest
+
+            if children is not None:
+                self._call_children.setdefault(fun_name, {})[call_index] = \
+                    children
+
+
+    def _load_file(self, file_name):
+        """Unpickle the record of the file if we haven't yet."""
+
+        try:
+            records = self._file_records.pop(file_name.encode('utf-8'))
+        except KeyError:
+            return
+
+        for kind, key, pos, start, end in records:
+            obj = fbuild.db.backend.pickle_loads(
+                self._ctx, self._data[start:end])
+
+            if kind == b'p':
+                self._files[obj[0]] = obj[1]
+            else:
+                self._files.pop(obj, None)
+
+    def _load_all(self):
+        """Unpickle every record, so that they can be written into a new
+        log."""
+
+        for fun_name in list(self._function_records):
+            self._load_function(fun_name.decode('utf-8'))
+
+        for file_name in list(self._file_records):
+            self._load_file(file_name.decode('utf-8'))
+
+        for key, (kind, _, pos, start, end) in self._object_records.items():
+            digest = key.decode('utf-8')
+            if digest not in self._object_states:
+                self._object_states[digest] = self._data[start:end]
+                self._new_objects.append(digest)
+
+        self.find_source_digests()
+
+    # --------------------------------------------------------------------------
+
+    def collect_garbage(self, keep_builds=0):
+        """Delete the calls and files that weren't used recently, and write a
+        new log without them when we close."""
+
+        # Load everything, since we're going to write it all out again.
+        self._load_all()
+        self._rewrite = True
+
+        return super().collect_garbage(keep_builds)
+
+    # --------------------------------------------------------------------------
+
+    def find_source_digests(self):
+        for kind, key, pos, start, end in self._source_records.values():
+            self._source_digests.setdefault(key.decode('utf-8'),
+                fbuild.db.backend.pickle_loads(self._ctx,
+                    self._data[start:end]))
+        self._source_records = {}
+
+        return super().find_source_digests()
+
+
+    def save_source_digests(self, digests):
+        self._dirty_sources.update(digests)
+        return super().save_source_digests(digests)
+
+
+    def find_object(self, digest):
+        try:
+            return self._object_states[digest]
+        except KeyError:
+            pass
+
+        try:
+            kind, key, pos, start, end = \
+                self._object_records[digest.encode('utf-8')]
+        except KeyError:
+            return None
+
+        return self._data[start:end]
+
+
+    def save_object(self, digest, state):
+        self._object_states[digest] = state
+        self._new_objects.append(digest)
+
+
+    def find_function(self, fun_name):
+        self._load_function(fun_name)
+        return super().find_function(fun_name)
+
+
+    def save_function(self, fun_id, fun_name, fun_digest):
+        self._load_function(fun_name)
+        self._reset_functions.add(fun_name)
+        return super().save_function(fun_id, fun_name, fun_digest)
+
+
+    def delete_function(self, fun_name):
+        self._load_function(fun_name)
+        self._reset_functions.add(fun_name)
+        self._dirty_calls = {call_id for call_id in self._dirty_calls
+            if call_id[0] != fun_name}
+        return super().delete_function(fun_name)
+
+
+    def find_call(self, fun_id, bound, bound_digest):
+        self._load_function(fun_id)
+        return super().find_call(fun_id, bound, bound_digest)
+
+
+    def save_call(self, call_id, fun_id, bound, bound_digest, result):
+        self._load_function(fun_id)
+        call_id = super().save_call(call_id, fun_id, bound, bound_digest,
+            result)
+        self._dirty_calls.add(call_id)
+        return call_id
+
+
+    def find_durations(self, calls):
+        for call in calls:
+            if call is not None:
+                self._load_function(call[0])
+
+        return super().find_durations(calls)
+
+
+    def find_call_durations(self):
+        # We need every function to find all of the durations.
+        for fun_name in list(self._function_records):
+            self._load_function(fun_name.decode('utf-8'))
+
+        return super().find_call_durations()
+
+
+    def save_call_duration(self, call_id, duration):
+        self._dirty_calls.add(call_id)
+        return super().save_call_duration(call_id, duration)
+
+
+    def save_call_children(self, call_id, children):
+        self._dirty_calls.add(call_id)
+        return super().save_call_children(call_id, children)
+
+
+    def save_call_file(self, call_id, file_id, file_digest):
+        self._dirty_calls.add(call_id)
+        return super().save_call_file(call_id, file_id, file_digest)
+
+
+    def save_external_files(self, call_id, srcs, dsts):
+        self._dirty_calls.add(call_id)
+        return super().save_external_files(call_id, srcs, dsts)
+
+
+    def find_file(self, file_name):
+        self._load_file(file_name)
+        return super().find_file(file_name)
+
+
+    def save_file(self, file_id, file_name, file_identity, file_digest):
+        self._load_file(file_name)
+        self._dirty_files.add(file_name)
+        return super().save_file(file_id, file_name, file_identity,
+            file_digest)
+
+
+    def delete_file(self, file_name):
+        # The call files of the functions we haven't loaded yet will still
+        # have the old digest of the file, but that's fine since the digest
+        # won't match if the file really changed.
+        self._load_file(file_name)
+        self._dirty_files.add(file_name)
+        return super().delete_file(file_name)
@@ -16,9 +16,43 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
             with open(self._file_name, 'rb') as f:
                 unpickler = fbuild.db.backend.Unpickler(self._ctx, f)
 
+                tables = unpickler.load()
+
+                # Older state files don't have the call durations, the call
+                # indices, the source digests, the builds that used the
+                # calls and files, the calls that each call made, or the
+                # version of the digests the calls are indexed by.
+                if len(tables) == 6:
+                    tables += ({},)
+
+                if len(tables) == 7:
+                    tables += (None,)
+
+                if len(tables) == 8:
+                    tables += ({},)
+
+                if len(tables) == 9:
+                    tables += (0, {}, {})
+
+                if len(tables) == 12:
+                    tables += ({},)
+
+                if len(tables) == 13:
+                    tables += (1,)
+
                 self._functions, self._function_calls, self._files, \
                     self._call_files, self._external_srcs, \
-                    self._external_dsts = unpickler.load()
+                    self._external_dsts, self._call_durations, \
+                    self._call_indices, self._source_digests, \
+                    self._build, self._call_builds, self._file_builds, \
+                    self._call_children, digest_version = tables
+
+                if self._call_indices is None or \
+                        digest_version != fbuild.db.backend.DIGEST_VERSION:
+                    self._index_calls()
+
+                # This is the build after the one that was saved.
+                self._build += 1
         else:
             super().connect()
 
@@ -26,6 +60,8 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
     def close(self):
         """Save the database to the file."""
 
+        self._save_uses()
+
         f = io.BytesIO()
         pickler = fbuild.db.backend.Pickler(self._ctx, f)
 
@@ -35,7 +71,15 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
             self._files,
             self._call_files,
             self._external_srcs,
-            self._external_dsts))
+            self._external_dsts,
+            self._call_durations,
+            self._call_indices,
+            self._source_digests,
+            self._build,
+            self._call_builds,
+            self._file_builds,
+            self._call_children,
+            fbuild.db.backend.DIGEST_VERSION))
 
         s = f.getvalue()
 
@@ -43,13 +87,20 @@ class PickleBackend(fbuild.db.cache_backend.CacheBackend):
         # someone presses ctrl+c while we're saving, we might corrupt the db.
         # So, we'll write to a temp file, then move the old state file out of
         # the way, then rename the temp file to the filename.
-        path = fbuild.path.Path(self._file_name)
-        tmp = path + '.tmp'
-        old = path + '.old'
+        tmp = fbuild.path.Path(self._file_name + '.tmp')
 
         with open(tmp, 'wb') as f:
             f.write(s)
 
+        self._replace_state_file(tmp)
+
+
+    def _replace_state_file(self, tmp):
+        """Replace the state file with the temp file."""
+
+        path = fbuild.path.Path(self._file_name)
+        old = path + '.old'
+
         if path.exists():
             path.rename(old)
 
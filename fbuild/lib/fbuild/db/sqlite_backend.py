@@ -1,6 +1,7 @@
 import io
-import pickle
 import sqlite3
+import threading
+import urllib.request
 import weakref
 
 import fbuild.db
@@ -10,6 +11,8 @@ import fbuild.path
 # ------------------------------------------------------------------------------
 
 class _ObjectID:
+    """How older databases stored PersistentObjects."""
+
     def __init__(self, cls, state):
         self.cls = cls
         self.state = state
@@ -19,11 +22,31 @@ class _ObjectID:
 class SqliteBackend(fbuild.db.backend.Backend):
     """
     A sqlite-based fbuild backend database.
+
+    With I{concurrent_reads}, the database is switched to WAL journaling and
+    each thread gets its own read-only connection to prepare calls with. Only
+    the calls that need to write to the database have to go through the
+    database thread.
+
+    The layout of the database is versioned with sqlite's user_version, and
+    older databases are migrated when we connect to them.
     """
 
-    def __init__(self, *args, **kwargs):
+    # The version of the database layout.
+    SCHEMA_VERSION = 5
+
+    # How many prepared statements sqlite3 should keep around for each
+    # connection. This needs to be enough to hold every query we make.
+    CACHED_STATEMENTS = 256
+
+    def __init__(self, *args, concurrent_reads=False, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self._concurrent_reads = concurrent_reads
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
         self._pickle_data = io.BytesIO()
         self._pickler = fbuild.db.backend.Pickler(
             self._ctx,
@@ -39,17 +62,77 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         self._file_name = fbuild.path.Path(filename)
 
-        self.conn = sqlite3.connect(self._file_name)
-        self.cursor = self.conn.cursor()
+        self.conn = sqlite3.connect(self._file_name,
+            cached_statements=self.CACHED_STATEMENTS)
+        self._cursor = self.conn.cursor()
+
+        if self._concurrent_reads:
+            self._cursor.execute('PRAGMA journal_mode = WAL')
 
         self._initialize_database()
 
+        # Number this build after the last one that was saved.
+        build, = self.cursor.execute('SELECT MAX(build_id) FROM Build') \
+            .fetchone()
+        self._build = (build or 0) + 1
+
 
     def close(self):
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+
+        # Save whatever was written outside of a cached call, such as the new
+        # identities of files that were rehashed but didn't change.
+        self._save_uses()
+        self.conn.commit()
         self.conn.close()
 
 
+    @property
+    def cursor(self):
+        """The cursor of the current thread's read-only connection while it is
+        preparing a call, otherwise the cursor of the writable connection."""
+        try:
+            return self._local.cursor
+        except AttributeError:
+            return self._cursor
+
+
+    def _reader(self):
+        """Returns the read-only connection of the current thread."""
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+
+        # The connection is only used by this thread, but it's closed by the
+        # database thread. The path has to be quoted, since characters like
+        # '?' and '#' are special in a URI.
+        conn = sqlite3.connect(
+            'file:%s?mode=ro' %
+                urllib.request.pathname2url(self._file_name.abspath()),
+            uri=True,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.CACHED_STATEMENTS)
+
+        with self._readers_lock:
+            self._readers.append(conn)
+
+        self._local.conn = conn
+        return conn
+
+
     def _initialize_database(self):
+        version, = self.cursor.execute('PRAGMA user_version').fetchone()
+
+        if version > self.SCHEMA_VERSION:
+            raise fbuild.Error(
+                '%s has schema version %d, but we only understand up to %d' %
+                (self._file_name, version, self.SCHEMA_VERSION))
+
         self.cursor.executescript('''
             PRAGMA foreign_keys = ON;
 
@@ -57,8 +140,6 @@ class SqliteBackend(fbuild.db.backend.Backend):
                 fun_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 fun_name TEXT UNIQUE,
                 fun_digest TEXT);
-            CREATE INDEX IF NOT EXISTS Function_name_index ON
-                Function (fun_name);
 
             CREATE TABLE IF NOT EXISTS Call (
                 call_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -66,17 +147,44 @@ class SqliteBackend(fbuild.db.backend.Backend):
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
                 call_bound BLOB,
-                call_result BLOB);
-            CREATE INDEX IF NOT EXISTS Call_fun_id_index ON
-                Call (fun_id);
+                call_result BLOB,
+                call_digest TEXT,
+                call_build INTEGER,
+                call_children BLOB);
 
+            CREATE TABLE IF NOT EXISTS CallDuration (
+                call_id INTEGER PRIMARY KEY REFERENCES Call(call_id)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE,
+                call_duration REAL);
+
+            CREATE TABLE IF NOT EXISTS SourceDigest (
+                module_path TEXT,
+                module_mtime INTEGER,
+                module_size INTEGER,
+                fun_key TEXT,
+                fun_digest TEXT,
+                PRIMARY KEY (module_path, fun_key));
+
+            CREATE TABLE IF NOT EXISTS Object (
+                object_digest TEXT PRIMARY KEY,
+                object_state BLOB);
+
+            -- call_build and file_build are the last builds that used the
+            -- call or file, and call_children holds the ids of the cached
+            -- calls that the call made.
+            CREATE TABLE IF NOT EXISTS Build (
+                build_id INTEGER PRIMARY KEY);
+
+            -- file_mtime is the st_mtime_ns of the file.
             CREATE TABLE IF NOT EXISTS File (
                 file_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 file_name TEXT UNIQUE,
                 file_mtime INTEGER,
-                file_digest TEXT);
-            CREATE INDEX IF NOT EXISTS File_name_index ON
-                File (file_name);
+                file_digest TEXT,
+                file_ino INTEGER,
+                file_size INTEGER,
+                file_build INTEGER);
 
             CREATE TABLE IF NOT EXISTS CallFile (
                 call_id INTEGER REFERENCES Call(call_id)
@@ -105,14 +213,265 @@ class SqliteBackend(fbuild.db.backend.Backend):
                     ON DELETE CASCADE
                     ON UPDATE CASCADE,
                 PRIMARY KEY (call_id, file_id));
+
+            -- digest_version is the version of the digests in call_digest.
+            CREATE TABLE IF NOT EXISTS Setting (
+                setting_name TEXT PRIMARY KEY,
+                setting_value);
             ''')
 
+        if version < self.SCHEMA_VERSION:
+            with self.conn:
+                self._migrate_database(version)
+
+        # The primary keys of the call file tables only index them by call, so
+        # we need these to find the calls of a file, or to delete a file
+        # without scanning every table.
+        self.cursor.executescript('''
+            CREATE INDEX IF NOT EXISTS Call_digest_index ON
+                Call (fun_id, call_digest);
+            CREATE INDEX IF NOT EXISTS CallFile_file_id_index ON
+                CallFile (file_id);
+            CREATE INDEX IF NOT EXISTS ExternalSrc_file_id_index ON
+                ExternalSrc (file_id);
+            CREATE INDEX IF NOT EXISTS ExternalDst_file_id_index ON
+                ExternalDst (file_id);
+            ''')
+
+        # Databases from before we recorded the version used the first one.
+        row = self.cursor.execute(
+            'SELECT setting_value FROM Setting WHERE setting_name=?',
+            ('digest_version',)).fetchone()
+        digest_version = 1 if row is None else row[0]
+
+        if digest_version != fbuild.db.backend.DIGEST_VERSION:
+            with self.conn:
+                self._index_calls()
+
+
+    def _index_calls(self):
+        """Index all the calls by the digests of their arguments, and record
+        which version of the digests we used."""
+
+        digests = []
+        for call_id, bound in self.cursor.execute(
+                'SELECT call_id, call_bound FROM Call').fetchall():
+            digests.append((
+                fbuild.db.backend.digest_bound(self._ctx,
+                    self._pickle_loads(bound)),
+                call_id))
+
+        self.cursor.executemany(
+            'UPDATE Call SET call_digest=? WHERE call_id=?',
+            digests)
+
+        self.cursor.execute(
+            'INSERT OR REPLACE INTO Setting VALUES (?,?)',
+            ('digest_version', fbuild.db.backend.DIGEST_VERSION))
+
+
+    def _migrate_database(self, version):
+        """Upgrade a database with an older layout to the current one. Version
+        0 covers every database made before we started versioning them."""
+
+        if version < 2:
+            # Databases made before we indexed the calls by the digest of
+            # their arguments need the new column. The calls without digests
+            # are found by searching through them in find_call.
+            columns = [row[1] for row in
+                self.cursor.execute('PRAGMA table_info(Call)')]
+
+            if 'call_digest' not in columns:
+                self.cursor.execute(
+                    'ALTER TABLE Call ADD COLUMN call_digest TEXT')
+
+            # Likewise, files used to be identified by just their mtime, which
+            # was stored as float seconds. Those files will be rehashed once
+            # since they don't have an inode or size, but convert their mtimes
+            # so that the column only holds integer nanoseconds.
+            columns = [row[1] for row in
+                self.cursor.execute('PRAGMA table_info(File)')]
+
+            if 'file_ino' not in columns:
+                self.cursor.execute(
+                    'ALTER TABLE File ADD COLUMN file_ino INTEGER')
+                self.cursor.execute(
+                    'ALTER TABLE File ADD COLUMN file_size INTEGER')
+
+            self.cursor.execute('''
+                UPDATE File
+                SET file_mtime=CAST(file_mtime * 1000000000 AS INTEGER)
+                WHERE file_ino IS NULL AND file_mtime IS NOT NULL
+                ''')
+
+            # The unique constraints already index these, and the call digest
+            # index covers the function id, so these just slowed down writes.
+            self.cursor.execute('DROP INDEX IF EXISTS Function_name_index')
+            self.cursor.execute('DROP INDEX IF EXISTS File_name_index')
+            self.cursor.execute('DROP INDEX IF EXISTS Call_fun_id_index')
+
+        if version < 3:
+            # Record which builds used the calls and files so that we can
+            # garbage collect them. Anything saved before this is treated as
+            # being used by build 0.
+            columns = [row[1] for row in
+                self.cursor.execute('PRAGMA table_info(Call)')]
+
+            if 'call_build' not in columns:
+                self.cursor.execute(
+                    'ALTER TABLE Call ADD COLUMN call_build INTEGER')
+
+            columns = [row[1] for row in
+                self.cursor.execute('PRAGMA table_info(File)')]
+
+            if 'file_build' not in columns:
+                self.cursor.execute(
+                    'ALTER TABLE File ADD COLUMN file_build INTEGER')
+
+        if version < 4:
+            # Record the calls that each call made, so that the calls made by
+            # a cached call aren't garbage collected. We don't know what the
+            # older calls made, so they're left as NULL.
+            columns = [row[1] for row in
+                self.cursor.execute('PRAGMA table_info(Call)')]
+
+            if 'call_children' not in columns:
+                self.cursor.execute(
+                    'ALTER TABLE Call ADD COLUMN call_children BLOB')
+
+        # Version 5 added the Setting table, which we've already created.
+
+        self.cursor.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+
     # --------------------------------------------------------------------------
 
+    def prepare(self, *args, **kwargs):
+        if not self._concurrent_reads:
+            return super().prepare(*args, **kwargs)
+
+        # Commit right away so the readers can see our changes.
+        with self.conn:
+            return super().prepare(*args, **kwargs)
+
+    def try_prepare(self, *args, **kwargs):
+        return self._try_read(super().prepare, *args, **kwargs)
+
+    def try_find_prefetch_files(self, *args, **kwargs):
+        return self._try_read(super().find_prefetch_files, *args, **kwargs)
+
+    def _try_read(self, function, *args, **kwargs):
+        """Run the function with a reader of this thread. Returns None if we
+        don't have readers, or if the function needs to write."""
+
+        if not self._concurrent_reads:
+            return None
+
+        conn = self._reader()
+        self._local.cursor = conn.cursor()
+        try:
+            # Read from a single snapshot of the database.
+            self.cursor.execute('BEGIN')
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.cursor.execute('COMMIT')
+        except sqlite3.OperationalError:
+            # We tried to write to the database, or it was busy, so the
+            # database thread needs to handle this call.
+            return None
+        finally:
+            del self._local.cursor
+
     def cache(self, *args, **kwargs):
         with self.conn:
             return super().cache(*args, **kwargs)
 
+    def cache_many(self, calls):
+        # Save all the calls in a single transaction.
+        call_ids = []
+        with self.conn:
+            for call in calls:
+                call_ids.append(super().cache(*call))
+
+        return call_ids
+
+    # --------------------------------------------------------------------------
+
+    def _save_uses(self):
+        """Mark the calls and files we used with the number of this build."""
+
+        self.cursor.execute(
+            'INSERT OR IGNORE INTO Build (build_id) VALUES (?)',
+            (self._build,))
+
+        self.cursor.executemany(
+            'UPDATE Call SET call_build=? WHERE call_id=?',
+            [(self._build, call_id) for call_id in self._used_calls])
+
+        self.cursor.executemany(
+            'UPDATE File SET file_build=? WHERE file_name=?',
+            [(self._build, file_name) for file_name in self._used_files])
+
+        self._used_calls.clear()
+        self._used_files.clear()
+
+
+    def collect_garbage(self, keep_builds=0):
+        """Delete the calls and files that weren't used during this build or
+        the I{keep_builds} builds before it, along with the calls they made
+        and the files the calls depend on, and vacuum the database. Returns
+        the number of calls and files that were deleted."""
+
+        oldest = self._build - keep_builds
+
+        with self.conn:
+            self._save_uses()
+
+            used = self.find_reachable_calls(call_id for call_id, in
+                self.cursor.execute(
+                    'SELECT call_id FROM Call WHERE IFNULL(call_build, 0) >= ?',
+                    (oldest,)).fetchall())
+
+            # If we don't know what some of the used calls made, any call
+            # could still be used, so we can only delete files. The call
+            # files, durations and external files of the calls are deleted
+            # along with them.
+            call_count = 0
+            if used is not None:
+                unused = [(call_id,) for call_id, in
+                    self.cursor.execute('SELECT call_id FROM Call').fetchall()
+                    if call_id not in used]
+
+                self.cursor.executemany(
+                    'DELETE FROM Call WHERE call_id=?',
+                    unused)
+                call_count = len(unused)
+
+            # Keep the files that the remaining calls depend on, even if they
+            # weren't checked recently, since deleting them would make the
+            # calls dirty.
+            self.cursor.execute('''
+                DELETE FROM File
+                WHERE IFNULL(file_build, 0) < ?
+                AND file_id NOT IN (SELECT file_id FROM CallFile)
+                AND file_id NOT IN (SELECT file_id FROM ExternalSrc)
+                AND file_id NOT IN (SELECT file_id FROM ExternalDst)
+                ''', (oldest,))
+            file_count = self.cursor.rowcount
+
+            self.cursor.execute('''
+                DELETE FROM Function
+                WHERE fun_id NOT IN (SELECT fun_id FROM Call)
+                ''')
+
+            self.cursor.execute(
+                'DELETE FROM Build WHERE build_id < ?',
+                (oldest,))
+
+        self.cursor.execute('VACUUM')
+
+        return call_count, file_count
+
     # --------------------------------------------------------------------------
 
     def find_function(self, fun_name):
@@ -173,6 +532,10 @@ class SqliteBackend(fbuild.db.backend.Backend):
                 'DELETE FROM Call WHERE call_id=?',
                 (call_id,))
 
+            self.cursor.execute(
+                'DELETE FROM CallDuration WHERE call_id=?',
+                (call_id,))
+
             self.cursor.execute(
                 'DELETE FROM CallFile WHERE call_id=?',
                 (call_id,))
@@ -192,43 +555,13 @@ class SqliteBackend(fbuild.db.backend.Backend):
     # --------------------------------------------------------------------------
 
     def _pickle_dumps(self, obj):
-        def persistent_id(obj):
-            if obj is self._ctx:
-                return b'ctx'
-            else:
-                return None
-
-        f = io.BytesIO()
-        pickler = pickle._Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
-        pickler.persistent_id = persistent_id
-
-        def persist(obj):
-            if isinstance(obj, fbuild.db.PersistentObject):
-                # Make sure all the values are persisted.
-                state = {k: persist(v) for k, v in obj.__dict__.items()}
-                return _ObjectID(obj.__class__, state)
-            else:
-                return obj
-
-        obj = persist(obj)
-        pickler.dump(obj)
-
-        return f.getvalue()
+        return self.dumps(obj)
 
 
     def _pickle_loads(self, value):
-        def persistent_load(pid):
-            if pid == b'ctx':
-                return self._ctx
-            else:
-                raise pickle.UnpicklingError(
-                    'unsupported persistent object: %r'  % pid)
-
-        f = io.BytesIO(value)
-        unpickler = pickle._Unpickler(f)
-        unpickler.persistent_load = persistent_load
-        obj = unpickler.load()
+        obj = self.loads(value)
 
+        # Older databases stored PersistentObjects inline as _ObjectIDs.
         def unpersist(obj):
             if isinstance(obj, _ObjectID):
                 o = object.__new__(obj.cls)
@@ -241,7 +574,7 @@ class SqliteBackend(fbuild.db.backend.Backend):
         return unpersist(obj)
 
 
-    def find_call(self, fun_id, bound):
+    def find_call(self, fun_id, bound, bound_digest):
         """Returns the function call index and result or None if it does not
         exist."""
 
@@ -249,24 +582,35 @@ class SqliteBackend(fbuild.db.backend.Backend):
         assert isinstance(fun_id, int), fun_id
         assert isinstance(bound, dict), bound
 
-        # We've called this before, so search the data to see if we've called
-        # it with the same arguments.
+        # Look up the call with the same digest and make sure it really has
+        # the same arguments.
+        for call_id, old_bound, old_result in self.cursor.execute('''
+                SELECT call_id, call_bound, call_result
+                FROM Call
+                WHERE fun_id=? AND call_digest=?
+                ''', (fun_id, bound_digest)).fetchall():
+            if bound == self._pickle_loads(old_bound):
+                return False, call_id, self._pickle_loads(old_result)
+
+        # Search the calls that were saved without a digest, and add the
+        # digest if we find it.
         for call_id, old_bound, old_result in self.cursor.execute('''
                 SELECT call_id, call_bound, call_result
                 FROM Call
-                WHERE fun_id=?
-                ''', (fun_id,)):
-            old_bound = self._pickle_loads(old_bound)
+                WHERE fun_id=? AND call_digest IS NULL
+                ''', (fun_id,)).fetchall():
+            if bound == self._pickle_loads(old_bound):
+                self.cursor.execute(
+                    'UPDATE Call SET call_digest=? WHERE call_id=?',
+                    (bound_digest, call_id))
 
-            if bound == old_bound:
-                old_result = self._pickle_loads(old_result)
+                return False, call_id, self._pickle_loads(old_result)
 
-                return False, call_id, old_result
-        else:
-            return True, None, None
+        return True, None, None
 
 
-    def save_call(self, call_id, fun_id, call_bound, call_result):
+    def save_call(self, call_id, fun_id, call_bound, bound_digest,
+            call_result):
         """Insert or update the function call."""
 
         # Make sure we got the right types.
@@ -281,12 +625,13 @@ class SqliteBackend(fbuild.db.backend.Backend):
             call_bound = self._pickle_dumps(call_bound)
 
             self.cursor.execute('''
-                INSERT INTO Call (fun_id,call_bound,call_result)
-                VALUES (?,?,?)
+                INSERT INTO Call (fun_id,call_bound,call_result,call_digest)
+                VALUES (?,?,?,?)
                 ''', (
                     fun_id,
                     sqlite3.Binary(call_bound),
-                    sqlite3.Binary(call_result)))
+                    sqlite3.Binary(call_result),
+                    bound_digest))
 
             call_id = self.cursor.lastrowid
         else:
@@ -296,6 +641,147 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
         return call_id
 
+    def find_call_children(self, call_id):
+        """Returns the ids of the cached calls that the call made, or None if
+        we don't know."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, int), call_id
+
+        self.cursor.execute(
+            'SELECT call_children FROM Call WHERE call_id=?',
+            (call_id,))
+
+        rows = self.cursor.fetchall()
+
+        if not rows:
+            return frozenset()
+
+        (call_children,), = rows
+
+        if call_children is None:
+            return None
+
+        return frozenset(fbuild.db.backend.pickle_loads(self._ctx,
+            call_children))
+
+
+    def save_call_children(self, call_id, children):
+        """Replace the ids of the cached calls that the call made."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, int), call_id
+        assert all(isinstance(child, int) for child in children), children
+
+        self.cursor.execute(
+            'UPDATE Call SET call_children=? WHERE call_id=?',
+            (sqlite3.Binary(fbuild.db.backend.pickle_dumps(self._ctx,
+                sorted(children))), call_id))
+
+    # --------------------------------------------------------------------------
+
+    def find_call_duration(self, call_id):
+        """Returns the duration of the call or None if it does not exist."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, int), call_id
+
+        self.cursor.execute(
+            'SELECT call_duration FROM CallDuration WHERE call_id=?',
+            (call_id,))
+
+        rows = self.cursor.fetchall()
+
+        if not rows:
+            return None
+        else:
+            (call_duration,), = rows
+            return call_duration
+
+
+    def find_durations(self, calls):
+        """Returns how long the commands of each call took to run the last
+        time it was called, or None if we don't know."""
+
+        durations = []
+        for call in calls:
+            row = None
+            if call is not None and call[1] is not None:
+                row = self.cursor.execute('''
+                    SELECT call_duration
+                    FROM CallDuration
+                    JOIN Call USING (call_id)
+                    JOIN Function USING (fun_id)
+                    WHERE fun_name=? AND call_digest=?
+                    ''', call).fetchone()
+
+            durations.append(None if row is None else row[0])
+
+        return durations
+
+
+    def find_call_durations(self):
+        """Returns an iterator of the function name and duration of every
+        timed call."""
+
+        return self.cursor.execute('''
+            SELECT fun_name, call_duration
+            FROM CallDuration
+            JOIN Call USING (call_id)
+            JOIN Function USING (fun_id)
+            ''').fetchall()
+
+
+    def save_call_duration(self, call_id, duration):
+        """Insert or update the duration of the call."""
+
+        # Make sure we got the right types.
+        assert isinstance(call_id, int), call_id
+        assert isinstance(duration, float), duration
+
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO CallDuration (call_id,call_duration)
+            VALUES (?,?)
+            ''', (call_id, duration))
+
+    # --------------------------------------------------------------------------
+
+    def find_source_digests(self):
+        """Returns a dictionary of the source digests of the cached functions,
+        keyed by the path of their module."""
+
+        digests = {}
+        for module_path, module_mtime, module_size, fun_key, fun_digest in \
+                self.cursor.execute('''
+                    SELECT module_path,module_mtime,module_size,fun_key,
+                        fun_digest
+                    FROM SourceDigest
+                    ''').fetchall():
+            digests.setdefault(module_path,
+                ((module_mtime, module_size), {}))[1][fun_key] = fun_digest
+
+        return digests
+
+
+    def save_source_digests(self, digests):
+        """Insert or replace the source digests of the modules."""
+
+        with self.conn:
+            for module_path, ((module_mtime, module_size), funs) in \
+                    digests.items():
+                self.cursor.execute(
+                    'DELETE FROM SourceDigest WHERE module_path=?',
+                    (module_path,))
+
+                self.cursor.executemany('''
+                    INSERT INTO SourceDigest
+                        (module_path,module_mtime,module_size,fun_key,
+                        fun_digest)
+                    VALUES (?,?,?,?,?)
+                    ''', ((module_path, module_mtime, module_size, fun_key,
+                            fun_digest)
+                        for fun_key, fun_digest in funs.items()))
+
     # --------------------------------------------------------------------------
 
     def find_call_file(self, call_id, file_id):
@@ -426,12 +912,40 @@ class SqliteBackend(fbuild.db.backend.Backend):
 
     # --------------------------------------------------------------------------
 
-    def find_file(self, file_name):
-        """Returns the mtime and digest of the file, or None if it does not
+    def find_object(self, digest):
+        """Returns the pickled state of the object, or None if it does not
         exist."""
 
+        self.cursor.execute(
+            'SELECT object_state FROM Object WHERE object_digest=?',
+            (digest,))
+
+        rows = self.cursor.fetchall()
+
+        if not rows:
+            return None
+
+        (object_state,), = rows
+
+        return object_state
+
+
+    def save_object(self, digest, state):
+        """Insert the pickled state of the object."""
+
         self.cursor.execute('''
-            SELECT file_id,file_mtime,file_digest
+            INSERT OR IGNORE INTO Object (object_digest,object_state)
+            VALUES (?,?)
+            ''', (digest, state))
+
+    # --------------------------------------------------------------------------
+
+    def find_file(self, file_name):
+        """Returns the identity and digest of the file, or None if it does
+        not exist."""
+
+        self.cursor.execute('''
+            SELECT file_id,file_ino,file_size,file_mtime,file_digest
             FROM File
             WHERE file_name=?
             ''', (file_name,))
@@ -441,30 +955,44 @@ class SqliteBackend(fbuild.db.backend.Backend):
         if not rows:
             return None, None, None
 
-        (file_id, file_mtime, file_digest), = rows
+        (file_id, file_ino, file_size, file_mtime, file_digest), = rows
+
+        if file_ino is None:
+            file_identity = None
+        else:
+            file_identity = (file_ino, file_size, file_mtime)
 
-        return file_id, file_mtime, file_digest
+        return file_id, file_identity, file_digest
 
 
-    def save_file(self, file_id, file_name, file_mtime, file_digest):
+    def save_file(self, file_id, file_name, file_identity, file_digest):
         """Insert or update the file."""
 
         # Make sure we got the right types.
         assert isinstance(file_name, str) or file_id is None, file_name
-        assert isinstance(file_mtime, float), file_mtime
+        assert file_identity is None or isinstance(file_identity, tuple), \
+            file_identity
         assert isinstance(file_digest, str), file_digest
 
+        if file_identity is None:
+            file_ino = file_size = file_mtime = None
+        else:
+            file_ino, file_size, file_mtime = file_identity
+
         if file_id is None:
             self.cursor.execute('''
-                INSERT INTO File (file_name,file_mtime,file_digest)
-                VALUES (?,?,?)
-                ''', (file_name, file_mtime, file_digest))
+                INSERT INTO File
+                    (file_name,file_ino,file_size,file_mtime,file_digest)
+                VALUES (?,?,?,?,?)
+                ''', (file_name, file_ino, file_size, file_mtime, file_digest))
 
             file_id = self.cursor.lastrowid
         else:
-            self.cursor.execute(
-                'UPDATE File SET file_mtime=?, file_digest=? WHERE file_id=?',
-                (file_mtime, file_digest, file_id))
+            self.cursor.execute('''
+                UPDATE File
+                SET file_ino=?, file_size=?, file_mtime=?, file_digest=?
+                WHERE file_id=?
+                ''', (file_ino, file_size, file_mtime, file_digest, file_id))
 
         return file_id
 
@@ -1,6 +1,13 @@
+import time
+_start_time = time.perf_counter()
+
+import builtins
+import collections
+import contextlib
 import os
 import sys
 import signal
+import threading
 
 # Make sure the current working directory is in the search path so we can find
 # the fbuildroot.py.
@@ -12,13 +19,83 @@ import fbuild.target
 import fbuild.path
 import fbuild.context
 import fbuild.options
-import fbuild.builders.file
 
-# If we can't import fbuildroot, save the exception and raise it later.
-try:
-    import fbuildroot
-except ImportError as e:
-    fbuildroot = e
+_import_time = time.perf_counter() - _start_time
+
+# We import the fbuildroot in main() so that --profile-startup can see it.
+fbuildroot = None
+
+def import_fbuildroot():
+    global fbuildroot
+
+    # If we can't import fbuildroot, save the exception and raise it later.
+    try:
+        import fbuildroot
+    except ImportError as e:
+        fbuildroot = e
+
+# ------------------------------------------------------------------------------
+
+class StartupProfiler:
+    """Time every module import and each stage of starting up, much like
+    python's -X importtime, so we can spot what makes fbuild slow to start."""
+
+    def __init__(self):
+        self.imports = []
+        self.stages = [('import fbuild.main', _import_time)]
+        self._local = threading.local()
+        self._import = None
+
+    def install(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+            level=0):
+        # Only time the modules that actually need to be loaded.
+        if level != 0 or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        # Keep track of how long our nested imports took so we can tell how
+        # much time was spent in this module alone.
+        try:
+            stack = self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += total
+            self.imports.append((len(stack), name, total - nested, total))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def report(self, logger):
+        logger.log('%10s %10s  %s' % ('self ms', 'total ms', 'import'))
+        for depth, name, self_time, total in self.imports:
+            logger.log('%10.2f %10.2f  %s%s' %
+                (self_time * 1000, total * 1000, '  ' * depth, name))
+
+        logger.log('%10s  %s' % ('ms', 'stage'))
+        for name, duration in self.stages:
+            logger.log('%10.2f  %s' % (duration * 1000, name))
 
 # ------------------------------------------------------------------------------
 
@@ -61,10 +138,95 @@ def install_files(ctx):
             target = file.removeroot(ctx.buildroot / '').addroot(target_root /
                 froot)
             # Copy the file.
+            import fbuild.builders.file
             fbuild.builders.file.copy(ctx, file, target)
 
 # ------------------------------------------------------------------------------
 
+def estimate(ctx):
+    """Print how long the commands of the cached calls took the last time they
+    ran, and use that to estimate the duration of a full build."""
+
+    totals = collections.defaultdict(float)
+    counts = collections.Counter()
+    longest = 0.0
+
+    for fun_name, duration in ctx.db.find_call_durations():
+        totals[fun_name] += duration
+        counts[fun_name] += 1
+        longest = max(longest, duration)
+
+    if not totals:
+        ctx.logger.log('no call durations have been recorded yet')
+        return
+
+    ctx.logger.log('%-60s %8s %10s' % ('function', 'calls', 'seconds'))
+    for fun_name, total in sorted(totals.items(), key=lambda i: -i[1]):
+        ctx.logger.log('%-60s %8d %10.2f' % (fun_name, counts[fun_name], total))
+
+    # We can't do better than the slowest single call, no matter how many jobs
+    # we have.
+    total = sum(totals.values())
+    threadcount = max(1, ctx.options.threadcount)
+    ctx.logger.log('estimated full build: %.2f sec serial, %.2f sec with %d '
+        'jobs' % (total, max(total / threadcount, longest), threadcount))
+
+# ------------------------------------------------------------------------------
+
+def report_call_stats(ctx):
+    """Print a table of how often the calls of each cached function were
+    cached, why they weren't, and where the time went, and save them as
+    JSON."""
+
+    if not (ctx.options.call_stats or ctx.options.call_stats_file):
+        return
+
+    stats = ctx.db.find_call_stats()
+
+    if ctx.options.call_stats_file:
+        import json
+        with open(ctx.options.call_stats_file, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+
+    if not ctx.options.call_stats:
+        return
+
+    reasons = fbuild.db.database.MISS_REASONS
+    labels = {'function': 'fun', 'arguments': 'args', 'external srcs': 'ext'}
+
+    def total_time(s):
+        return s['prepare_time'] + s['body_time'] + s['cache_time']
+
+    ctx.logger.log('%-60s %6s %6s %s %9s %9s %9s' % (
+        'function', 'hits', 'misses',
+        ' '.join('%6s' % labels.get(reason, reason) for reason in reasons),
+        'prepare', 'body', 'cache'))
+
+    for fun_name, s in sorted(stats.items(), key=lambda i: -total_time(i[1])):
+        ctx.logger.log('%-60s %6d %6d %s %9.3f %9.3f %9.3f' % (
+            fun_name, s['hits'], sum(s['misses'].values()),
+            ' '.join('%6d' % s['misses'][reason] for reason in reasons),
+            s['prepare_time'], s['body_time'], s['cache_time']))
+
+# ------------------------------------------------------------------------------
+
+def load_config(ctx):
+    """Load the configuration test results that were saved with
+    --save-config."""
+
+    if ctx.options.load_config:
+        import fbuild.config
+        fbuild.config.find_results(ctx).load(ctx.options.load_config)
+
+def save_config(ctx):
+    """Save the results of the configuration tests."""
+
+    if ctx.options.save_config:
+        import fbuild.config
+        fbuild.config.find_results(ctx).save(ctx.options.save_config)
+
+# ------------------------------------------------------------------------------
+
 def build(ctx):
     # Exit early if we're just viewing the state.
     if ctx.options.dump_state:
@@ -99,15 +261,37 @@ def build(ctx):
     for target_name in targets:
         if target_name == 'install':
             install_files(ctx)
+        elif target_name == 'estimate':
+            estimate(ctx)
         else:
             target = fbuild.target.find(target_name)
-            target.function(ctx)
+            with ctx.tracer.slice(target_name, 'target'):
+                target.function(ctx)
 
     return 0
 
 # ------------------------------------------------------------------------------
 
 def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    # Start profiling as early as we can, which is before we've even parsed the
+    # arguments.
+    profiler = StartupProfiler()
+    if '--profile-startup' in argv:
+        profiler.install()
+
+    # Put the real import back however we exit.
+    try:
+        return _main(argv, profiler)
+    finally:
+        profiler.uninstall()
+
+def _main(argv, profiler):
+    with profiler.stage('import fbuildroot'):
+        import_fbuildroot()
+
     # Register a couple functions as targets.
     for name in ('configure', 'build'):
         try:
@@ -135,7 +319,8 @@ def main(argv=None):
 
     # --------------------------------------------------------------------------
 
-    ctx = parse_args(sys.argv if argv is None else argv)
+    with profiler.stage('parse arguments'):
+        ctx = parse_args(argv)
 
     # --------------------------------------------------------------------------
     # Replace the ctrl-c signal handler with one that will shut down the
@@ -171,14 +356,26 @@ def main(argv=None):
             return
 
         # Prep the context for running.
-        ctx.create_buildroot()
-        ctx.load_configuration()
+        with profiler.stage('create buildroot'):
+            ctx.create_buildroot()
+        with profiler.stage('load configuration'):
+            ctx.load_configuration()
+
+        # We only care about startup, so report now rather than slowing down
+        # all the imports done by the build.
+        profiler.uninstall()
+        if ctx.options.profile_startup:
+            profiler.report(ctx.logger)
 
         # ... and then run the build.
         try:
+            load_config(ctx)
             result = build(ctx)
+            save_config(ctx)
             if ctx.options.prune:
                 ctx.prune(prune_get_all, prune_get_bad)
+            if ctx.options.gc_state:
+                ctx.gc_state()
         except fbuild.Error as e:
             ctx.logger.log(e, color='red')
             sys.exit(1)
@@ -193,6 +390,10 @@ def main(argv=None):
         finally:
             ctx.save_configuration()
             ctx.db.shutdown()
+            report_call_stats(ctx)
+
+            if ctx.options.trace:
+                ctx.tracer.save(ctx.options.trace)
     finally:
         ctx.scheduler.shutdown()
 
@@ -39,6 +39,18 @@ def make_parser():
             type='int',
             default=1,
             help='Allow N jobs at once'),
+        make_option('--executor',
+            action='store',
+            choices=('thread', 'process'),
+            default='thread',
+            help='run process safe jobs in threads or processes: ' \
+                '(thread, process). thread is the default'),
+        make_option('--schedule',
+            action='store',
+            choices=('lifo', 'critical-path'),
+            default='lifo',
+            help='the order to run ready jobs in: (lifo, critical-path). ' \
+                'lifo is the default'),
         make_option('--nocolor',
             action='store_true',
             default=False,
@@ -52,6 +64,27 @@ def make_parser():
             action='store_true',
             default=False,
             help='force reconfiguration'),
+        make_option('--no-batch-probes',
+            dest='batch_probes',
+            action='store_false',
+            default=True,
+            help='compile each configuration probe on its own instead of ' \
+                'batching the probes of a test together'),
+        make_option('--save-config',
+            action='store',
+            metavar='FILE',
+            help='save the results of the configuration tests to FILE, ' \
+                'keyed by the identity of the compiler'),
+        make_option('--load-config',
+            action='store',
+            metavar='FILE',
+            help='reuse the configuration test results in FILE for the ' \
+                'compilers with the same identity'),
+        make_option('--object-cache',
+            action='store',
+            metavar='DIR',
+            help='reuse the objects compiled by gcc and clang from the ' \
+                'cache in DIR, and add the ones we compile to it'),
         make_option('--buildroot',
             action='store',
             default='build',
@@ -78,6 +111,18 @@ def make_parser():
             action='store_true',
             default=False,
             help='delete all stale files in the build directory'),
+        make_option('--gc-state',
+            action='store_true',
+            default=False,
+            help='delete the calls and files from the state file that were ' \
+                'not used during this build, and compact it'),
+        make_option('--gc-keep-builds',
+            action='store',
+            type='int',
+            default=0,
+            metavar='N',
+            help='with --gc-state, also keep what was used in the last N ' \
+                'builds (default 0)'),
         make_option('--delete-function',
             action='store',
             help='delete cached data for the specified function'),
@@ -94,10 +139,33 @@ def make_parser():
             help='explain why a function was not cached.'),
         make_option('--database-engine',
             action='store',
-            choices=('pickle', 'sqlite', 'cache'),
+            choices=('pickle', 'log', 'sqlite', 'cache'),
             default='pickle',
-            help='which database engine to use: (pickle, sqlite). pickle is ' \
-                'the default'),
+            help='which database engine to use: (pickle, log, sqlite). ' \
+                'pickle is the default'),
+        make_option('--concurrent-reads',
+            action='store_true',
+            default=False,
+            help='check cached calls from the worker threads with their own ' \
+                'read-only connections (sqlite only)'),
+        make_option('--call-stats',
+            action='store_true',
+            default=False,
+            help='print how often the calls of each cached function were ' \
+                'cached, why they were not, and how long they took'),
+        make_option('--call-stats-file',
+            action='store',
+            metavar='FILE',
+            help='save the call statistics to FILE as JSON'),
+        make_option('--trace',
+            action='store',
+            metavar='FILE',
+            help='save a timeline of the targets, cached calls, scheduler ' \
+                'tasks and commands to FILE as trace event JSON'),
+        make_option('--profile-startup',
+            action='store_true',
+            default=False,
+            help='print how long each import and startup stage took'),
     ])
 
     return parser
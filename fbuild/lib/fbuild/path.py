@@ -1,6 +1,7 @@
 import collections
 import hashlib
 import itertools
+import mmap
 import os
 import shutil
 import sys
@@ -245,6 +246,13 @@ class Path(str):
             else:
                 yield Path(path)
 
+    def identity(self):
+        """Return the (inode, size, mtime in nanoseconds) of the file from a
+        single stat call. If the identity hasn't changed, the file almost
+        certainly hasn't either."""
+        st = os.stat(self)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
     def isabs(self):
         return os.path.isabs(self)
 
@@ -292,15 +300,28 @@ class Path(str):
                 return
             raise
 
-    def digest(self, chunksize=65536):
-        """Hash the file usind md5 and return the digest."""
-        with open(self, 'rb') as f:
+    def digest(self, chunksize=65536, *, algorithm='md5', mmapsize=1048576):
+        """Hash the file and return the digest. The algorithm is either 'md5'
+        or 'blake2b'. Files at least mmapsize bytes long are hashed through
+        mmap instead of being read in chunks."""
+        if algorithm == 'md5':
             m = hashlib.md5()
-            while True:
-                d = f.read(chunksize)
-                if not d:
-                    break
-                m.update(d)
+        elif algorithm == 'blake2b':
+            m = hashlib.blake2b(digest_size=20)
+        else:
+            raise ValueError('unknown digest algorithm: %r' % algorithm)
+
+        with open(self, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if mmapsize is not None and size and size >= mmapsize:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as d:
+                    m.update(d)
+            else:
+                while True:
+                    d = f.read(chunksize)
+                    if not d:
+                        break
+                    m.update(d)
             return m.hexdigest()
 
     def mkdir(self):
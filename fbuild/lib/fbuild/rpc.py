@@ -1,6 +1,7 @@
 import queue
 import sys
 import threading
+import time
 
 # ------------------------------------------------------------------------------
 
@@ -21,15 +22,32 @@ class _Result:
     def __init__(self):
         self.result = _NULL
 
+def _call_name(args):
+    """Returns the name of the function that's being called."""
+
+    if args:
+        return getattr(args[0], '__name__', None) or repr(args[0])
+    else:
+        return 'call'
+
 # ------------------------------------------------------------------------------
 
 class RPC(threading.Thread):
-    """A simple threaded procedure call server and client."""
+    """A simple threaded procedure call server and client. If a
+    L{fbuild.trace.Tracer} is given, the time each client spends waiting on a
+    call and the time the server spends handling it are recorded as slices
+    named after the first argument."""
 
-    def __init__(self, handler):
+    def __init__(self, handler, tracer=None):
         super().__init__()
 
+        # Without a tracer, the calls aren't recorded.
+        if tracer is None:
+            import fbuild.trace
+            tracer = fbuild.trace.NullTracer()
+
         self._handler = handler
+        self._tracer = tracer
         self._lock = threading.Lock()
         self._queue = queue.Queue()
         self._events = threading.local()
@@ -39,6 +57,8 @@ class RPC(threading.Thread):
     def call(self, *args, **kwargs):
         """Call the function inside the rpc thread."""
 
+        start = time.perf_counter()
+
         with self._lock:
             if not self._running:
                 raise RPCNotRunning()
@@ -61,6 +81,9 @@ class RPC(threading.Thread):
         # Wait for the message to be processed.
         event.wait()
 
+        self._tracer.add_slice(_call_name(args), 'rpc wait', start,
+            time.perf_counter())
+
         assert result.result is not _NULL, "function failed to get called!"
 
         # Raise any exceptions we've received.
@@ -108,6 +131,7 @@ class RPC(threading.Thread):
         # Break up the message.
         event, result, args, kwargs = msg
 
+        start = time.perf_counter()
         try:
             result.result = self._handler(*args, **kwargs)
         except Exception as err:
@@ -117,6 +141,9 @@ class RPC(threading.Thread):
             result.result = err
             raise
         finally:
+            self._tracer.add_slice(_call_name(args), 'rpc', start,
+                time.perf_counter())
+
             # Let the client know that we finished.
             event.set()
 
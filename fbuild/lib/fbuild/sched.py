@@ -1,6 +1,12 @@
 import collections
+import concurrent.futures
+import contextvars
+import functools
+import heapq
 import io
+import itertools
 import operator
+import pickle
 import queue
 import sys
 import threading
@@ -8,6 +14,7 @@ import time
 import _thread
 
 import fbuild
+import fbuild.functools
 
 # ------------------------------------------------------------------------------
 
@@ -44,6 +51,28 @@ class DependencyLoop(fbuild.Error):
 
 # ------------------------------------------------------------------------------
 
+def process_safe(function):
+    """
+    Mark a function as safe to run in a separate process when the scheduler
+    uses the process executor. Such a function must be importable by name, must
+    not need the context, and must return a picklable result. Anything that
+    launches a subprocess or logs should stay on the worker threads.
+    """
+
+    function.process_safe = True
+    return function
+
+def _is_process_safe(function):
+    """Returns True if the function, or the function wrapped by a partial,
+    was marked with L{process_safe}."""
+
+    while isinstance(function, functools.partial):
+        function = function.func
+
+    return getattr(function, 'process_safe', False)
+
+# ------------------------------------------------------------------------------
+
 class Scheduler:
     """
     A Scheduler asynchronously runs functions inside a thread pool. It has a
@@ -65,20 +94,63 @@ class Scheduler:
     >>> scheduler.map_with_dependencies(deps, f, ['a', 'b', 'c'])
     ['c', 'b', 'a']
 
+    Independent work can also be started in the background, and waited on
+    later:
+
+    >>> futures = [scheduler.submit(f, x) for x in 'ab']
+    >>> scheduler.wait(futures)
+    ['a', 'b']
+
+    With the 'process' executor, functions marked with L{process_safe} are
+    sent to a process pool so that python-heavy work isn't serialized by the
+    GIL. All other functions still run on the worker threads.
+
+    With the 'critical-path' schedule, ready tasks are run in the order of the
+    longest chain of work that depends on them, so that long dependency chains
+    in L{map_with_dependencies} start as early as possible. If an I{estimate}
+    function is given, it is called once with a list of the function and the
+    source of each task, and should return a list of how long each task took
+    the last time, or None. L{map} can also be given the estimates directly.
+
+    If a L{fbuild.trace.Tracer} is given, each task is recorded as a slice of
+    the worker thread that ran it.
     """
 
-    def __init__(self, threadcount=0, *, logger=None):
+    def __init__(self, threadcount=0, *,
+            logger=None,
+            executor='thread',
+            schedule='lifo',
+            estimate=None,
+            tracer=None):
         # We need at least 1 thread.
         threadcount = max(1, threadcount)
 
         # Our threads.
         self.__threads = []
 
-        # Our work queue of ready tasks that is shared with all the worker
-        # threads. We use a lifo queue as we want to do work in the order it
+        # The optional process pool. The worker threads hand off process safe
+        # tasks to it and block until they finish, so the dependency tracking
+        # works the same for both kinds of tasks.
+        if executor == 'thread':
+            self.__executor = None
+        elif executor == 'process':
+            self.__executor = concurrent.futures.ProcessPoolExecutor(
+                threadcount)
+        else:
+            raise fbuild.Error('unknown executor: %s' % executor)
+
+        # Our pool of ready tasks that is shared with all the worker threads.
+        # We run the newest tasks first as we want to do work in the order it
         # comes in since it's less likely to have dependencies on later
-        # functions.
-        self.__ready_queue = queue.LifoQueue()
+        # functions. The critical path schedule falls back on that order for
+        # tasks of equal priority.
+        if schedule not in ('lifo', 'critical-path'):
+            raise fbuild.Error('unknown schedule: %s' % schedule)
+
+        self.__ready_queue = ReadyPool(schedule)
+
+        self.__schedule = schedule
+        self.__estimate = estimate
 
         # All the worker threads need to share a logger object to make sure we
         # don't have races when we're logging to the console. So we need to
@@ -87,9 +159,16 @@ class Scheduler:
             import fbuild.console
             logger = fbuild.console.Log()
 
+        # Without a tracer, the tasks aren't recorded.
+        if tracer is None:
+            import fbuild.trace
+            tracer = fbuild.trace.NullTracer()
+
         # Spin up our threads!
         for i in range(threadcount):
-            thread = WorkerThread(logger, self.__ready_queue)
+            thread = WorkerThread(logger, self.__ready_queue, self.__executor,
+                tracer)
+            self.__ready_queue.add_worker(thread)
             self.__threads.append(thread)
             thread.start()
 
@@ -97,11 +176,17 @@ class Scheduler:
     def threadcount(self):
         return len(self.__threads)
 
-    def map(self, function, srcs):
+    @property
+    def schedule(self):
+        return self.__schedule
+
+    def map(self, function, srcs, *, estimates=None):
         """Run the function over the input sources concurrently. This function
-        returns the results in their initial order."""
+        returns the results in their initial order. The I{estimates} of how
+        long each source takes are used instead of the I{estimate} function."""
         tasks = [Task(function, src, index) for index, src in enumerate(srcs)]
-        tasks = sorted(self._evaluate(tasks), key=operator.attrgetter('index'))
+        tasks = sorted(self._evaluate(tasks, estimates),
+            key=operator.attrgetter('index'))
 
         return [n.result for n in tasks]
 
@@ -155,7 +240,37 @@ class Scheduler:
 
         return results
 
-    def _evaluate(self, tasks):
+    def submit(self, function, *args, **kwargs):
+        """Run the function with the arguments in a worker thread, and return
+        a L{Future} of its result. As with L{fbuild.functools.call}, the
+        function may be the name of a function to import."""
+
+        function = fbuild.functools.import_function(function)
+        if kwargs:
+            function = functools.partial(function, **kwargs)
+
+        task = Task(function, None, args=args)
+        future = Future(task, self.__ready_queue)
+
+        # Submitted functions tend to start whole phases of the build, so run
+        # them before the tasks that are already waiting.
+        task.priority = float('inf')
+        task.running = True
+        self.__ready_queue.put((future, task))
+
+        return future
+
+    def wait(self, futures):
+        """Wait for all of the futures to finish, and return their results in
+        order. If any of them raised an exception, the first one is raised
+        after they've all finished."""
+
+        for future in futures:
+            future.wait()
+
+        return [future.result() for future in futures]
+
+    def _evaluate(self, tasks, estimates=None):
         """Evaluate the function over these tasks and return the results."""
 
         # Keep a counter for the number of active tasks. When this reaches 0 we
@@ -166,13 +281,19 @@ class Scheduler:
         children = collections.defaultdict(list)
 
         # The queue from which we will receive function results.
-        done_queue = queue.Queue()
+        done_queue = DoneQueue()
 
-        # Add each task to our work set and map dependencies to dependents.
+        # Map dependencies to dependents.
         for task in tasks:
             for dep in task.dependencies:
                 children[dep].append(task)
 
+        # Prioritize the tasks before any of them are queued up.
+        if self.__schedule == 'critical-path':
+            self._prioritize(tasks, children, estimates)
+
+        # Add each task to our work set.
+        for task in tasks:
             if task.can_run():
                 count += 1
                 task.running = True
@@ -189,30 +310,16 @@ class Scheduler:
         # The way we avoid this problem is that we detect if the current thread is
         # one of our worker threads, and if so, we know we're are being used
         # recursively. When this happens, we know we can reuse this thread to
-        # run another queued up function.
-        current_thread = threading.current_thread()
+        # run another queued up function. When there's nothing to run, the
+        # thread sleeps until either new work shows up or one of our tasks
+        # finished. See L{ReadyPool.wait}.
 
         # The list of function results.
         results = []
 
         # Run until all of our tasks finished.
         while count != 0:
-            if isinstance(current_thread, WorkerThread):
-                # We're inside an already running thread, so we're going to run
-                # until all of our tasks are done.
-                try:
-                    current_thread.run_one(block=False)
-                except queue.Empty:
-                    pass
-
-                # See if any of our tasks finished.
-                try:
-                    task = done_queue.get(block=False)
-                except queue.Empty:
-                    # No tasks done, so loop.
-                    continue
-            else:
-                task = done_queue.get()
+            task = self.__ready_queue.wait(done_queue)
 
             # We finished a task!
             count -= 1
@@ -256,6 +363,45 @@ class Scheduler:
 
         return results
 
+    def _prioritize(self, tasks, children, estimates=None):
+        """Set the priority of each task to the cost of the longest chain of
+        tasks that depend upon it, including itself."""
+
+        if estimates is None and self.__estimate is not None:
+            estimates = self.__estimate([(t.function, t.src) for t in tasks])
+
+        # Use the historical durations as the costs if we have them. Tasks
+        # we haven't seen before are assumed to take the average time.
+        if estimates is not None:
+            known = [e for e in estimates if e is not None]
+
+            if known:
+                average = sum(known) / len(known)
+                for task, estimate in zip(tasks, estimates):
+                    task.cost = average if estimate is None else estimate
+
+        weights = {}
+        visited = set()
+
+        # Walk the dependents depth first without recursing, since the chains
+        # can be longer than the recursion limit. Any dependency loops are
+        # broken at the first task we revisit, and are reported later on.
+        for root in tasks:
+            stack = [(root, False)]
+            while stack:
+                task, expanded = stack.pop()
+                if expanded:
+                    weights[task] = task.cost + max(
+                        (weights.get(child, 0) for child in children[task]),
+                        default=0)
+                elif task not in visited:
+                    visited.add(task)
+                    stack.append((task, True))
+                    stack.extend((child, False) for child in children[task])
+
+        for task, weight in weights.items():
+            task.priority = weight
+
     def __del__(self):
         # Make sure we shutdown all our threads before we quit.
         self.shutdown()
@@ -264,8 +410,7 @@ class Scheduler:
         """Tell the worker threads to shut down."""
 
         # make sure we wake the threads before we kill them.
-        for thread in self.__threads:
-            self.__ready_queue.put(None)
+        self.__ready_queue.close()
 
         for thread in self.__threads:
             thread.shutdown()
@@ -274,6 +419,269 @@ class Scheduler:
         # Reset our thread list.
         self.__threads = []
 
+        # Shut down the process pool once no thread can submit to it anymore.
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+# ------------------------------------------------------------------------------
+
+class DoneQueue:
+    """
+    The tasks of a L{Scheduler._evaluate} call that finished, in the order
+    they finished. The L{ReadyPool} wakes up the threads waiting on it.
+    """
+
+    def __init__(self):
+        self._tasks = collections.deque()
+
+        # The condition variables of the threads that wait on us.
+        self.waiters = []
+
+    def __bool__(self):
+        return bool(self._tasks)
+
+    def put(self, task):
+        self._tasks.append(task)
+
+    def get(self):
+        return self._tasks.popleft()
+
+# ------------------------------------------------------------------------------
+
+class Future(DoneQueue):
+    """
+    The eventual result of a function passed to L{Scheduler.submit}. Worker
+    threads that wait on a future run other tasks in the meantime, so that
+    waiting from inside a task can't deadlock the scheduler.
+    """
+
+    def __init__(self, task, pool):
+        super().__init__()
+        self._task = task
+        self._pool = pool
+
+    def __bool__(self):
+        return self._task.done
+
+    def put(self, task):
+        """Called by the worker thread once the task finished, just like the
+        done queue of L{Scheduler._evaluate}."""
+
+        task.done = True
+
+    def get(self):
+        # Unlike a done queue, any number of threads can wait on a future.
+        return self._task
+
+    def done(self):
+        """Returns True if the function finished."""
+        return self._task.done
+
+    def wait(self):
+        """Wait for the function to finish."""
+
+        self._pool.wait(self)
+
+    def result(self):
+        """Wait for the function to finish and return its result, or raise
+        the exception it raised."""
+
+        self.wait()
+
+        if self._task.exc is not None:
+            raise self._task.exc
+
+        return self._task.result
+
+# ------------------------------------------------------------------------------
+
+class ReadyPool:
+    """
+    The tasks that are ready to run, shared by the worker threads of a
+    scheduler.
+
+    With the 'lifo' schedule, each worker thread has its own deque. The tasks
+    a worker queues up go onto its deque and it runs the newest one first, so
+    that recursive calls into the scheduler stay on the thread that made them.
+    A worker that runs out of tasks steals the oldest task of another worker.
+    With the 'critical-path' schedule, all the tasks share one queue that
+    returns the task with the highest priority first, and falls back on lifo
+    order for tasks of the same priority.
+
+    Threads with nothing to do sleep on their own condition variable until a
+    task is queued or one of the tasks they're waiting on finishes.
+    """
+
+    def __init__(self, schedule='lifo'):
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # The per thread deques, and the deque for the tasks queued by
+        # threads that aren't workers.
+        self._deques = {}
+        self._shared = collections.deque()
+
+        # The priority queue of the critical path schedule.
+        if schedule == 'critical-path':
+            self._heap = []
+            self._counter = itertools.count()
+        else:
+            self._heap = None
+
+        # The condition variables of each thread, and of the worker threads
+        # that sleep until a task is queued.
+        self._conditions = {}
+        self._idle = []
+
+    def add_worker(self, thread):
+        """Give the worker thread its own deque of tasks."""
+
+        with self._lock:
+            self._deques[thread] = collections.deque()
+
+    def put(self, item):
+        """Queue up a (done queue, task) pair and wake up a thread to run
+        it."""
+
+        with self._lock:
+            if self._heap is not None:
+                done_queue, task = item
+                heapq.heappush(self._heap,
+                    (-task.priority, -next(self._counter), item))
+            else:
+                thread = threading.current_thread()
+                self._deques.get(thread, self._shared).append(item)
+
+            if self._idle:
+                self._idle.pop().notify()
+
+    def get(self, block=True):
+        """Returns the next task for the current worker thread, or None once
+        the pool is closed and there are no tasks left. Raises queue.Empty if
+        we aren't blocking and there are no tasks."""
+
+        thread = threading.current_thread()
+
+        with self._lock:
+            while True:
+                item = self._pop(thread)
+                if item is not None:
+                    return item
+
+                if self._closed:
+                    return None
+
+                if not block:
+                    raise queue.Empty
+
+                self._sleep(thread, idle=True)
+
+    def finish(self, done_queue, task):
+        """Put the finished task on its done queue and wake up the threads
+        waiting on it."""
+
+        with self._lock:
+            done_queue.put(task)
+
+            for condition in done_queue.waiters:
+                condition.notify()
+
+    def wait(self, done_queue):
+        """Wait until a task is on the done queue and return it. A worker
+        thread runs the ready tasks while it waits, so that a task that calls
+        back into the scheduler can't deadlock it by tying up all of the
+        workers."""
+
+        thread = threading.current_thread()
+        worker = thread in self._deques
+
+        while True:
+            with self._lock:
+                while True:
+                    if done_queue:
+                        # We may have been woken up for a task we won't run,
+                        # so pass it on to another thread.
+                        if self._idle and self._has_tasks():
+                            self._idle.pop().notify()
+
+                        return done_queue.get()
+
+                    item = self._pop(thread) if worker else None
+                    if item is not None:
+                        break
+
+                    self._sleep(thread, idle=worker, done_queue=done_queue)
+
+            # Run the task without holding the lock.
+            thread.run_task(item)
+
+    def close(self):
+        """Wake up all the worker threads and let them exit once there are no
+        tasks left."""
+
+        with self._lock:
+            self._closed = True
+
+            for condition in self._idle:
+                condition.notify()
+
+            del self._idle[:]
+
+    def _pop(self, thread):
+        """Returns the next task for the thread, or None. This needs to be
+        called with the lock held."""
+
+        if self._heap is not None:
+            if self._heap:
+                return heapq.heappop(self._heap)[2]
+            return None
+
+        deque = self._deques.get(thread)
+        if deque:
+            return deque.pop()
+
+        if self._shared:
+            return self._shared.pop()
+
+        # Steal the oldest task of another worker, which is the one least
+        # likely to be needed soon by the thread that queued it.
+        for deque in self._deques.values():
+            if deque:
+                return deque.popleft()
+
+        return None
+
+    def _has_tasks(self):
+        if self._heap is not None:
+            return bool(self._heap)
+
+        return bool(self._shared) or any(self._deques.values())
+
+    def _sleep(self, thread, *, idle, done_queue=None):
+        """Sleep until we're woken up. Idle threads are woken up when a task
+        is queued, and threads with a done queue when one of its tasks
+        finished. This needs to be called with the lock held."""
+
+        try:
+            condition = self._conditions[thread]
+        except KeyError:
+            condition = self._conditions[thread] = \
+                threading.Condition(self._lock)
+
+        if idle:
+            self._idle.append(condition)
+        if done_queue is not None:
+            done_queue.waiters.append(condition)
+
+        try:
+            condition.wait()
+        finally:
+            if idle and condition in self._idle:
+                self._idle.remove(condition)
+            if done_queue is not None:
+                done_queue.waiters.remove(condition)
+
 # ------------------------------------------------------------------------------
 
 class WorkerThread(threading.Thread):
@@ -282,12 +690,14 @@ class WorkerThread(threading.Thread):
     left.
     """
 
-    def __init__(self, logger, ready_queue):
+    def __init__(self, logger, ready_queue, executor, tracer):
         super().__init__()
         self.daemon = True
 
         self.__logger = logger
         self.__ready_queue = ready_queue
+        self.__executor = executor
+        self.__tracer = tracer
         self.__finished = False
 
     def shutdown(self):
@@ -313,22 +723,23 @@ class WorkerThread(threading.Thread):
 
         queue_task = self.__ready_queue.get(*args, **kwargs)
 
-        try:
-            # This should be tested in the try block so that we update the done
-            # counter in the ready queue, even if we errored out.
-            if queue_task is None:
-                return False
+        if queue_task is None:
+            return False
 
-            done_queue, task = queue_task
-            try:
-                task.run()
-            finally:
-                done_queue.put(task)
-        finally:
-            self.__ready_queue.task_done()
+        self.run_task(queue_task)
 
         return True
 
+    def run_task(self, queue_task):
+        """Run the task from the ready queue and hand it to its done queue."""
+
+        done_queue, task = queue_task
+        try:
+            with self.__tracer.slice(task.name(), 'task'):
+                task.run(self.__executor)
+        finally:
+            self.__ready_queue.finish(done_queue, task)
+
 # ------------------------------------------------------------------------------
 
 class Task:
@@ -336,15 +747,30 @@ class Task:
     Represent the state needed to run the function with one source.
     """
 
-    def __init__(self, function, src, index=None):
+    def __init__(self, function, src, index=None, *, args=None):
         self.function = function
         self.src = src
         self.index = index
+
+        # Run the function in a copy of the context that created the task, so
+        # that context variables follow the task to whichever thread runs it,
+        # and don't leak into the other tasks that thread runs.
+        self.context = contextvars.copy_context()
+
+        # The function is called with the source unless other arguments are
+        # given.
+        self.args = (src,) if args is None else args
         self.running = False
         self.done = False
         self.dependencies = []
         self.exc =None
 
+        # The critical path scheduler runs tasks with a higher priority first.
+        # The priority is computed from the cost of this task and all the
+        # tasks that depend on it.
+        self.cost = 1
+        self.priority = 0
+
     def can_run(self):
         """Returns True if all of this task's dependencies are done. Otherwise
         return False."""
@@ -357,10 +783,39 @@ class Task:
 
         return all(d.done for d in self.dependencies)
 
-    def run(self):
-        """Run the task's function."""
+    def name(self):
+        """Returns the name of the task's function."""
+
+        function = self.function
+        while isinstance(function, functools.partial):
+            function = function.func
+
+        return getattr(function, '__qualname__', None) or repr(function)
+
+    def run(self, executor=None):
+        """Run the task's function. If we have a process pool and the function
+        is process safe, run it in the pool and wait for the result."""
 
         try:
-            self.result = self.function(self.src)
+            if executor is not None and self.can_run_in_process():
+                future = executor.submit(self.function, *self.args)
+                self.result = future.result()
+            else:
+                self.result = self.context.run(self.function, *self.args)
         except Exception as e:
             self.exc = e
+
+    def can_run_in_process(self):
+        """Returns True if the task can be sent to another process."""
+
+        if not _is_process_safe(self.function):
+            return False
+
+        # Make sure the function and the source can be sent to the pool.
+        # Otherwise we just fall back onto the worker thread.
+        try:
+            pickle.dumps((self.function, self.args))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return False
+
+        return True
@@ -0,0 +1,110 @@
+"""
+Record what each thread was doing during a build as a timeline of slices, and
+save it in the trace event format that chrome://tracing and Perfetto can open.
+
+>>> tracer = Tracer()
+>>> with tracer.slice('build', 'target'):
+...     pass
+>>> [(e['name'], e['cat'], e['ph']) for e in tracer.events()]
+[('thread_name', '__metadata', 'M'), ('build', 'target', 'X')]
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+class Tracer:
+    """Collect slices of time from any thread. Each slice is tagged with the
+    name of the thread that recorded it."""
+
+    def __init__(self):
+        self._events = []
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def slice(self, name, category, **args):
+        """Record the time spent in the with block as a slice."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_slice(name, category, start, time.perf_counter(), **args)
+
+    def add_slice(self, name, category, start, end, **args):
+        """Record a slice of the current thread that started and ended at the
+        L{time.perf_counter} times."""
+
+        thread = threading.current_thread()
+
+        event = {
+            'name': str(name),
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self._start) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self._pid,
+            'tid': thread.ident,
+            'args': dict(args, thread=thread.name),
+        }
+
+        with self._lock:
+            # Name the thread's track the first time we see it.
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self._events.append({
+                    'name': 'thread_name',
+                    'cat': '__metadata',
+                    'ph': 'M',
+                    'pid': self._pid,
+                    'tid': thread.ident,
+                    'args': {'name': thread.name},
+                })
+
+            self._events.append(event)
+
+    def events(self):
+        """Returns a list of the events recorded so far."""
+
+        with self._lock:
+            return list(self._events)
+
+    def save(self, filename):
+        """Write the events to the file as trace event JSON."""
+
+        import json
+
+        with open(filename, 'w') as f:
+            json.dump({
+                'traceEvents': self.events(),
+                'displayTimeUnit': 'ms',
+            }, f)
+
+# ------------------------------------------------------------------------------
+
+class NullTracer:
+    """A tracer that doesn't record anything, for when tracing is off."""
+
+    def slice(self, name, category, **args):
+        return _null_slice
+
+    def add_slice(self, name, category, start, end, **args):
+        pass
+
+    def events(self):
+        return []
+
+class _NullSlice:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+_null_slice = _NullSlice()
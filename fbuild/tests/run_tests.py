@@ -7,9 +7,14 @@ import unittest
 
 sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'lib'))
 
+import test_config
+import test_database
 import test_fnmatch
 import test_functools
 import test_glob
+import test_log_backend
+import test_main
+import test_objcache
 import test_scheduler
 
 # -----------------------------------------------------------------------------
@@ -42,9 +47,14 @@ def main():
             else:
                 suite.addTest(test)
 
+    suite.addTest(test_config.suite())
+    suite.addTest(test_database.suite())
     suite.addTest(test_fnmatch.suite())
     suite.addTest(test_functools.suite())
     suite.addTest(test_glob.suite())
+    suite.addTest(test_log_backend.suite())
+    suite.addTest(test_main.suite())
+    suite.addTest(test_objcache.suite())
     suite.addTest(test_scheduler.suite())
 
     runner = unittest.TextTestRunner(verbosity=2)
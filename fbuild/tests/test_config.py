@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+import re
+import shutil
+import threading
+import unittest
+from unittest import mock
+
+import fbuild
+import fbuild.builders.c.gcc
+import fbuild.config
+import fbuild.config.c
+import fbuild.config.c.c90
+import fbuild.db
+import fbuild.db.backend
+import fbuild.main
+
+from test_database import DatabaseTestCase
+
+# -----------------------------------------------------------------------------
+
+# The fields of the tests that were probed, in the order they were probed.
+probed = []
+
+class Builder(fbuild.db.PersistentObject):
+    """A builder that can be identified without a compiler."""
+
+    def __init__(self, ctx, flags=()):
+        super().__init__(ctx)
+        self.flags = list(flags)
+
+    def identity(self):
+        return ('builder', tuple(self.flags))
+
+class Probes(fbuild.config.c.Test):
+    @fbuild.config.c.cacheproperty
+    def answer(self):
+        probed.append('answer')
+        return 42
+
+class AssertBuilder(Builder):
+    """A builder whose objects never hold the values of the tests, so they
+    have to be searched for. It checks the static asserts by evaluating them
+    in python."""
+
+    src_suffix = '.c'
+
+    def uncached_compile(self, src, **kwargs):
+        with open(src) as f:
+            match = re.search(r'fbuild_assert\[\((.*)\) \? 1 : -1\]', f.read())
+
+        if match is not None and not eval(match.group(1)):
+            raise fbuild.ExecutionError(src)
+
+        return src
+
+class value_test(fbuild.config.c.AbstractFieldDescriptor):
+    """A test whose value is a python expression."""
+
+    def __init__(self, expression, **kwargs):
+        super().__init__(**kwargs)
+        self.expression = expression
+
+    def format_values(self, header=None, prefix='fbuild'):
+        return '', '', [self.expression]
+
+    def process_values(self, instance, values):
+        return values[0]
+
+class SearchProbes(fbuild.config.c.Test):
+    zero = value_test('0')
+    thousand = value_test('1000')
+    largest = value_test('(1 << 32) - 1')
+    huge = value_test('1 << 40')
+
+class echo_test(fbuild.config.c.AbstractFieldDescriptor):
+    """A test whose program prints the name of the test, unless it's broken,
+    in which case it doesn't compile."""
+
+    def __init__(self, *, broken=False, include='stdio.h', **kwargs):
+        super().__init__(**kwargs)
+        self.broken = broken
+        self.include = include
+
+    def format_probe(self, header=None):
+        body = 'printf("%s");\nreturn 0;' % self.name
+        if self.broken:
+            body = 'int broken = ;\n' + body
+
+        return '#include <stdio.h>\n#include <%s>' % self.include, body
+
+    def process_stdout(self, instance, stdout):
+        return stdout.decode()
+
+class EchoProbes(fbuild.config.c.Test):
+    first = echo_test()
+    second = echo_test()
+    third = echo_test()
+
+class BrokenProbes(fbuild.config.c.Test):
+    first = echo_test()
+    broken = echo_test(broken=True)
+    second = echo_test()
+    int = fbuild.config.c.int_type_test()
+    missing = fbuild.config.c.type_test(name='struct fbuild_missing')
+    double = fbuild.config.c.type_test()
+
+class ValueProbes(fbuild.config.c.Test):
+    char = fbuild.config.c.int_type_test()
+    int = fbuild.config.c.int_type_test()
+    long_long = fbuild.config.c.int_type_test(name='long long')
+    double = fbuild.config.c.type_test()
+    missing = fbuild.config.c.type_test(name='struct fbuild_missing')
+
+class PrefetchProbes(fbuild.config.c.Test):
+    first = echo_test()
+    second = echo_test()
+    other = echo_test(include='stdlib.h')
+    int = fbuild.config.c.int_type_test()
+    double = fbuild.config.c.type_test()
+
+# -----------------------------------------------------------------------------
+
+class ConfigTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        del probed[:]
+        self.config = self.tmpdir / 'config'
+
+    def probe(self, *args, flags=()):
+        """Probe the test in a new buildroot, loading and saving the results
+        as if it was the build."""
+
+        # Every build starts without any results in its database.
+        shutil.rmtree(self.tmpdir / 'build', ignore_errors=True)
+
+        def f(ctx):
+            fbuild.main.load_config(ctx)
+            answer = Probes(Builder(ctx, flags),
+                platform=frozenset({'posix'})).answer
+            fbuild.main.save_config(ctx)
+
+            return answer
+
+        return self.build(f, *args)
+
+    def write_config(self, contents):
+        with open(self.config, 'wb') as f:
+            f.write(contents)
+
+# -----------------------------------------------------------------------------
+
+class TestSaveLoad(ConfigTestCase):
+    def testRoundTrip(self):
+        self.assertEqual(self.probe('--save-config=' + self.config), 42)
+        self.assertEqual(probed, ['answer'])
+
+        # The results are reused in a new buildroot.
+        self.assertEqual(self.probe('--load-config=' + self.config), 42)
+        self.assertEqual(probed, ['answer'])
+
+        # Without them, the test runs again.
+        self.assertEqual(self.probe(), 42)
+        self.assertEqual(probed, ['answer', 'answer'])
+
+    def testLoadAndSave(self):
+        self.probe('--save-config=' + self.config)
+
+        # The loaded results are saved again with the ones we found.
+        self.probe('--load-config=' + self.config,
+            '--save-config=' + self.config)
+        self.probe('--load-config=' + self.config)
+        self.assertEqual(probed, ['answer'])
+
+    def testContext(self):
+        def f(ctx):
+            results = fbuild.config.find_results(ctx)
+            self.assertIs(fbuild.config.find_results(ctx), results)
+
+            return results
+
+        # Each build keeps its own results.
+        results = self.build(f, '--save-config=' + self.config)
+        self.assertIsNotNone(results)
+        self.assertIsNot(self.build(f, '--save-config=' + self.config),
+            results)
+
+        self.assertIsNone(self.build(f))
+
+class TestReject(ConfigTestCase):
+    def testOtherBuilder(self):
+        self.probe('--save-config=' + self.config)
+
+        # The results are only reused with a builder with the same identity.
+        self.probe('--load-config=' + self.config, flags=['-O2'])
+        self.assertEqual(probed, ['answer', 'answer'])
+
+    def testOtherVersion(self):
+        self.probe('--save-config=' + self.config)
+
+        # Pretend the results were saved by another version of fbuild.
+        with open(self.config, 'rb') as f:
+            version, results = fbuild.db.backend.pickle_loads(None, f.read())
+        self.write_config(fbuild.db.backend.pickle_dumps(None,
+            ('0.0', results)))
+
+        self.probe('--load-config=' + self.config)
+        self.assertEqual(probed, ['answer', 'answer'])
+
+    def testNotSavedResults(self):
+        for contents in (b'', b'garbage',
+                fbuild.db.backend.pickle_dumps(None, ['not', 'results'])):
+            del probed[:]
+            self.write_config(contents)
+
+            self.assertEqual(self.probe('--load-config=' + self.config), 42)
+            self.assertEqual(probed, ['answer'])
+
+    def testMissingFile(self):
+        with self.assertRaises(fbuild.Error):
+            self.probe('--load-config=' + self.config)
+
+# -----------------------------------------------------------------------------
+
+def format_data(values, count=None, end=fbuild.config.c._VALUES_END_MARKER):
+    """Returns the data of an object that holds the array of values."""
+
+    if count is None:
+        count = len(values)
+
+    return b'garbage' + fbuild.config.c._VALUES_MARKER + \
+        b''.join(v.to_bytes(4, 'big') for v in [count] + values) + \
+        end + b'garbage'
+
+class TestValues(unittest.TestCase):
+    def testFormat(self):
+        code = fbuild.config.c._format_values('int a;', [
+            (None, 'int fbuild_value_0 = 1;', ['fbuild_value_0', '2']),
+            (None, '', ['sizeof(int)'])])
+
+        self.assertIn('int a;', code)
+        self.assertIn('int fbuild_value_0 = 1;', code)
+        self.assertIn('FBUILD_VALUE(3),', code)
+
+        # The markers and the values are in order.
+        lines = code.split('\n')
+        start = lines.index('    %s,' % ', '.join(
+            str(b) for b in fbuild.config.c._VALUES_MARKER))
+        self.assertEqual(lines[start + 1:], [
+            '    FBUILD_VALUE(3),',
+            '    FBUILD_VALUE(fbuild_value_0),',
+            '    FBUILD_VALUE(2),',
+            '    FBUILD_VALUE(sizeof(int)),',
+            '    %s,' % ', '.join(
+                str(b) for b in fbuild.config.c._VALUES_END_MARKER),
+            '};'])
+
+    def testParse(self):
+        parse = fbuild.config.c._parse_values
+
+        self.assertEqual(parse(format_data([0, 1, 2**32 - 1]), 3),
+            [0, 1, 2**32 - 1])
+        self.assertEqual(parse(format_data([]), 0), [])
+
+    def testNotFound(self):
+        parse = fbuild.config.c._parse_values
+        data = format_data([1, 2])
+
+        self.assertIsNone(parse(b'', 2))
+        self.assertIsNone(parse(data.replace(b'values', b'VALUES'), 2))
+
+        # The object ends in the middle of the array.
+        marker = data.index(fbuild.config.c._VALUES_MARKER)
+        self.assertIsNone(parse(data[:marker + 20], 2))
+
+        # The array holds another number of values.
+        self.assertIsNone(parse(data, 3))
+        self.assertIsNone(parse(format_data([1, 2], count=3), 2))
+        self.assertIsNone(parse(format_data([1, 2], end=b''), 2))
+
+    def testFirstMarker(self):
+        # Objects for link time optimization can hold the start of the
+        # array without the values.
+        data = format_data([1, 2])
+        decoy = fbuild.config.c._VALUES_MARKER + (2).to_bytes(4, 'big')
+
+        self.assertEqual(fbuild.config.c._parse_values(decoy + data, 2),
+            [1, 2])
+
+class TestSearch(DatabaseTestCase):
+    engines = ('pickle',)
+
+    def testSearch(self):
+        def f(ctx):
+            instance = SearchProbes(AssertBuilder(ctx),
+                platform=frozenset({'posix'}))
+
+            return {name: getattr(instance, name)
+                for name, field in instance.fields()}
+
+        for args in ((), ('--no-batch-probes',)):
+            shutil.rmtree(self.tmpdir / 'build', ignore_errors=True)
+
+            # Only the value that doesn't fit in 32 bits fails.
+            self.assertEqual(self.build(f, *args), {
+                'zero': 0,
+                'thousand': 1000,
+                'largest': 2**32 - 1,
+                'huge': None})
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not available')
+class TestProbeBatch(DatabaseTestCase):
+    engines = ('pickle',)
+
+    def probe(self, test, *args, flags=()):
+        """Find the fields of the test in a new buildroot. Returns the
+        results and the number of programs we linked."""
+
+        shutil.rmtree(self.tmpdir / 'build', ignore_errors=True)
+
+        def f(ctx):
+            instance = test(fbuild.builders.c.gcc.static(ctx, flags=flags))
+
+            with mock.patch.object(fbuild.config.c._ProbeBatch, 'link',
+                    autospec=True,
+                    side_effect=fbuild.config.c._ProbeBatch.link) as link:
+                results = {name: getattr(instance, name)
+                    for name, field in instance.fields()}
+
+            return results, link.call_count
+
+        return self.build(f, *args)
+
+    def testRunIndex(self):
+        # The tests are linked into one program, which runs each of them.
+        with mock.patch.object(fbuild.builders.c.gcc.Builder, 'run',
+                autospec=True,
+                side_effect=fbuild.builders.c.gcc.Builder.run) as run:
+            results, links = self.probe(EchoProbes)
+
+        self.assertEqual(results,
+            {'first': 'first', 'second': 'second', 'third': 'third'})
+        self.assertEqual(links, 1)
+
+        # Ignore the programs that check gcc works.
+        cmds = [args[1] for args, kwargs in run.call_args_list
+            if len(args[1]) == 2]
+        self.assertEqual(len({cmd[0] for cmd in cmds}), 1)
+        self.assertEqual(sorted(cmd[1] for cmd in cmds), ['0', '1', '2'])
+
+    def testCompileFailure(self):
+        results, links = self.probe(BrokenProbes)
+
+        # Only the broken tests fail.
+        self.assertEqual(results['first'], 'first')
+        self.assertEqual(results['second'], 'second')
+        self.assertIsNone(results['broken'])
+        self.assertIsNone(results['missing'])
+        self.assertIsNotNone(results['int'])
+        self.assertIsNotNone(results['double'])
+
+        # The tests are bisected until the broken one fails on its own.
+        self.assertEqual(links, 5)
+
+        self.assertEqual(results,
+            self.probe(BrokenProbes, '--no-batch-probes')[0])
+
+    def testSameAsUnbatched(self):
+        batched, links = self.probe(fbuild.config.c.c90.string_h)
+        self.assertEqual(links, 1)
+
+        unbatched, links = self.probe(fbuild.config.c.c90.string_h,
+            '--no-batch-probes')
+        self.assertEqual(links, 0)
+
+        self.assertEqual(batched, unbatched)
+
+    def testLinkTimeOptimization(self):
+        # The objects only hold the intermediate representation, so the
+        # values are found with static asserts.
+        with mock.patch.object(fbuild.config.c._ProbeBatch, 'search',
+                autospec=True,
+                side_effect=fbuild.config.c._ProbeBatch.search) as search:
+            batched = self.probe(ValueProbes, flags=['-flto'])[0]
+        self.assertTrue(search.called)
+
+        self.assertEqual(batched,
+            self.probe(ValueProbes, '--no-batch-probes', flags=['-flto'])[0])
+        self.assertEqual(batched, self.probe(ValueProbes)[0])
+
+    def testPrefetch(self):
+        barrier = threading.Barrier(2, timeout=10)
+        original = fbuild.config.c._ProbeBatch.link
+
+        def link(batch, declarations, probes):
+            # Both groups of programs have to be linked at the same time.
+            barrier.wait()
+            return original(batch, declarations, probes)
+
+        def f(ctx):
+            instance = PrefetchProbes(fbuild.builders.c.gcc.static(ctx))
+
+            with mock.patch.object(fbuild.config.c._ProbeBatch, 'link',
+                    autospec=True, side_effect=link) as link_exe:
+                self.assertIs(instance.prefetch(), instance)
+            self.assertEqual(link_exe.call_count, 2)
+
+            # Every field was found, so nothing is compiled again.
+            with mock.patch.object(fbuild.builders.c.gcc.Builder,
+                    'uncached_compile') as compile:
+                results = {name: getattr(instance, name)
+                    for name, field in instance.fields()}
+            self.assertFalse(compile.called)
+
+            return results
+
+        shutil.rmtree(self.tmpdir / 'build', ignore_errors=True)
+        self.assertEqual(self.build(f, '-j4'),
+            self.probe(PrefetchProbes)[0])
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(TestSaveLoad),
+        loader.loadTestsFromTestCase(TestReject),
+        loader.loadTestsFromTestCase(TestValues),
+        loader.loadTestsFromTestCase(TestSearch),
+        loader.loadTestsFromTestCase(TestProbeBatch),
+    ))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,871 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import hashlib
+import importlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import fbuild.builders
+import fbuild.builders.text
+import fbuild.context
+import fbuild.db
+import fbuild.db.backend
+import fbuild.db.database
+import fbuild.db.sqlite_backend
+import fbuild.inspect
+import fbuild.sched
+from fbuild.path import Path
+from fbuild.sched import Task
+
+# -----------------------------------------------------------------------------
+
+# The sources that the compiler compiled, in the order it compiled them.
+compiled = []
+
+class Compiler(fbuild.builders.AbstractCompiler):
+    """A compiler that just copies the source into the buildroot, and
+    pretends that took as many seconds as the source has bytes."""
+
+    def __init__(self, ctx):
+        super().__init__(ctx, src_suffix='.c')
+
+    @fbuild.db.cachemethod
+    def compile(self, src:fbuild.db.SRC) -> fbuild.db.DST:
+        return self.uncached_compile(src)
+
+    def uncached_compile(self, src):
+        compiled.append(Path(src).name)
+        self.ctx.db.add_duration_to_call(float(os.path.getsize(src)))
+
+        dst = self.ctx.buildroot / Path(src).name + '.o'
+        shutil.copyfile(src, dst)
+
+        return dst
+
+@fbuild.db.caches
+def count_lines(ctx, src:fbuild.db.SRC):
+    compiled.append(Path(src).name)
+
+    with open(src) as f:
+        return len(f.readlines())
+
+@fbuild.db.caches
+def generate(ctx, dst:fbuild.db.DST, contents) -> fbuild.db.DST:
+    with open(dst, 'w') as f:
+        f.write(contents)
+
+    return dst
+
+@fbuild.db.caches
+def generate_external(ctx, dst, contents):
+    with open(dst, 'w') as f:
+        f.write(contents)
+
+    ctx.db.add_external_dependencies_to_call(dsts=[dst])
+
+@fbuild.db.caches
+def read_external(ctx, src):
+    ctx.db.add_external_dependencies_to_call(srcs=[src])
+
+    with open(src) as f:
+        return f.read()
+
+# Tasks that were queued outside of any cached call, which the timed function
+# runs as if the scheduler ran them while the function waited on it.
+unrelated_tasks = []
+
+@fbuild.db.caches
+def timed(ctx):
+    for task in unrelated_tasks:
+        task.run()
+
+    ctx.db.add_duration_to_call(1.0)
+
+    # The tasks the call queues belong to it.
+    ctx.scheduler.map(ctx.db.add_duration_to_call, [2.0])
+
+# -----------------------------------------------------------------------------
+
+class DatabaseTestCase(unittest.TestCase):
+    """Runs each test against every engine that saves the database."""
+
+    engines = ('pickle', 'log', 'sqlite')
+
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        del compiled[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_context(self, *args):
+        ctx = fbuild.context.make_default_context([
+            '--buildroot=' + self.tmpdir / 'build',
+            '--database-engine=' + self.engine] + list(args))
+        ctx.create_buildroot()
+        ctx.load_configuration()
+
+        return ctx
+
+    def build(self, function, *args):
+        """Run the function with a new context as if it was a build, and save
+        the database afterwards."""
+
+        ctx = self.make_context(*args)
+        try:
+            return function(ctx)
+        finally:
+            ctx.db.close()
+            ctx.db.shutdown()
+            ctx.scheduler.shutdown()
+            ctx.logger.file.close()
+
+    def write(self, name, contents):
+        path = self.tmpdir / name
+        with open(path, 'w') as f:
+            f.write(contents)
+
+        return path
+
+    def run(self, *args, **kwargs):
+        for engine in self.engines:
+            self.engine = engine
+            super().run(*args, **kwargs)
+
+# -----------------------------------------------------------------------------
+
+class TestMap(DatabaseTestCase):
+    def build_objects(self, ctx):
+        return Compiler(ctx).build_objects([self.a, self.b])
+
+    def setUp(self):
+        super().setUp()
+
+        self.a = self.write('a.c', 'int a;\n')
+        self.b = self.write('b.c', 'int b;\n')
+
+    def testEditOneSource(self):
+        self.build(self.build_objects)
+        self.assertEqual(sorted(compiled), ['a.c', 'b.c'])
+
+        del compiled[:]
+        self.build(self.build_objects)
+        self.assertEqual(compiled, [])
+
+        # Only the source we edited should be compiled again.
+        self.write('b.c', 'int b, c;\n')
+        self.build(self.build_objects)
+        self.assertEqual(compiled, ['b.c'])
+
+    def testFunctionChanged(self):
+        self.build(self.build_objects)
+
+        # Pretend the compile function changed, which recompiles everything
+        # the next time we build the objects.
+        function = Compiler.__dict__['compile'].method
+        with mock.patch.dict(
+                fbuild.db.database.Database._digest_function_cache,
+                {function: 'changed'}):
+            del compiled[:]
+            self.write('a.c', 'int a, c;\n')
+            self.build(self.build_objects)
+            self.assertEqual(sorted(compiled), ['a.c', 'b.c'])
+
+            # The calls saved after the change should all still be cached.
+            del compiled[:]
+            self.write('b.c', 'int b, c;\n')
+            self.build(self.build_objects)
+            self.assertEqual(compiled, ['b.c'])
+
+# -----------------------------------------------------------------------------
+
+class TestMemo(DatabaseTestCase):
+    def testRepeatedCall(self):
+        a = self.write('a.c', 'int a;\n')
+
+        def f(ctx):
+            compiler = Compiler(ctx)
+            compiler.compile(a)
+
+            # Count the calls that go to the backend.
+            with mock.patch.object(ctx.db._backend, 'prepare') as prepare:
+                compiler.compile(a)
+                return prepare.call_count
+
+        self.assertEqual(self.build(f), 0)
+        self.assertEqual(compiled, ['a.c'])
+
+    def testWrittenSource(self):
+        a = self.tmpdir / 'a.c'
+
+        def f(ctx):
+            compiler = Compiler(ctx)
+
+            generate(ctx, a, 'int a;\n')
+            compiler.compile(a)
+            compiler.compile(a)
+            self.assertEqual(compiled, ['a.c'])
+
+            # The source was rewritten, so the compile is dirty again.
+            generate(ctx, a, 'int a, b;\n')
+            compiler.compile(a)
+            self.assertEqual(compiled, ['a.c', 'a.c'])
+
+        self.build(f)
+
+    def testExternalDestination(self):
+        a = self.tmpdir / 'a.c'
+
+        def f(ctx):
+            compiler = Compiler(ctx)
+
+            generate_external(ctx, a, 'int a;\n')
+            compiler.compile(a)
+            self.assertEqual(compiled, ['a.c'])
+
+            generate_external(ctx, a, 'int a, b;\n')
+            compiler.compile(a)
+            self.assertEqual(compiled, ['a.c', 'a.c'])
+
+        self.build(f)
+
+# -----------------------------------------------------------------------------
+
+class TestGarbageCollection(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.a = self.write('a.c', 'int a;\n')
+        self.b = self.write('b.c', 'int b;\n')
+
+    def build_objects(self, srcs):
+        def f(ctx):
+            return Compiler(ctx).build_objects(srcs)
+        return f
+
+    def collect_garbage(self, srcs):
+        def f(ctx):
+            Compiler(ctx).build_objects(srcs)
+            return ctx.db.collect_garbage()
+        return f
+
+    def testNoopBuild(self):
+        self.build(self.build_objects([self.a, self.b]))
+
+        # The compiles weren't checked since building the objects was cached,
+        # but they're still used by it.
+        self.assertEqual(
+            self.build(self.collect_garbage([self.a, self.b])),
+            (0, 0))
+
+        del compiled[:]
+        self.write('b.c', 'int b, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['b.c'])
+
+    def testUnusedCalls(self):
+        self.build(self.build_objects([self.a, self.b]))
+
+        # Building the objects of both sources, and compiling b.c, are
+        # unused.
+        call_count, file_count = \
+            self.build(self.collect_garbage([self.a]))
+        self.assertEqual(call_count, 2)
+
+        del compiled[:]
+        self.build(self.build_objects([self.a]))
+        self.assertEqual(compiled, [])
+
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['b.c'])
+
+# -----------------------------------------------------------------------------
+
+class TestDurations(DatabaseTestCase):
+    def tearDown(self):
+        del unrelated_tasks[:]
+        super().tearDown()
+
+    def testTasksOfOtherCalls(self):
+        def f(ctx):
+            unrelated_tasks.append(Task(ctx.db.add_duration_to_call, 5.0))
+            timed(ctx)
+
+            return ctx.db.find_call_durations()
+
+        self.assertEqual(self.build(f), [('test_database.timed', 3.0)])
+
+class TestEstimates(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.a = self.write('a.c', 'int a;\n')
+        self.b = self.write('b.c', 'int bb;\n')
+
+    def testFindDurations(self):
+        def f(ctx):
+            compiler = Compiler(ctx)
+            compiler.build_objects([self.a, self.b])
+
+            return ctx.db.find_durations([
+                (compiler.compile, self.a),
+                (compiler.compile, self.b),
+                (compiler.compile, self.tmpdir / 'c.c'),
+                (len, self.a)])
+
+        self.assertEqual(self.build(f), [7.0, 8.0, None, None])
+
+    def testMap(self):
+        self.build(lambda ctx: Compiler(ctx).build_objects([self.a, self.b]))
+
+        # Catch the estimates the database passes on to the scheduler.
+        estimates = []
+        def map(scheduler, function, srcs, **kwargs):
+            estimates.append(kwargs.get('estimates'))
+            return scheduler_map(scheduler, function, srcs, **kwargs)
+
+        scheduler_map = fbuild.sched.Scheduler.map
+        with mock.patch.object(fbuild.sched.Scheduler, 'map', map):
+            self.write('a.c', 'int a, c;\n')
+            self.write('b.c', 'int bb, c;\n')
+            self.build(
+                lambda ctx: Compiler(ctx).build_objects([self.a, self.b]),
+                '--schedule=critical-path')
+
+        self.assertIn([7.0, 8.0], estimates)
+
+# -----------------------------------------------------------------------------
+
+class TestCallStats(DatabaseTestCase):
+    def stats(self, function):
+        """Run the function as a build, and return the hits and misses of
+        each function it called."""
+
+        def f(ctx):
+            function(ctx)
+            return {fun_name: (s['hits'], {reason: misses
+                    for reason, misses in s['misses'].items() if misses})
+                for fun_name, s in ctx.db.find_call_stats().items()}
+
+        return self.build(f)
+
+    def testMissReasons(self):
+        a = self.write('a.c', 'int a;\n')
+        dst = self.tmpdir / 'b.txt'
+
+        def f(ctx):
+            count_lines(ctx, a)
+            generate(ctx, dst, 'b')
+            read_external(ctx, a)
+
+        # New functions are dirty.
+        self.assertEqual(self.stats(f), {
+            'test_database.count_lines': (0, {'function': 1}),
+            'test_database.generate': (0, {'function': 1}),
+            'test_database.read_external': (0, {'function': 1}),
+        })
+
+        # Calling them again only hits, including the memo of the calls we
+        # already checked during the build.
+        self.assertEqual(self.stats(lambda ctx: (f(ctx), f(ctx))), {
+            'test_database.count_lines': (2, {}),
+            'test_database.generate': (2, {}),
+            'test_database.read_external': (2, {}),
+        })
+
+        self.write('a.c', 'int a, b;\n')
+        dst.remove()
+        self.assertEqual(self.stats(lambda ctx: (
+                generate(ctx, dst, 'b'),
+                generate(ctx, dst, 'c'),
+                read_external(ctx, a),
+                count_lines(ctx, a))), {
+            'test_database.count_lines': (0, {'srcs': 1}),
+            'test_database.generate': (0, {'dsts': 1, 'arguments': 1}),
+            'test_database.read_external': (0, {'external srcs': 1}),
+        })
+
+# -----------------------------------------------------------------------------
+
+class TestDigests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.a = self.write('a.c', 'int a;\n')
+        self.b = self.write('b.c', 'int b;\n')
+
+    def build_objects(self, ctx):
+        return Compiler(ctx).build_objects([self.a, self.b])
+
+    def testDigestOnce(self):
+        digests = []
+        def f(ctx, bound):
+            digests.append(bound)
+            return digest_bound(ctx, bound)
+
+        digest_bound = fbuild.db.backend.digest_bound
+        with mock.patch.object(fbuild.db.backend, 'digest_bound', f):
+            # Making the compiler, building the objects, and compiling each
+            # of the sources.
+            self.build(self.build_objects)
+            self.assertEqual(len(digests), 4)
+
+            # The compiles aren't checked when building the objects is cached.
+            del digests[:]
+            self.build(self.build_objects)
+            self.assertEqual(len(digests), 2)
+
+    def testDigestVersionChanged(self):
+        self.build(self.build_objects)
+
+        # Pretend the digests changed, which the backends have to index the
+        # calls by before they can find them again.
+        def f(ctx, bound):
+            digest = digest_bound(ctx, bound)
+            return None if digest is None else 'new' + digest
+
+        digest_bound = fbuild.db.backend.digest_bound
+        with mock.patch.object(fbuild.db.backend, 'digest_bound', f), \
+                mock.patch.object(fbuild.db.backend, 'DIGEST_VERSION', 2):
+            del compiled[:]
+            self.build(self.build_objects)
+            self.assertEqual(compiled, [])
+
+            self.write('b.c', 'int b, c;\n')
+            self.build(self.build_objects)
+            self.assertEqual(compiled, ['b.c'])
+
+    def testRecursiveArguments(self):
+        items = [1]
+        items.append(items)
+
+        compiler = {}
+        compiler['self'] = compiler
+
+        nested = []
+        for i in range(10000):
+            nested = [nested]
+
+        # Arguments we can't digest fall back on searching every call.
+        def f(ctx):
+            for arg in (items, compiler, nested):
+                self.assertIsNone(
+                    fbuild.db.backend.digest_bound(ctx, {'arg': arg}))
+
+            self.assertIsNotNone(
+                fbuild.db.backend.digest_bound(ctx, {'arg': [items[0]]}))
+
+        self.build(f)
+
+# -----------------------------------------------------------------------------
+
+class TestSourceDigests(DatabaseTestCase):
+    # A module of cached functions that we can edit.
+    module = '''
+import fbuild.db
+
+runs = []
+
+@fbuild.db.caches
+def f(ctx):
+    runs.append('f')
+'''
+
+    def setUp(self):
+        super().setUp()
+
+        self.write('digested.py', self.module)
+        sys.path.insert(0, self.tmpdir)
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir)
+        sys.modules.pop('digested', None)
+        super().tearDown()
+
+    def build_f(self):
+        """Call the function in a new build, as if it was a new process that
+        hasn't digested any functions yet. Returns the functions whose
+        source was read."""
+
+        module = importlib.import_module('digested')
+
+        with mock.patch.dict(
+                fbuild.db.database.Database._digest_function_cache,
+                clear=True), \
+                mock.patch.object(fbuild.inspect, 'getsource',
+                    wraps=fbuild.inspect.getsource) as getsource:
+            self.build(module.f)
+
+        return [args[0].__name__ for args, kwargs in getsource.call_args_list]
+
+    def testSavedDigests(self):
+        runs = importlib.import_module('digested').runs
+
+        self.assertEqual(self.build_f(), ['f'])
+        self.assertEqual(runs, ['f'])
+
+        # The module didn't change, so we don't need to read it again.
+        self.assertEqual(self.build_f(), [])
+        self.assertEqual(runs, ['f'])
+
+        # Editing the module digests its functions again, but f is the same
+        # so it's still cached.
+        self.write('digested.py', self.module + '\ndef g():\n    pass\n')
+        self.assertEqual(self.build_f(), ['f'])
+        self.assertEqual(runs, ['f'])
+
+        self.assertEqual(self.build_f(), [])
+
+# -----------------------------------------------------------------------------
+
+class TestObjects(DatabaseTestCase):
+    # Only these backends store the objects in an object table.
+    engines = ('log', 'sqlite')
+
+    def testMutatedObject(self):
+        def f(ctx):
+            backend = ctx.db._backend
+            compiler = Compiler(ctx)
+
+            before = ctx.db._rpc.call(backend.dumps, compiler)
+            compiler.flags = ['-O2']
+            after = ctx.db._rpc.call(backend.dumps, compiler)
+
+            return (
+                ctx.db._rpc.call(backend.loads, before).__dict__.get('flags'),
+                ctx.db._rpc.call(backend.loads, after).flags)
+
+        # The object changed, so it should be stored again.
+        self.assertEqual(self.build(f), (None, ['-O2']))
+
+# -----------------------------------------------------------------------------
+
+class TestFiles(DatabaseTestCase):
+    def testFindFileOnce(self):
+        a = self.write('a.c', 'int a;\n')
+        b = self.write('b.c', 'int b;\n')
+
+        def f(ctx):
+            # Count how often each file is looked up in the database.
+            found = collections.Counter()
+            find_file = ctx.db._backend.find_file
+            def counting_find_file(file_name):
+                found[file_name] += 1
+                return find_file(file_name)
+            ctx.db._backend.find_file = counting_find_file
+
+            Compiler(ctx).build_objects([a, b])
+
+            return found
+
+        found = self.build(f)
+        self.assertIn(a, found)
+        self.assertEqual(set(found.values()), {1})
+
+        self.write('b.c', 'int b, c;\n')
+        found = self.build(f)
+        self.assertIn(b, found)
+        self.assertEqual(set(found.values()), {1})
+
+    def testPrefetchOutsideDatabaseThread(self):
+        a = self.write('a.c', 'int a;\n')
+        b = self.write('b.c', 'int b;\n')
+
+        # The srcs are hashed before the database thread checks them.
+        threads = []
+        digest = Path.digest
+        def f(path, *args, **kwargs):
+            if path in (a, b):
+                threads.append(threading.current_thread().name)
+            return digest(path, *args, **kwargs)
+
+        with mock.patch.object(Path, 'digest', f):
+            self.build(lambda ctx: Compiler(ctx).build_objects([a, b]))
+            self.write('a.c', 'int a, c;\n')
+            self.build(lambda ctx: count_lines(ctx, a))
+
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn('database', threads)
+
+    def testRewriteWithinTick(self):
+        a = self.write('a.c', 'int a;\n')
+
+        # Pretend the filesystem only has millisecond timestamps, so a
+        # rewrite of the same size within the tick keeps the same identity.
+        mtime_ns = time.time_ns() // 1000000 * 1000000 + 1000000
+        os.utime(a, ns=(mtime_ns, mtime_ns))
+        self.build(lambda ctx: Compiler(ctx).compile(a))
+
+        self.write('a.c', 'int b;\n')
+        os.utime(a, ns=(mtime_ns, mtime_ns))
+
+        # The next build notices the rewrite, even if it's long after it.
+        later_ns = time.time_ns() + 10000000000
+        with mock.patch.object(time, 'time_ns', return_value=later_ns):
+            del compiled[:]
+            self.build(lambda ctx: Compiler(ctx).compile(a))
+            self.assertEqual(compiled, ['a.c'])
+
+    def testOldIdentity(self):
+        a = self.write('a.c', 'int a;\n')
+        mtime_ns = time.time_ns() - 10000000000
+        os.utime(a, ns=(mtime_ns, mtime_ns))
+        self.build(lambda ctx: Compiler(ctx).compile(a))
+
+        # The file isn't hashed again while it keeps its old identity.
+        with mock.patch.object(Path, 'digest') as digest:
+            self.build(lambda ctx: Compiler(ctx).compile(a))
+            self.assertFalse(digest.called)
+
+    def testDigestAlgorithm(self):
+        a = self.write('a.c', 'int a;\n')
+        md5 = hashlib.md5(b'int a;\n').hexdigest()
+        blake2b = hashlib.blake2b(b'int a;\n', digest_size=20).hexdigest()
+
+        def f(ctx):
+            # New files are hashed with blake2b, but files that were hashed
+            # with md5 keep their digests.
+            stat_file = ctx.db._backend.stat_file
+            self.assertEqual(stat_file(a)[1], blake2b)
+            self.assertEqual(stat_file(a, None, md5)[1], md5)
+            self.assertEqual(
+                stat_file(a, None, hashlib.md5().hexdigest())[1],
+                md5)
+
+            Compiler(ctx).compile(a)
+            return ctx.db._rpc.call(ctx.db._backend.find_file, a)[2]
+
+        self.assertEqual(self.build(f), blake2b)
+
+# -----------------------------------------------------------------------------
+
+class TestConcurrentReads(DatabaseTestCase):
+    engines = ('sqlite',)
+
+    def setUp(self):
+        super().setUp()
+
+        # Build in a directory with characters that are special in a URI.
+        self.root = self.tmpdir
+        self.tmpdir = self.root / 'a #b?c%41'
+        self.tmpdir.makedirs()
+
+    def tearDown(self):
+        self.tmpdir = self.root
+        super().tearDown()
+
+    def testSpecialCharacters(self):
+        a = self.write('a.c', 'int a;\n')
+
+        def f(ctx):
+            # Count the calls that the readers could prepare, since the
+            # database thread takes over the calls the readers fail on.
+            prepared = []
+            try_prepare = ctx.db._backend.try_prepare
+            def counting_try_prepare(*args, **kwargs):
+                result = try_prepare(*args, **kwargs)
+                prepared.append(result is not None)
+                return result
+            ctx.db._backend.try_prepare = counting_try_prepare
+
+            Compiler(ctx).build_objects([a])
+
+            return prepared
+
+        self.build(f, '--concurrent-reads')
+        self.assertEqual(compiled, ['a.c'])
+
+        del compiled[:]
+        self.assertIn(True, self.build(f, '--concurrent-reads'))
+        self.assertEqual(compiled, [])
+
+# -----------------------------------------------------------------------------
+
+class TestSqliteMigration(DatabaseTestCase):
+    engines = ('sqlite',)
+
+    # The layout of the databases made before we versioned them.
+    schema = '''
+        CREATE TABLE Function (
+            fun_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fun_name TEXT UNIQUE,
+            fun_digest TEXT);
+        CREATE INDEX Function_name_index ON Function (fun_name);
+
+        CREATE TABLE Call (
+            call_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fun_id INTEGER REFERENCES Function(fun_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            call_bound BLOB,
+            call_result BLOB);
+        CREATE INDEX Call_fun_id_index ON Call (fun_id);
+
+        CREATE TABLE File (
+            file_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT UNIQUE,
+            file_mtime INTEGER,
+            file_digest TEXT);
+        CREATE INDEX File_name_index ON File (file_name);
+
+        CREATE TABLE CallFile (
+            call_id INTEGER REFERENCES Call(call_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            file_id INTEGER REFERENCES File(file_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            file_digest TEXT,
+            PRIMARY KEY (call_id, file_id));
+
+        CREATE TABLE ExternalSrc (
+            call_id INTEGER REFERENCES Call(call_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            file_id INTEGER REFERENCES File(file_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            PRIMARY KEY (call_id, file_id));
+
+        CREATE TABLE ExternalDst (
+            call_id INTEGER REFERENCES Call(call_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            file_id INTEGER REFERENCES File(file_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE,
+            PRIMARY KEY (call_id, file_id));
+        '''
+
+    @property
+    def state_file(self):
+        return self.tmpdir / 'build' / 'fbuild-state.db'
+
+    def downgrade(self):
+        """Rewrite the database with the layout of version 0. Back then the
+        files were hashed with md5 and their mtimes were in seconds."""
+
+        with sqlite3.connect(self.state_file) as conn:
+            functions = conn.execute(
+                'SELECT fun_id, fun_name, fun_digest FROM Function').fetchall()
+            calls = conn.execute(
+                'SELECT call_id, fun_id, call_bound, call_result FROM Call'
+                ).fetchall()
+            files = conn.execute(
+                'SELECT file_id, file_name, file_mtime FROM File').fetchall()
+            call_files = conn.execute(
+                'SELECT call_id, file_id FROM CallFile').fetchall()
+        conn.close()
+
+        digests = {}
+        for file_id, file_name, file_mtime in files:
+            with open(file_name, 'rb') as f:
+                digests[file_id] = hashlib.md5(f.read()).hexdigest()
+
+        os.remove(self.state_file)
+
+        with sqlite3.connect(self.state_file) as conn:
+            conn.executescript(self.schema)
+            conn.executemany('INSERT INTO Function VALUES (?,?,?)', functions)
+            conn.executemany('INSERT INTO Call VALUES (?,?,?,?)', calls)
+            conn.executemany('INSERT INTO File VALUES (?,?,?,?)',
+                [(file_id, file_name, file_mtime / 1e9, digests[file_id])
+                    for file_id, file_name, file_mtime in files])
+            conn.executemany('INSERT INTO CallFile VALUES (?,?,?)',
+                [(call_id, file_id, digests[file_id])
+                    for call_id, file_id in call_files])
+        conn.close()
+
+    def testMigrateVersion0(self):
+        a = self.write('a.c', 'int a;\n')
+
+        # Only the identities of files that weren't just written are saved.
+        mtime_ns = time.time_ns() - 10000000000
+        os.utime(a, ns=(mtime_ns, mtime_ns))
+
+        self.build(lambda ctx: count_lines(ctx, a))
+        self.downgrade()
+
+        # The call is still cached after the migration.
+        del compiled[:]
+        self.assertEqual(self.build(lambda ctx: count_lines(ctx, a)), 1)
+        self.assertEqual(compiled, [])
+
+        with sqlite3.connect(self.state_file) as conn:
+            version, = conn.execute('PRAGMA user_version').fetchone()
+            self.assertEqual(version,
+                fbuild.db.sqlite_backend.SqliteBackend.SCHEMA_VERSION)
+
+            # The call was given a digest when we found it, and the file's
+            # mtime was converted to integer nanoseconds.
+            self.assertEqual(
+                conn.execute('SELECT COUNT(*) FROM Call '
+                    'WHERE call_digest IS NULL').fetchone(),
+                (0,))
+            file_mtime, file_digest = conn.execute(
+                'SELECT file_mtime, file_digest FROM File WHERE file_name=?',
+                (a,)).fetchone()
+            self.assertEqual(file_mtime, os.stat(a).st_mtime_ns)
+            self.assertEqual(len(file_digest), 32)
+        conn.close()
+
+        self.write('a.c', 'int a;\nint b;\n')
+        self.assertEqual(self.build(lambda ctx: count_lines(ctx, a)), 2)
+        self.assertEqual(compiled, ['a.c'])
+
+# -----------------------------------------------------------------------------
+
+class TestProcessExecutor(DatabaseTestCase):
+    engines = ('sqlite',)
+
+    def testSubstitute(self):
+        src = self.write('a.txt.in', 'a = @A@\n')
+
+        submitted = []
+        submit = concurrent.futures.ProcessPoolExecutor.submit
+        def f(executor, function, *args, **kwargs):
+            submitted.append(function)
+            return submit(executor, function, *args, **kwargs)
+
+        with mock.patch.object(concurrent.futures.ProcessPoolExecutor,
+                'submit', f):
+            dst = self.build(
+                lambda ctx: fbuild.builders.text.substitute(ctx,
+                    'a.txt', src, {'@A@': '1'}),
+                '--executor=process')
+
+        self.assertEqual(submitted, [fbuild.builders.text._substitute])
+
+        with open(dst) as f:
+            self.assertEqual(f.read(), 'a = 1\n')
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(TestMap),
+        loader.loadTestsFromTestCase(TestMemo),
+        loader.loadTestsFromTestCase(TestGarbageCollection),
+        loader.loadTestsFromTestCase(TestDurations),
+        loader.loadTestsFromTestCase(TestEstimates),
+        loader.loadTestsFromTestCase(TestDigests),
+        loader.loadTestsFromTestCase(TestSourceDigests),
+        loader.loadTestsFromTestCase(TestObjects),
+        loader.loadTestsFromTestCase(TestFiles),
+        loader.loadTestsFromTestCase(TestConcurrentReads),
+        loader.loadTestsFromTestCase(TestSqliteMigration),
+        loader.loadTestsFromTestCase(TestProcessExecutor),
+    ))
+
+if __name__ == "__main__":
+    unittest.main()
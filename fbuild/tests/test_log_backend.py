@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+from unittest import mock
+
+import fbuild.db.log_backend
+
+from test_database import Compiler, DatabaseTestCase, compiled
+
+# -----------------------------------------------------------------------------
+
+class LogBackendTestCase(DatabaseTestCase):
+    engines = ('log',)
+
+    def setUp(self):
+        super().setUp()
+
+        self.a = self.write('a.c', 'int a;\n')
+        self.b = self.write('b.c', 'int b;\n')
+
+    def build_objects(self, srcs, keep_builds=None):
+        def f(ctx):
+            Compiler(ctx).build_objects(srcs)
+
+            if keep_builds is not None:
+                return ctx.db.collect_garbage(keep_builds)
+        return f
+
+    @property
+    def log_file(self):
+        return self.tmpdir / 'build' / 'fbuild-state.db'
+
+    def read_log(self):
+        with open(self.log_file, 'rb') as f:
+            return f.read()
+
+# -----------------------------------------------------------------------------
+
+class TestUses(LogBackendTestCase):
+    def testNoopBuild(self):
+        self.build(self.build_objects([self.a, self.b]))
+        log = self.read_log()
+
+        # Nothing changed, so nothing should be written.
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(self.read_log(), log)
+
+        self.write('b.c', 'int b, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertNotEqual(self.read_log(), log)
+
+        log = self.read_log()
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(self.read_log(), log)
+
+    def testKeepBuilds(self):
+        self.build(self.build_objects([self.a, self.b]))
+        self.build(self.build_objects([self.a]))
+
+        # Compiling b.c was used by the build before the last one.
+        self.assertEqual(
+            self.build(self.build_objects([self.a], keep_builds=2)),
+            (0, 0))
+
+        # Only building the objects of a.c was used by the last build.
+        call_count, file_count = \
+            self.build(self.build_objects([self.a], keep_builds=1))
+        self.assertEqual(call_count, 2)
+
+        del compiled[:]
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['b.c'])
+
+# -----------------------------------------------------------------------------
+
+class TestReplay(LogBackendTestCase):
+    def testReplay(self):
+        self.build(self.build_objects([self.a, self.b]))
+
+        # Each build appends the records that changed, which replace the
+        # ones before them when the log is read back.
+        self.write('b.c', 'int b, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.write('b.c', 'int b, d;\n')
+        self.build(self.build_objects([self.a, self.b]))
+
+        del compiled[:]
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, [])
+
+        self.write('a.c', 'int a, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['a.c'])
+
+    def testInterruptedSave(self):
+        self.build(self.build_objects([self.a, self.b]))
+        log = self.read_log()
+
+        # Pretend the last save was interrupted halfway through a record.
+        with open(self.log_file, 'ab') as f:
+            f.write(fbuild.db.log_backend.LogBackend.HEADER.pack(b'c', 9, 100))
+            f.write(b'\xffpartial\xff')
+
+        del compiled[:]
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, [])
+
+        # The partial record is dropped when the next records are appended.
+        self.write('b.c', 'int b, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['b.c'])
+        self.assertTrue(self.read_log().startswith(log))
+        self.assertNotIn(b'\xffpartial\xff', self.read_log())
+
+class TestLazyLoading(LogBackendTestCase):
+    def testLoadFunctionOnUse(self):
+        self.build(self.build_objects([self.a, self.b]))
+
+        def f(ctx):
+            backend = ctx.db._backend
+
+            # Nothing is unpickled until it's used.
+            self.assertEqual(backend._functions, {})
+            self.assertEqual(backend._function_calls, {})
+
+            Compiler(ctx).build_objects([self.a, self.b])
+
+            return set(backend._functions), set(backend._function_records)
+
+        # Building the objects was cached, so the compiles were never looked
+        # at.
+        functions, records = self.build(f)
+        self.assertIn('fbuild.builders.Compiler.build_objects', functions)
+        self.assertNotIn('test_database.Compiler.compile', functions)
+        self.assertEqual(records, {b'test_database.Compiler.compile'})
+
+        # The records we didn't load are still in the log.
+        del compiled[:]
+        self.write('b.c', 'int b, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['b.c'])
+
+class TestCompaction(LogBackendTestCase):
+    def compact(self):
+        """Compact any log where at least half of the records were
+        replaced, however small it is."""
+        return mock.patch.object(fbuild.db.log_backend.LogBackend,
+            'COMPACT_SIZE', 0)
+
+    def testCompact(self):
+        self.build(self.build_objects([self.a, self.b]))
+
+        # Replace the records of compiling b.c a few times.
+        for i in range(5):
+            self.write('b.c', 'int b%d;\n' % i)
+            self.build(self.build_objects([self.a, self.b]))
+
+        # The log is compacted while we build, and replaces the log when we're
+        # done even though nothing changed.
+        size = len(self.read_log())
+        with self.compact():
+            self.build(self.build_objects([self.a, self.b]))
+        self.assertLess(len(self.read_log()), size)
+        self.assertFalse(os.path.exists(self.log_file + '.compact'))
+
+        # Nothing we still need was left out.
+        del compiled[:]
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, [])
+
+        self.write('a.c', 'int a, c;\n')
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, ['a.c'])
+
+    def testCompactWithChanges(self):
+        self.build(self.build_objects([self.a, self.b]))
+
+        for i in range(5):
+            self.write('b.c', 'int b%d;\n' % i)
+            self.build(self.build_objects([self.a, self.b]))
+
+        # The records of the build are appended to the compacted log.
+        size = len(self.read_log())
+        self.write('a.c', 'int a, c;\n')
+        with self.compact():
+            self.build(self.build_objects([self.a, self.b]))
+        self.assertLess(len(self.read_log()), size)
+
+        del compiled[:]
+        self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(compiled, [])
+
+    def testLiveLog(self):
+        self.build(self.build_objects([self.a, self.b]))
+        log = self.read_log()
+
+        # Nothing was replaced, so there's nothing to compact.
+        with self.compact():
+            self.build(self.build_objects([self.a, self.b]))
+        self.assertEqual(self.read_log(), log)
+
+class TestClose(LogBackendTestCase):
+    def testNoopClose(self):
+        self.build(self.build_objects([self.a, self.b]))
+        mtime = os.stat(self.log_file).st_mtime_ns
+        log = self.read_log()
+
+        # Closing a database we didn't use shouldn't touch the log.
+        self.build(lambda ctx: None)
+        self.assertEqual(self.read_log(), log)
+        self.assertEqual(os.stat(self.log_file).st_mtime_ns, mtime)
+
+    def testNewLog(self):
+        self.build(lambda ctx: None)
+
+        self.assertTrue(self.read_log().startswith(
+            fbuild.db.log_backend.LogBackend.MAGIC))
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(TestUses),
+        loader.loadTestsFromTestCase(TestReplay),
+        loader.loadTestsFromTestCase(TestLazyLoading),
+        loader.loadTestsFromTestCase(TestCompaction),
+        loader.loadTestsFromTestCase(TestClose),
+    ))
+
+if __name__ == "__main__":
+    unittest.main()
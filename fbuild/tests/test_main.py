@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import builtins
+import collections
+import importlib
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import fbuild.console
+import fbuild.db.database
+import fbuild.main
+from fbuild.path import Path
+
+# -----------------------------------------------------------------------------
+
+class MainTestCase(unittest.TestCase):
+    """Runs fbuild on an fbuildroot.py in a temp dir."""
+
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        sys.path.insert(0, self.tmpdir)
+
+        # fbuild replaces the ctrl-c handler while it runs.
+        self.handler = signal.getsignal(signal.SIGINT)
+
+    def tearDown(self):
+        signal.signal(signal.SIGINT, self.handler)
+        sys.modules.pop('fbuildroot', None)
+        sys.path.remove(self.tmpdir)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def main(self, fbuildroot, *args):
+        """Run fbuild with the arguments on the fbuildroot source."""
+
+        with open(self.tmpdir / 'fbuildroot.py', 'w') as f:
+            f.write(fbuildroot)
+
+        # Make sure we import the fbuildroot we just wrote.
+        sys.modules.pop('fbuildroot', None)
+        importlib.invalidate_caches()
+
+        with mock.patch.object(sys, 'dont_write_bytecode', True):
+            return fbuild.main.main(['fbuild',
+                '--buildroot=' + self.tmpdir / 'build'] + list(args))
+
+# -----------------------------------------------------------------------------
+
+class TestProfileStartup(MainTestCase):
+    def testImportRestored(self):
+        original = builtins.__import__
+
+        self.assertEqual(
+            self.main('def build(ctx): pass\n', '--profile-startup'),
+            0)
+        self.assertIs(builtins.__import__, original)
+
+    def testImportRestoredAfterError(self):
+        original = builtins.__import__
+
+        # Fail while fbuild is still starting up.
+        for fbuildroot in (
+                'raise RuntimeError("broken fbuildroot")\n',
+                'def pre_options(parser):\n'
+                '    raise RuntimeError("broken options")\n'):
+            with self.assertRaises(RuntimeError):
+                self.main(fbuildroot, '--profile-startup')
+            self.assertIs(builtins.__import__, original)
+
+# -----------------------------------------------------------------------------
+
+class TestCallStats(MainTestCase):
+    fbuildroot = '''
+import fbuild.db
+
+@fbuild.db.caches
+def answer(ctx):
+    return 42
+
+def build(ctx):
+    answer(ctx)
+    answer(ctx)
+'''
+
+    def testCallStatsFile(self):
+        stats_file = self.tmpdir / 'stats.json'
+
+        for i in range(2):
+            self.main(self.fbuildroot, '--call-stats-file=' + stats_file)
+
+        with open(stats_file) as f:
+            stats = json.load(f)
+
+        self.assertEqual(list(stats), ['fbuildroot.answer'])
+        self.assertEqual(stats['fbuildroot.answer']['hits'], 2)
+        self.assertEqual(stats['fbuildroot.answer']['misses'],
+            dict.fromkeys(fbuild.db.database.MISS_REASONS, 0))
+        for time in ('prepare_time', 'body_time', 'cache_time'):
+            self.assertGreaterEqual(stats['fbuildroot.answer'][time], 0.0)
+
+    def testCallStats(self):
+        with mock.patch.object(fbuild.console.Log, 'log') as log:
+            self.main(self.fbuildroot, '--call-stats')
+
+        lines = [args[0] for args, kwargs in log.call_args_list
+            if isinstance(args[0], str)]
+        header = [line for line in lines if line.startswith('function ')]
+        row, = [line for line in lines
+            if line.startswith('fbuildroot.answer ')]
+
+        self.assertEqual(len(header), 1)
+        self.assertEqual(row.split()[1:8], ['1', '1', '1', '0', '0', '0', '0'])
+
+# -----------------------------------------------------------------------------
+
+class TestTrace(MainTestCase):
+    fbuildroot = '''
+import sys
+
+import fbuild.db
+
+@fbuild.db.caches
+def square(ctx, x):
+    ctx.execute([sys.executable, '-c', 'pass'], quieter=1)
+    return x * x
+
+def build(ctx):
+    ctx.scheduler.map(lambda x: square(ctx, x), range(4))
+'''
+
+    def trace(self):
+        trace_file = self.tmpdir / 'trace.json'
+        self.main(self.fbuildroot, '-j2', '--trace=' + trace_file)
+
+        with open(trace_file) as f:
+            return json.load(f)['traceEvents']
+
+    def testEvents(self):
+        events = self.trace()
+
+        # Each thread is named before its slices.
+        named = set()
+        slices = collections.defaultdict(list)
+        for event in events:
+            if event['ph'] == 'M':
+                self.assertEqual(event['name'], 'thread_name')
+                self.assertNotIn(event['tid'], named)
+                named.add(event['tid'])
+            else:
+                self.assertEqual(event['ph'], 'X')
+                self.assertIn(event['tid'], named)
+                self.assertIsInstance(event['name'], str)
+                self.assertGreaterEqual(event['ts'], 0)
+                self.assertGreaterEqual(event['dur'], 0)
+                slices[event['tid']].append(event)
+
+        categories = {event['cat'] for events in slices.values()
+            for event in events}
+        self.assertLessEqual(
+            {'target', 'task', 'call', 'execute', 'rpc', 'rpc wait'},
+            categories)
+
+        # The slices of each thread are nested in each other.
+        for events in slices.values():
+            stack = []
+            for event in sorted(events, key=lambda e: (e['ts'], -e['dur'])):
+                while stack and end(stack[-1]) <= event['ts']:
+                    stack.pop()
+                if stack:
+                    self.assertLessEqual(end(event), end(stack[-1]) + 1,
+                        (event, stack[-1]))
+                stack.append(event)
+
+        # The database handles each call while its caller waits on it.
+        waits = [event for events in slices.values() for event in events
+            if event['cat'] == 'rpc wait']
+        for rpc in (event for events in slices.values() for event in events
+                if event['cat'] == 'rpc'):
+            self.assertTrue(any(
+                    wait['name'] == rpc['name'] and
+                    wait['tid'] != rpc['tid'] and
+                    wait['ts'] <= rpc['ts'] and
+                    end(rpc) <= end(wait) + 1
+                for wait in waits), rpc)
+
+def end(event):
+    return event['ts'] + event['dur']
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(TestProfileStartup),
+        loader.loadTestsFromTestCase(TestCallStats),
+        loader.loadTestsFromTestCase(TestTrace),
+    ))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import shutil
+import unittest
+from unittest import mock
+
+import fbuild.builders.c.gcc
+import fbuild.db
+from fbuild.builders.c.objcache import ObjectCache, find_object_cache
+
+from test_database import DatabaseTestCase
+
+# -----------------------------------------------------------------------------
+
+class Builder(fbuild.db.PersistentObject):
+    """A builder that can be identified without a compiler. Its identity isn't
+    part of its state, like the version of a real compiler."""
+
+    def identity(self):
+        return ('gcc', '1.0', ())
+
+# -----------------------------------------------------------------------------
+
+class ObjectCacheTestCase(DatabaseTestCase):
+    engines = ('pickle',)
+
+    def setUp(self):
+        super().setUp()
+
+        self.src = self.write('a.c', '#include "a.h"\nint a;\n')
+        self.header = self.write('a.h', 'int b;\n')
+        self.obj = self.write('a.o', 'object')
+
+    def with_cache(self, function):
+        """Run the function with a new context and a cache in the temp
+        dir."""
+        return self.build(lambda ctx:
+            function(ctx, ObjectCache(ctx, self.tmpdir / 'cache')))
+
+# -----------------------------------------------------------------------------
+
+class TestKey(ObjectCacheTestCase):
+    def testIdentity(self):
+        def key(ctx, identity):
+            # The cache only identifies each builder once, so use a new one.
+            cache = ObjectCache(ctx, self.tmpdir / 'cache')
+            with mock.patch.object(Builder, 'identity',
+                    return_value=identity):
+                return cache.key(Builder(ctx), self.src, {'flags': []})
+
+        def f(ctx, cache):
+            gcc = key(ctx, ('gcc', '1.0', ()))
+            self.assertIsNotNone(gcc)
+            self.assertEqual(gcc, key(ctx, ('gcc', '1.0', ())))
+
+            # Another compiler, version or set of builder flags.
+            for identity in (
+                    ('clang', '1.0', ()),
+                    ('gcc', '2.0', ()),
+                    ('gcc', '1.0', ('-O2',))):
+                self.assertNotEqual(gcc, key(ctx, identity))
+
+            # Compilers we can't identify can't be cached.
+            self.assertIsNone(key(ctx, None))
+
+        self.with_cache(f)
+
+    def testArguments(self):
+        def f(ctx, cache):
+            gcc = Builder(ctx)
+            key = cache.key(gcc, self.src, {'flags': []})
+
+            self.assertNotEqual(key,
+                cache.key(gcc, self.src, {'flags': ['-O2']}))
+            self.assertNotEqual(key,
+                cache.key(gcc, self.src, {'flags': [], 'macros': ['A']}))
+
+            # The buildroot only changes where the object goes.
+            self.assertEqual(key,
+                cache.key(gcc, self.src,
+                    {'flags': [], 'buildroot': self.tmpdir / 'other'}))
+
+        self.with_cache(f)
+
+    def testSource(self):
+        def f(ctx, cache):
+            return cache.key(Builder(ctx), self.src,
+                {'flags': []})
+
+        key = self.with_cache(f)
+        self.write('a.c', '#include "a.h"\nint a, c;\n')
+        self.assertNotEqual(key, self.with_cache(f))
+
+class TestFind(ObjectCacheTestCase):
+    def add(self, ctx, cache):
+        key = cache.key(Builder(ctx), self.src,
+            {'flags': []})
+        cache.add(key, self.obj, [self.src, self.header])
+
+        return key
+
+    def testRestore(self):
+        key = self.with_cache(self.add)
+
+        # The cache is shared with the next build.
+        def f(ctx, cache):
+            cached, deps = cache.find(key)
+            self.assertEqual(deps, [self.src, self.header])
+
+            obj = self.tmpdir / 'build' / 'obj' / 'a.o'
+            cache.restore(cached, obj)
+
+            with open(obj) as o:
+                return o.read()
+
+        self.assertEqual(self.with_cache(f), 'object')
+
+    def testChangedHeader(self):
+        key = self.with_cache(self.add)
+        find = lambda ctx, cache: cache.find(key)
+
+        self.write('a.h', 'int c;\n')
+        self.assertIsNone(self.with_cache(find))
+
+        # Changing it back finds the object again.
+        self.write('a.h', 'int b;\n')
+        self.assertIsNotNone(self.with_cache(find))
+
+    def testManifest(self):
+        key = self.with_cache(self.add)
+
+        # Each set of dependencies is remembered separately.
+        self.write('a.h', 'int c;\n')
+        self.write('a.o', 'other object')
+        self.assertEqual(self.with_cache(self.add), key)
+
+        find = lambda ctx, cache: cache.find(key)
+        for header, obj in (
+                ('int b;\n', 'object'),
+                ('int c;\n', 'other object')):
+            self.write('a.h', header)
+            cached, deps = self.with_cache(find)
+            with open(cached) as f:
+                self.assertEqual(f.read(), obj)
+
+class TestFindObjectCache(ObjectCacheTestCase):
+    def testContext(self):
+        def f(ctx):
+            cache = find_object_cache(ctx)
+            self.assertIs(find_object_cache(ctx), cache)
+
+            return cache
+
+        # Each build keeps its own cache.
+        args = ('--object-cache=' + self.tmpdir / 'cache',)
+        cache = self.build(f, *args)
+        self.assertEqual(cache.dirname, self.tmpdir / 'cache')
+        self.assertIsNot(self.build(f, *args), cache)
+
+        self.assertIsNone(self.build(f))
+
+# -----------------------------------------------------------------------------
+
+@unittest.skipUnless(shutil.which('gcc'), 'gcc is not available')
+class TestGcc(ObjectCacheTestCase):
+    def compile(self, **kwargs):
+        """Compile the source in a new buildroot. Returns the object and if
+        gcc had to compile it."""
+
+        shutil.rmtree(self.tmpdir / 'build', ignore_errors=True)
+
+        def f(ctx):
+            builder = fbuild.builders.c.gcc.static(ctx)
+
+            with mock.patch.object(fbuild.builders.c.gcc.Compiler,
+                    '__call__', autospec=True,
+                    side_effect=fbuild.builders.c.gcc.Compiler.__call__) as cc:
+                obj = builder.compile(self.src, **kwargs)
+
+            with open(obj, 'rb') as f:
+                return f.read(), cc.call_count > 0
+
+        return self.build(f, '--object-cache=' + self.tmpdir / 'cache')
+
+    def testCompile(self):
+        obj, compiled = self.compile()
+        self.assertTrue(compiled)
+
+        # Another buildroot restores the object instead of compiling it.
+        self.assertEqual(self.compile(), (obj, False))
+
+        # Other flags need another object.
+        self.assertTrue(self.compile(flags=['-O2'])[1])
+
+        self.write('a.h', 'int c;\n')
+        self.assertTrue(self.compile()[1])
+
+# -----------------------------------------------------------------------------
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(TestKey),
+        loader.loadTestsFromTestCase(TestFind),
+        loader.loadTestsFromTestCase(TestFindObjectCache),
+        loader.loadTestsFromTestCase(TestGcc),
+    ))
+
+if __name__ == "__main__":
+    unittest.main()
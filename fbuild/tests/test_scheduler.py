@@ -5,10 +5,29 @@ import random
 import unittest
 import gc
 
+import fbuild.builders.ocaml
 from fbuild.console import Log
-from fbuild.sched import Scheduler
+from fbuild.path import Path
+from fbuild.sched import Scheduler, Task, process_safe, _is_process_safe
 
+import concurrent.futures
+import functools
+import os
+import shutil
+import sys
+import tempfile
 import threading
+from unittest import mock
+
+# The felix tools, when we're testing the fbuild in a felix checkout.
+tools_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', '..', 'src', 'tools')
+
+# -----------------------------------------------------------------------------
+
+@process_safe
+def getpid(x):
+    return x + 1, os.getpid()
 
 # -----------------------------------------------------------------------------
 
@@ -51,6 +70,54 @@ class TestScheduler(unittest.TestCase):
             self.scheduler.map(g, [[0,1,2],[3,4,5],[6,7,8]]),
             [[1,2,3],[4,5,6],[7,8,9]])
 
+    def testSubmit(self):
+        def f(x, y=0):
+            time.sleep(random.random() * 0.01)
+            return x + y
+
+        futures = [self.scheduler.submit(f, x, y=1) for x in range(5)]
+        self.assertEquals(self.scheduler.wait(futures), [1,2,3,4,5])
+        self.assertTrue(all(future.done() for future in futures))
+
+        # Functions can be given by name.
+        future = self.scheduler.submit('operator.add', 1, 2)
+        self.assertEquals(future.result(), 3)
+
+        # Waiting from inside a task mustn't deadlock.
+        def g(x):
+            return self.scheduler.wait(
+                [self.scheduler.submit(f, x, y) for y in range(3)])
+
+        self.assertEquals(
+            self.scheduler.wait([self.scheduler.submit(g, x) for x in range(3)]),
+            [[0,1,2],[1,2,3],[2,3,4]])
+
+    def testRecursiveWaitSleeps(self):
+        def f(x):
+            time.sleep(0.1)
+            return x
+
+        def g(x):
+            return self.scheduler.map(f, x)
+
+        # The threads waiting on the slow tasks should sleep rather than poll
+        # the ready queue.
+        start = time.process_time()
+        self.assertEquals(
+            self.scheduler.map(g, [[0,1],[2,3]]),
+            [[0,1],[2,3]])
+        self.assertLess(time.process_time() - start, 0.1)
+
+    def testSubmitError(self):
+        def f(x):
+            raise ValueError(x)
+
+        futures = [self.scheduler.submit(f, x) for x in range(3)]
+        with self.assertRaises(ValueError):
+            self.scheduler.wait(futures)
+
+        self.assertTrue(all(future.done() for future in futures))
+
     def run(self, *args, **kwargs):
         for i in range(10):
             self.threads = i
@@ -58,8 +125,190 @@ class TestScheduler(unittest.TestCase):
 
 # -----------------------------------------------------------------------------
 
+class TestCriticalPathScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(4, schedule='critical-path')
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def testPrioritize(self):
+        a, b, c, d = [Task(None, src) for src in 'abcd']
+        b.dependencies.append(a)
+        c.dependencies.append(b)
+        d.cost = 5
+
+        children = {a: [b], b: [c], c: [], d: []}
+        self.scheduler._prioritize([a, b, c, d], children)
+
+        self.assertEqual(
+            [t.priority for t in (a, b, c, d)],
+            [3, 2, 1, 5])
+
+    def testPrioritizeLoop(self):
+        a, b = Task(None, 'a'), Task(None, 'b')
+        a.dependencies.append(b)
+        b.dependencies.append(a)
+
+        children = {a: [b], b: [a]}
+        self.scheduler._prioritize([a, b], children)
+
+        self.assertEqual(sorted(t.priority for t in (a, b)), [1, 2])
+
+    def testPrioritizeEstimates(self):
+        batches = []
+        def estimate(tasks):
+            batches.append([src for function, src in tasks])
+            return [{'a': 1, 'c': 4}.get(src) for function, src in tasks]
+
+        scheduler = Scheduler(1, schedule='critical-path', estimate=estimate)
+        try:
+            # Tasks we don't know about are assumed to take the average time.
+            a, b, c = [Task(None, src) for src in 'abc']
+            scheduler._prioritize([a, b, c], {a: [], b: [], c: []})
+            self.assertEqual([t.priority for t in (a, b, c)], [1, 2.5, 4])
+            self.assertEqual(batches, [['a', 'b', 'c']])
+
+            # Estimates we're given are used instead.
+            scheduler._prioritize([a, b, c], {a: [], b: [], c: []},
+                [3, None, None])
+            self.assertEqual([t.priority for t in (a, b, c)], [3, 3, 3])
+            self.assertEqual(len(batches), 1)
+        finally:
+            scheduler.shutdown()
+
+    def testMapWithDependencies(self):
+        def deps(x):
+            return {'a': ['b', 'c'], 'b': ['c'], 'c': [], 'd': []}[x]
+
+        def f(x):
+            time.sleep(random.random() * 0.01)
+            return x
+
+        self.assertEqual(
+            self.scheduler.map_with_dependencies(deps, f, ['a','b','c','d']),
+            ['c','b','a','d'])
+
+# -----------------------------------------------------------------------------
+
+class TestProcessScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(2, executor='process')
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def testMap(self):
+        results = self.scheduler.map(getpid, [0,1,2,3])
+
+        self.assertEqual([r for r, pid in results], [1,2,3,4])
+        self.assertNotIn(os.getpid(), [pid for r, pid in results])
+
+    def testUnsafeFunctionsStayOnThreads(self):
+        def f(x):
+            return x + 1, os.getpid()
+
+        self.assertEqual(
+            self.scheduler.map(f, [0,1,2]),
+            [(1, os.getpid()), (2, os.getpid()), (3, os.getpid())])
+
+    def testMapWithDependencies(self):
+        def deps(x):
+            return {0: [1, 2], 1: [2], 2: []}[x]
+
+        results = self.scheduler.map_with_dependencies(deps, getpid, [0,1,2])
+        self.assertEqual([r for r, pid in results], [3,2,1])
+
+    def testSubmit(self):
+        r, pid = self.scheduler.submit(getpid, 0).result()
+
+        self.assertEqual(r, 1)
+        self.assertNotEqual(pid, os.getpid())
+
+# -----------------------------------------------------------------------------
+
+class TestProcessSafeFunctions(unittest.TestCase):
+    """Make sure the functions we've marked as process safe really run in
+    the process pool."""
+
+    def setUp(self):
+        self.scheduler = Scheduler(2, executor='process')
+        self.tmpdir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def map(self, function, srcs):
+        """Map the function over the sources, and check that each one was
+        sent to the process pool."""
+
+        submitted = []
+        submit = concurrent.futures.ProcessPoolExecutor.submit
+        def f(executor, *args, **kwargs):
+            submitted.append(args)
+            return submit(executor, *args, **kwargs)
+
+        with mock.patch.object(concurrent.futures.ProcessPoolExecutor,
+                'submit', f):
+            results = self.scheduler.map(function, srcs)
+
+        self.assertEqual(len(submitted), len(srcs))
+
+        return results
+
+    def write(self, name, contents):
+        path = self.tmpdir / name
+        path.parent.makedirs()
+        with open(path, 'w') as f:
+            f.write(contents)
+
+        return path
+
+    def testOcamlModuleSources(self):
+        src = self.write('foo.ml', '')
+        self.write('lib/bar.mli', '')
+
+        self.assertEqual(
+            self.map(functools.partial(
+                    fbuild.builders.ocaml._find_module_sources,
+                    modules=('Bar',),
+                    includes=[self.tmpdir / 'lib'],
+                    buildroot=self.tmpdir / 'build'),
+                [src]),
+            [[self.tmpdir / 'lib' / 'bar.mli']])
+
+    @unittest.skipUnless(os.path.exists(os.path.join(tools_dir, 'flx_iscr.py')),
+        'flx_iscr is not available')
+    def testTanglePackages(self):
+        sys.path.append(tools_dir)
+        try:
+            import flx_iscr
+        finally:
+            sys.path.remove(tools_dir)
+
+        src = self.write('a.fdoc', '@tangler a = a.txt\n@tangle a\nhello\n')
+        self.assertTrue(_is_process_safe(flx_iscr.process_file))
+
+        self.map(
+            functools.partial(flx_iscr.process_file,
+                odir=self.tmpdir / 'out',
+                quiet=True),
+            [src])
+
+        with open(self.tmpdir / 'out' / 'a.txt') as f:
+            self.assertEqual(f.read(), 'hello\n')
+
+# -----------------------------------------------------------------------------
+
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestScheduler)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((
+        loader.loadTestsFromTestCase(TestScheduler),
+        loader.loadTestsFromTestCase(TestCriticalPathScheduler),
+        loader.loadTestsFromTestCase(TestProcessScheduler),
+        loader.loadTestsFromTestCase(TestProcessSafeFunctions),
+    ))
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,3 +1,4 @@
+from functools import partial
 from itertools import chain
 from optparse import make_option
 
@@ -449,13 +450,18 @@ def src_dir(ctx):
 
 # ------------------------------------------------------------------------------
 
-def tangle_packages(package_dir, odir):
+def tangle_packages(ctx, package_dir, odir):
     # import the processing logic from flx_iscr
     sys.path.append("src/tools/")
     import flx_iscr
 
+    # The packages are independent, so tangle them in parallel. Tangling is
+    # all python, so the process executor can run it in other processes.
     quiet = True
-    flx_iscr.process_dir(package_dir, odir, quiet)
+    ctx.scheduler.map(
+        partial(flx_iscr.process_file, odir=odir, quiet=quiet),
+        sorted(package_dir / i for i in package_dir.listdir()
+            if i.endswith('.fdoc')))
 
 def find_grammar(build_dir):
     sys.path.append("src/tools/")
@@ -578,7 +584,7 @@ def build(ctx):
     set_version(ctx.buildroot)
 
     print("[fbuild] RUNNING PACKAGE MANAGER")
-    tangle_packages(Path("src")/"packages", ctx.buildroot)
+    tangle_packages(ctx, Path("src")/"packages", ctx.buildroot)
 
     print("[fbuild] CONFIGURING FELIX")
     # configure the phases
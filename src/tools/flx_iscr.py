@@ -167,21 +167,28 @@ def process_dir(package_dir, odir, quiet):
     for i in os.listdir(package_dir):
         i = os.path.join(package_dir, i)
         if i[-5:] == ".fdoc":
-          # print debugging
-          print('PACKAGE', i)
-
-          odir = os.path.abspath(odir)
-          iname = os.path.abspath(i)
-          p = Processor(iname, odir, quiet)
-          # Process the input file and buffer up the code.
           try:
-              f = open_utf8(iname)
+              process_file(i, odir, quiet)
           except IOError as ex:
               sys.exit(str(ex))
-          with f:
-              p.process(f)
-          p.save()
 
+# Tangle one package. This doesn't share any state with the other packages,
+# so the packages can be processed in parallel.
+def process_file(iname, odir, quiet):
+    # print debugging
+    print('PACKAGE', iname)
+
+    odir = os.path.abspath(odir)
+    iname = os.path.abspath(iname)
+    p = Processor(iname, odir, quiet)
+    # Process the input file and buffer up the code.
+    with open_utf8(iname) as f:
+        p.process(f)
+    p.save()
+
+# Let fbuild's process executor run it in other processes. This is what
+# fbuild.sched.process_safe does, without needing fbuild to run the script.
+process_file.process_safe = True
 
 def iscr():
     # Parse the arguments.